@@ -15,19 +15,125 @@ from reportlab.platypus import (
     Table,
     TableStyle,
     Image,
-    PageBreak
+    PageBreak,
+    KeepTogether
 )
-from reportlab.lib.units import cm
+from reportlab.lib.units import cm, inch
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY, TA_LEFT
-import matplotlib.pyplot as plt
 import os
+import sys
+from importlib import metadata
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+BUNDLED_FONT_DIR = os.path.join(APP_DIR, 'dejavu-fonts-ttf-2.37', 'ttf')
+MPL_CACHE_ENV = 'MPLCONFIGDIR'
+
+
+def matplotlib_cache_dir():
+    """Папка кэша шрифтов matplotlib в каталоге приложения, своя для каждой версии"""
+    try:
+        version = metadata.version('matplotlib')
+    except metadata.PackageNotFoundError:
+        version = 'unknown'
+    return os.path.join(APP_DIR, '.mpl_cache', f"matplotlib-{version}")
+
+
+def default_matplotlib_cache_dir():
+    """Папка кэша, которую matplotlib выбирает сам при отсутствии MPLCONFIGDIR"""
+    if sys.platform.startswith(('linux', 'freebsd')):
+        return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'matplotlib')
+    return os.path.join(os.path.expanduser('~'), '.matplotlib')
+
+
+def _can_write_dir(path):
+    """Папку можно дописать или создать в ближайшем существующем родителе"""
+    while not os.path.isdir(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return os.access(path, os.W_OK)
+
+
+def configure_matplotlib_cache(force=False):
+    """Переносит кэш шрифтов в каталог приложения, если папка по умолчанию недоступна
+
+    Без записи в ~/.cache (например, в контейнере) matplotlib при каждом запуске
+    заново сканирует системные шрифты. force — для команды font-cache, которая
+    собирает кэш при сборке образа. Вызывается до импорта matplotlib.
+    """
+    if MPL_CACHE_ENV in os.environ:
+        return
+    if not force and _can_write_dir(default_matplotlib_cache_dir()):
+        return
+    try:
+        os.makedirs(matplotlib_cache_dir(), exist_ok=True)
+        if os.access(matplotlib_cache_dir(), os.W_OK):
+            os.environ[MPL_CACHE_ENV] = matplotlib_cache_dir()
+    except OSError:
+        pass  # Каталог приложения только для чтения: matplotlib выберет папку сам
+
+
+# Только при запуске программы: воркеры наследуют MPLCONFIGDIR через окружение,
+# а импорт модуля другими инструментами ни окружение, ни каталог приложения не трогает
+if __name__ == "__main__":
+    configure_matplotlib_cache(force='font-cache' in sys.argv[1:])
+
+import matplotlib.pyplot as plt
+from matplotlib import font_manager
 from PIL import Image as PILImage, ImageDraw, ImageFont
 import matplotlib
-import sys
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import json
+import gzip
+import io
+import tarfile
+import zipfile
+import csv
 import glob
+import fnmatch
+import hashlib
+import bisect
+import math
+import time
+import threading
+import multiprocessing
+import traceback
+import uuid
+from array import array
+import shutil
+import atexit
+import signal
+import socket
+import gc
+import heapq
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from functools import lru_cache
+from html import escape
+from itertools import count
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from email import policy as email_policy
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 matplotlib.use('Agg')
 
@@ -68,8 +174,33 @@ MATPLOT_SECONDARY = '#F18F01'
 # 1. РЕГИСТРАЦИЯ ШРИФТОВ
 # ============================================================================
 
+BUNDLED_FONT = os.path.join(BUNDLED_FONT_DIR, 'DejaVuSans.ttf')
+BUNDLED_BOLD_FONT = os.path.join(BUNDLED_FONT_DIR, 'DejaVuSans-Bold.ttf')
+CHART_FONT_FAMILY = 'DejaVu Sans'
+
+
+@lru_cache(maxsize=None)
+def register_chart_fonts():
+    """Подключает поставляемые шрифты к matplotlib без поиска по системе"""
+    for path in (BUNDLED_FONT, BUNDLED_BOLD_FONT):
+        if os.path.exists(path):
+            font_manager.fontManager.addfont(path)
+    return CHART_FONT_FAMILY
+
+
+@lru_cache(maxsize=None)
 def register_fonts():
-    """Регистрирует кириллические шрифты"""
+    """Регистрирует кириллические шрифты (один раз на процесс)"""
+    if os.path.exists(BUNDLED_FONT):
+        try:
+            pdfmetrics.registerFont(TTFont('DejaVuSans', BUNDLED_FONT))
+            if os.path.exists(BUNDLED_BOLD_FONT):
+                pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', BUNDLED_BOLD_FONT))
+                return 'DejaVuSans', 'DejaVuSans-Bold'
+            return 'DejaVuSans', 'DejaVuSans'
+        except Exception:
+            pass
+
     font_paths = [
         "DejaVuSans.ttf",
         "fonts/DejaVuSans.ttf",
@@ -224,7 +355,793 @@ def create_styles(normal_font, bold_font):
 
 
 # ============================================================================
-# 3. СОЗДАНИЕ ЛОГОТИПА
+# 3. ВРЕМЕННЫЕ ФАЙЛЫ И АТОМАРНАЯ ЗАПИСЬ
+# ============================================================================
+
+# Переменная окружения наследуется процессами-воркерами
+SCRATCH_ENV = 'FOOTSCAN_SCRATCH_DIR'
+DEFAULT_SCRATCH_ROOT = 'temp_graphs'
+_scratch_dir = None
+
+
+def configure_scratch(root):
+    """Задает корень временных папок (например, /dev/shm/footscan для tmpfs)"""
+    global _scratch_dir
+    os.environ[SCRATCH_ENV] = os.path.abspath(root)
+    _scratch_dir = None
+
+
+def scratch_root():
+    return os.environ.get(SCRATCH_ENV) or os.path.abspath(DEFAULT_SCRATCH_ROOT)
+
+
+def scratch_dir():
+    """Личная временная папка процесса: параллельные воркеры не пересекаются"""
+    global _scratch_dir
+    if _scratch_dir is None or not os.path.isdir(_scratch_dir):
+        _scratch_dir = os.path.join(scratch_root(), f"{os.getpid()}_{uuid.uuid4().hex[:8]}")
+        os.makedirs(_scratch_dir, exist_ok=True)
+        atexit.register(shutil.rmtree, _scratch_dir, ignore_errors=True)
+    return _scratch_dir
+
+
+def unique_stamp():
+    """Метка времени для имен файлов, уникальная и внутри одной секунды"""
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+
+
+def temp_sibling(path):
+    """Уникальное временное имя в папке path (os.replace атомарен в пределах одной ФС)"""
+    directory, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(directory, f".{stem}.{uuid.uuid4().hex[:8]}.tmp{ext}")
+
+
+@contextmanager
+def atomic_path(path):
+    """Временный путь рядом с path; после успешной записи файл атомарно заменяет path"""
+    temp_path = temp_sibling(path)
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def write_json_atomic(path, payload, **kwargs):
+    with atomic_path(path) as temp_path:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(payload, f, ensure_ascii=False, **kwargs)
+
+
+# ============================================================================
+# 4. ХРАНИЛИЩЕ АРТЕФАКТОВ
+# ============================================================================
+
+# Увеличивать при любом изменении внешнего вида графиков или отчета:
+# старые артефакты перестанут находиться и со временем будут вытеснены
+TEMPLATE_VERSION = '2'
+
+STORE_ENV = 'FOOTSCAN_STORE_DIR'
+STORE_BUDGET_ENV = 'FOOTSCAN_STORE_BUDGET_MB'
+DEFAULT_STORE_DIR = 'artifact_store'
+DEFAULT_STORE_BUDGET_MB = 1024
+STORE_EXTENSIONS = {'radar': '.png', 'comparison': '.png'}
+_artifact_store = None
+
+
+class ArtifactStore:
+    """Графики по хэшу входных данных и версии шаблона; вытеснение LRU по бюджету диска"""
+
+    def __init__(self, root, budget_mb=DEFAULT_STORE_BUDGET_MB):
+        self.root = os.path.abspath(root)
+        self.budget_bytes = int(budget_mb * 1024 * 1024) if budget_mb else None
+        self._added = 0
+
+    def key(self, kind, inputs):
+        payload = json.dumps({'kind': kind, 'template': TEMPLATE_VERSION, 'inputs': inputs},
+                             sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def path(self, kind, key):
+        return os.path.join(self.root, kind, key[:2], key + STORE_EXTENSIONS.get(kind, ''))
+
+    def fetch(self, kind, key, dest):
+        """Копирует готовый артефакт в dest; False — артефакта нет"""
+        path = self.path(kind, key)
+        try:
+            with atomic_path(dest) as temp_path:
+                shutil.copyfile(path, temp_path)
+            # mtime — отметка последнего использования для LRU
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, kind, key, src):
+        """Сохраняет копию src; при заметном росте хранилища запускает вытеснение"""
+        path = self.path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_path(path) as temp_path:
+            shutil.copyfile(src, temp_path)
+
+        self._added += os.path.getsize(path)
+        if self.budget_bytes and self._added > self.budget_bytes // 10:
+            self.evict()
+
+    def _entries(self):
+        pending = [self.root]
+        while pending:
+            try:
+                entries = list(os.scandir(pending.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        pending.append(entry.path)
+                    elif not entry.name.startswith('.'):
+                        stat = entry.stat()
+                        yield stat.st_mtime, stat.st_size, entry.path
+                except OSError:
+                    continue
+
+    def evict(self, budget_bytes=None):
+        """Удаляет давно не использованные артефакты до бюджета; возвращает (файлов, байт, осталось байт)"""
+        budget = self.budget_bytes if budget_bytes is None else budget_bytes
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = freed = 0
+
+        for _, size, path in entries:
+            if budget is None or total <= budget:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            removed += 1
+            freed += size
+
+        self._added = 0
+        return removed, freed, total
+
+
+def configure_store(root, budget_mb=DEFAULT_STORE_BUDGET_MB):
+    """Задает хранилище артефактов для процесса и его воркеров; root=None — отключить"""
+    global _artifact_store
+    os.environ[STORE_ENV] = os.path.abspath(root) if root else ''
+    os.environ[STORE_BUDGET_ENV] = str(budget_mb or 0)
+    _artifact_store = None
+
+
+def artifact_store():
+    """Хранилище артефактов процесса или None, если оно отключено"""
+    global _artifact_store
+    root = os.environ.get(STORE_ENV, DEFAULT_STORE_DIR)
+    if not root:
+        return None
+    if _artifact_store is None:
+        budget_mb = float(os.environ.get(STORE_BUDGET_ENV, DEFAULT_STORE_BUDGET_MB))
+        _artifact_store = ArtifactStore(root, budget_mb)
+    return _artifact_store
+
+
+def render_cached(kind, inputs, output_path, render):
+    """Берет график из хранилища или строит его через render(output_path) и сохраняет"""
+    store = artifact_store()
+    if store is None:
+        return render(output_path)
+
+    key = store.key(kind, inputs)
+    if store.fetch(kind, key, output_path):
+        print(f"[CACHE] График {kind} взят из хранилища")
+        return True
+
+    created = render(output_path)
+    if created:
+        store.put(kind, key, output_path)
+    return created
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def collect_garbage(store_root, budget_mb, stale_after=3600):
+    """Команда gc: вытесняет артефакты сверх бюджета, удаляет брошенные временные файлы и папки"""
+    store = ArtifactStore(store_root, budget_mb)
+    removed, freed, remaining = store.evict()
+    print(f"[GC] Хранилище {store.root}: удалено {removed} артефактов, "
+          f"освобождено {freed / 1024 / 1024:.1f} МБ, осталось {remaining / 1024 / 1024:.1f} МБ")
+
+    temp_removed = temp_freed = 0
+    now = time.time()
+    for root, dirs, files in os.walk(store.root):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+                if name.startswith('.') and '.tmp' in name and now - stat.st_mtime > stale_after:
+                    os.remove(path)
+                    temp_removed += 1
+                    temp_freed += stat.st_size
+            except OSError:
+                continue
+
+    # Временные папки процессов, которые завершились аварийно
+    if os.path.isdir(scratch_root()):
+        for entry in os.scandir(scratch_root()):
+            pid = entry.name.split('_', 1)[0]
+            if entry.is_dir() and pid.isdigit() and not _pid_alive(int(pid)):
+                for root, dirs, files in os.walk(entry.path):
+                    for name in files:
+                        try:
+                            temp_freed += os.path.getsize(os.path.join(root, name))
+                            temp_removed += 1
+                        except OSError:
+                            pass
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    print(f"[GC] Временные файлы: удалено {temp_removed}, освобождено {temp_freed / 1024 / 1024:.1f} МБ")
+    print(f"[GC] Всего освобождено: {(freed + temp_freed) / 1024 / 1024:.1f} МБ")
+    return freed + temp_freed
+
+
+# ============================================================================
+# 5. ОТЛАДОЧНЫЙ ЖУРНАЛ
+# ============================================================================
+
+DEBUG_LOG_ENV = 'FOOTSCAN_DEBUG_LOG_DIR'
+DEFAULT_DEBUG_LOG_DIR = 'debug_log'
+DEBUG_SEGMENT_BYTES = 64 * 1024 * 1024
+_debug_log = None
+
+
+class DebugLog:
+    """Отладочные записи в сжатых сегментах JSONL с индексом смещений
+
+    Каждая запись — отдельный gzip-член, поэтому сегмент остается обычным
+    .jsonl.gz, а запись читается по смещению без распаковки всего файла.
+    Каждый процесс пишет в свои сегменты; рядом лежит индекс <сегмент>.idx.
+    """
+
+    def __init__(self, root, segment_bytes=DEBUG_SEGMENT_BYTES):
+        self.root = os.path.abspath(root)
+        self.segment_bytes = segment_bytes
+        self.segment_path = None
+        self._segment = None
+        self._index = None
+        self._offset = 0
+
+    def _open_segment(self):
+        self.close()
+        os.makedirs(self.root, exist_ok=True)
+        base_path = os.path.join(self.root, f"debug_{unique_stamp()}_{os.getpid()}")
+        self.segment_path = base_path + '.jsonl.gz'
+        self._segment = open(self.segment_path, 'ab')
+        self._index = open(base_path + '.idx', 'a', encoding='utf-8')
+        self._offset = self._segment.tell()
+
+    def append(self, record):
+        """Дописывает запись; при превышении размера начинает новый сегмент"""
+        if self._segment is None or self._offset >= self.segment_bytes:
+            self._open_segment()
+
+        member = gzip.compress((json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8'), compresslevel=6)
+        self._segment.write(member)
+        self._segment.flush()
+
+        # Индекс пишется после данных: он никогда не указывает на недописанную запись
+        data = record.get('data') or {}
+        self._index.write(json.dumps({
+            'offset': self._offset,
+            'length': len(member),
+            'input_pdf': record.get('input_pdf'),
+            'scanner_id': data.get('scanner_id', ''),
+            'client_name': data.get('client_name', ''),
+            'generated': record.get('generated')
+        }, ensure_ascii=False) + "\n")
+        self._index.flush()
+        self._offset += len(member)
+
+    def close(self):
+        for f in (self._segment, self._index):
+            if f is not None:
+                f.close()
+        self._segment = self._index = None
+
+
+def configure_debug_log(root):
+    """Задает папку отладочного журнала для процесса и его воркеров; root=None — отключить"""
+    global _debug_log
+    os.environ[DEBUG_LOG_ENV] = os.path.abspath(root) if root else ''
+    _debug_log = None
+
+
+def debug_log_root():
+    return os.environ.get(DEBUG_LOG_ENV, DEFAULT_DEBUG_LOG_DIR)
+
+
+def write_debug_record(record):
+    """Добавляет запись об обработанном файле в отладочный журнал процесса"""
+    global _debug_log
+    if not debug_log_root():
+        return
+    if _debug_log is None:
+        _debug_log = DebugLog(debug_log_root())
+    try:
+        _debug_log.append(record)
+    except OSError as e:
+        print(f"[WARNING] Не удалось записать отладочный журнал: {e}")
+
+
+def iter_debug_index(root):
+    """Выдает (сегмент, запись индекса) по всем сегментам журнала"""
+    for index_path in sorted(glob.glob(os.path.join(root, '*.idx'))):
+        segment_path = index_path[:-len('.idx')] + '.jsonl.gz'
+        with open(index_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield segment_path, json.loads(line)
+                except ValueError:
+                    continue
+
+
+def read_debug_record(segment_path, offset, length):
+    with open(segment_path, 'rb') as f:
+        f.seek(offset)
+        return json.loads(gzip.decompress(f.read(length)))
+
+
+def lookup_debug_records(root, query):
+    """Записи журнала по имени входного файла (допускаются шаблоны) или ID сканера"""
+    for segment_path, entry in iter_debug_index(root):
+        input_pdf = entry.get('input_pdf') or ''
+        if ((query and query == entry.get('scanner_id')) or fnmatch.fnmatch(input_pdf, query)
+                or os.path.splitext(input_pdf)[0] == query):
+            yield read_debug_record(segment_path, entry['offset'], entry['length'])
+
+
+# ============================================================================
+# 6. ИСТОРИЯ ПАЦИЕНТОВ
+# ============================================================================
+
+HISTORY_ENV = 'FOOTSCAN_HISTORY_DIR'
+DEFAULT_HISTORY_DIR = 'patient_history'
+HISTORY_METRICS = ('foot_length', 'foot_width', 'arch_index', 'hallux_angle')
+HISTORY_LOCK_STALE = 30.0
+SCAN_DATE_FORMATS = ('%Y/%m/%d', '%d.%m.%Y', '%Y-%m-%d', '%d/%m/%Y')
+_patient_history = None
+
+
+def normalize_client_name(name):
+    """Имя для сравнения: регистр, ё/е и лишние пробелы не различаются"""
+    return ' '.join(str(name or '').casefold().replace('ё', 'е').split())
+
+
+def scan_sort_key(scan_date):
+    """Дата сканирования как YYYY-MM-DD ('' — не распознана)"""
+    for date_format in SCAN_DATE_FORMATS:
+        try:
+            return datetime.strptime(str(scan_date or '').strip(), date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return ''
+
+
+class PatientHistory:
+    """Индекс прошлых сканирований: по JSON файлу на пациента (номер сканера + имя)
+
+    Путь файла вычисляется из ключа пациента, поэтому поиск не зависит от
+    размера архива. Файл пациента обновляется под файловой блокировкой и
+    заменяется атомарно; одна дата сканирования хранится один раз.
+    Блокировка — flock на файле <пациент>.json.lock (файл не удаляется); без
+    fcntl (Windows) — файл-блокировка с токеном.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    @staticmethod
+    def key(data):
+        scanner_id = str(data.get('scanner_id') or '').strip()
+        client_name = normalize_client_name(data.get('client_name'))
+        if not scanner_id and not client_name:
+            return None
+        return hashlib.blake2b(f"{scanner_id}\0{client_name}".encode('utf-8'), digest_size=16).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.json')
+
+    def scans(self, data):
+        """Все сканирования пациента по возрастанию даты"""
+        key = self.key(data)
+        if key is None:
+            return []
+        try:
+            with open(self.path(key), encoding='utf-8') as f:
+                return json.load(f)['scans']
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def previous_scans(self, data):
+        """Сканирования пациента, сделанные раньше текущего"""
+        current = scan_sort_key(data.get('scan_date'))
+        if not current:
+            return []
+        return [scan for scan in self.scans(data) if scan['date'] < current]
+
+    @staticmethod
+    def _lock_token(lock_path):
+        try:
+            with open(lock_path, encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _take_stale_lock(self, lock_path):
+        """Снимает блокировку процесса, завершившегося аварийно; True — можно пробовать снова
+
+        Как и в LeaseQueue, блокировка сначала переименовывается и снимается,
+        только если это та же просроченная блокировка (тот же токен): иначе
+        два ожидающих процесса могли бы удалить свежую блокировку друг друга.
+        """
+        token = self._lock_token(lock_path)
+        try:
+            if time.time() - os.path.getmtime(lock_path) <= HISTORY_LOCK_STALE:
+                return False
+        except OSError:
+            return True
+
+        stale_path = f"{lock_path}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(lock_path, stale_path)
+        except OSError:
+            return True
+
+        try:
+            if (self._lock_token(stale_path) == token
+                    and time.time() - os.path.getmtime(stale_path) > HISTORY_LOCK_STALE):
+                print(f"[WARNING] Снята брошенная блокировка истории: {os.path.basename(lock_path)}")
+                return True
+            # Между проверкой и переименованием блокировку взял другой процесс — возвращаем ее
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                print(f"[WARNING] Блокировка истории перехвачена: {os.path.basename(lock_path)}")
+            return False
+        finally:
+            os.remove(stale_path)
+
+    @contextmanager
+    def _locked(self, path):
+        """Блокировка файла пациента; выдает проверку, что блокировка все еще наша"""
+        lock_path = path + '.lock'
+        if fcntl is not None:
+            # flock снимается ОС вместе с процессом, поэтому брошенных блокировок не бывает
+            with open(lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield lambda: True
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return
+
+        token = uuid.uuid4().hex
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._take_stale_lock(lock_path):
+                    time.sleep(0.05)
+                continue
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(token)
+            break
+        try:
+            yield lambda: self._lock_token(lock_path) == token
+        finally:
+            # Чужую блокировку не удаляем, даже если наша была снята как брошенная
+            if self._lock_token(lock_path) == token:
+                try:
+                    os.remove(lock_path)
+                except OSError:
+                    pass
+
+    def add(self, data, risk_scores, generated=None, input_pdf=''):
+        """Добавляет сканирование; более ранняя запись о той же дате не заменяет новую"""
+        key = self.key(data)
+        date = scan_sort_key(data.get('scan_date'))
+        if key is None or not date:
+            return False
+
+        scan = {
+            'date': date,
+            'scan_date': data.get('scan_date'),
+            'generated': str(generated or datetime.now().isoformat(timespec='seconds')),
+            'input_pdf': input_pdf,
+            'risk_scores': risk_scores,
+        }
+        for metric in HISTORY_METRICS:
+            scan[metric] = list(FootPair.from_dict(data.get(metric) or {}))
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        while True:
+            with self._locked(path) as still_held:
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        payload = json.load(f)
+                except (OSError, ValueError):
+                    payload = {'scanner_id': data.get('scanner_id', ''), 'client_name': data.get('client_name', ''),
+                               'scans': []}
+
+                same_date = [item for item in payload['scans'] if item['date'] == date]
+                if same_date and same_date[0]['generated'] > scan['generated']:
+                    return False
+                payload['scans'] = sorted([item for item in payload['scans'] if item['date'] != date] + [scan],
+                                          key=lambda item: item['date'])
+                # Блокировку сочли брошенной и перехватили: файл мог измениться, читаем заново
+                if not still_held():
+                    continue
+                write_json_atomic(path, payload)
+            return True
+
+
+def configure_history(root):
+    """Задает папку индекса истории для процесса и его воркеров; root=None — отключить"""
+    global _patient_history
+    os.environ[HISTORY_ENV] = os.path.abspath(root) if root else ''
+    _patient_history = None
+
+
+def patient_history():
+    """Индекс истории процесса или None, если он отключен"""
+    global _patient_history
+    root = os.environ.get(HISTORY_ENV, DEFAULT_HISTORY_DIR)
+    if not root:
+        return None
+    if _patient_history is None:
+        _patient_history = PatientHistory(root)
+    return _patient_history
+
+
+def rebuild_history(history, debug_log_dir=None, legacy_dir=None):
+    """Заполняет индекс по отладочному журналу и старым JSON; возвращает число добавленных"""
+    added = 0
+    for record in iter_stored_records(debug_log_dir, legacy_dir):
+        if history.add(record['data'], record['risk_scores'], generated=record.get('generated'),
+                       input_pdf=record.get('input_pdf', '')):
+            added += 1
+    return added
+
+
+def ensure_history(debug_log_dir=None, legacy_dir=None):
+    """При первом запуске строит индекс истории из уже накопленных записей"""
+    history = patient_history()
+    if history is None or os.path.isdir(history.root):
+        return
+    os.makedirs(history.root, exist_ok=True)
+    added = rebuild_history(history, debug_log_dir, legacy_dir)
+    print(f"[INFO] Индекс истории пациентов построен: {history.root} (сканирований: {added})")
+
+
+# ============================================================================
+# 7. КОГОРТНАЯ СТАТИСТИКА
+# ============================================================================
+
+SKETCH_ACCURACY = 0.01
+SKETCH_MIN_VALUE = 1e-9
+COHORT_MIN_SIZE = 10
+COHORT_QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+COHORT_METRICS = (
+    ('foot_length', 'Длина стопы, мм'),
+    ('foot_width', 'Ширина стопы, мм'),
+    ('ball_girth', 'Обхват плюсны, мм'),
+    ('arch_index', 'Индекс свода'),
+    ('heel_angle', 'Угол пятки, °'),
+    ('hallux_angle', 'Угол пальца, °'),
+)
+
+
+class QuantileSketch:
+    """Сливаемый скетч квантилей с относительной точностью (по схеме DDSketch)
+
+    Значения раскладываются по логарифмическим корзинам, поэтому память зависит
+    от диапазона значений, а не от их числа. Скетчи с одинаковой точностью
+    сливаются сложением счетчиков — в любом порядке и на любом узле.
+    """
+
+    def __init__(self, relative_accuracy=SKETCH_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def _index(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _bucket(self, value):
+        """Ключ корзины, упорядоченный так же, как значения"""
+        if value > SKETCH_MIN_VALUE:
+            return 1, self._index(value)
+        if value < -SKETCH_MIN_VALUE:
+            return -1, -self._index(-value)
+        return 0, 0
+
+    def _value(self, bucket):
+        sign, index = bucket
+        return sign * 2 * self.gamma ** (sign * index) / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        sign, index = self._bucket(value)
+        if sign > 0:
+            self.positive[index] = self.positive.get(index, 0) + count
+        elif sign < 0:
+            self.negative[-index] = self.negative.get(-index, 0) + count
+        else:
+            self.zero_count += count
+        self.count += count
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Скетчи с разной точностью не сливаются")
+        for index, count in other.positive.items():
+            self.positive[index] = self.positive.get(index, 0) + count
+        for index, count in other.negative.items():
+            self.negative[index] = self.negative.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def _buckets(self):
+        """(ключ корзины, счетчик) по возрастанию значений"""
+        for index in sorted(self.negative, reverse=True):
+            yield (-1, -index), self.negative[index]
+        if self.zero_count:
+            yield (0, 0), self.zero_count
+        for index in sorted(self.positive):
+            yield (1, index), self.positive[index]
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for bucket, count in self._buckets():
+            seen += count
+            if seen > rank:
+                return self._value(bucket)
+        return self._value(bucket)
+
+    def rank(self, value):
+        """Доля значений не больше value (значения своей корзины считаются наполовину)"""
+        if not self.count:
+            return None
+        target = self._bucket(value)
+        below = equal = 0
+        for bucket, count in self._buckets():
+            if bucket < target:
+                below += count
+            elif bucket == target:
+                equal = count
+            else:
+                break
+        return (below + equal / 2) / self.count
+
+    def to_dict(self):
+        return {'accuracy': self.relative_accuracy, 'zero': self.zero_count,
+                'positive': {str(index): count for index, count in self.positive.items()},
+                'negative': {str(index): count for index, count in self.negative.items()}}
+
+    @classmethod
+    def from_dict(cls, payload):
+        sketch = cls(payload['accuracy'])
+        sketch.positive = {int(index): count for index, count in payload['positive'].items()}
+        sketch.negative = {int(index): count for index, count in payload['negative'].items()}
+        sketch.zero_count = payload['zero']
+        sketch.count = sketch.zero_count + sum(sketch.positive.values()) + sum(sketch.negative.values())
+        return sketch
+
+
+class CohortStats:
+    """Скетчи параметров стоп по группам 'all' и полу; обе стопы — отдельные значения"""
+
+    def __init__(self):
+        self.sketches = {}
+        self.patients = {}
+
+    @staticmethod
+    def _groups(data):
+        gender = str(data.get('gender') or '').strip()
+        return ('all', gender) if gender else ('all',)
+
+    def _sketch(self, group, metric):
+        return self.sketches.setdefault(f"{group}|{metric}", QuantileSketch())
+
+    def add(self, data):
+        for group in self._groups(data):
+            self.patients[group] = self.patients.get(group, 0) + 1
+            for metric, _ in COHORT_METRICS:
+                for value in FootPair.from_dict(data.get(metric) or {}):
+                    self._sketch(group, metric).add(float(value))
+
+    def merge(self, other):
+        for key, sketch in other.sketches.items():
+            self.sketches.setdefault(key, QuantileSketch(sketch.relative_accuracy)).merge(sketch)
+        for group, count in other.patients.items():
+            self.patients[group] = self.patients.get(group, 0) + count
+        return self
+
+    def percentiles(self, data):
+        """Перцентили пациента в своей группе пола (или во всей когорте); None, если когорта мала"""
+        group = self._groups(data)[-1]
+        if self.patients.get(group, 0) < COHORT_MIN_SIZE:
+            group = 'all'
+        if self.patients.get(group, 0) < COHORT_MIN_SIZE:
+            return None
+        return {
+            'group': group,
+            'size': self.patients[group],
+            'metrics': {metric: [round(100 * self._sketch(group, metric).rank(float(value)))
+                                 for value in FootPair.from_dict(data.get(metric) or {})]
+                        for metric, _ in COHORT_METRICS},
+        }
+
+    def rows(self):
+        """(группа, пациентов, метрика, значений, квантили COHORT_QUANTILES)"""
+        for group in sorted(self.patients, key=lambda name: (name != 'all', name)):
+            for metric, _ in COHORT_METRICS:
+                sketch = self.sketches.get(f"{group}|{metric}")
+                if sketch and sketch.count:
+                    yield (group, self.patients[group], metric, sketch.count,
+                           [sketch.quantile(q) for q in COHORT_QUANTILES])
+
+    def to_dict(self):
+        return {'patients': self.patients,
+                'sketches': {key: sketch.to_dict() for key, sketch in self.sketches.items()}}
+
+    @classmethod
+    def from_dict(cls, payload):
+        cohort = cls()
+        cohort.patients = dict(payload['patients'])
+        cohort.sketches = {key: QuantileSketch.from_dict(sketch) for key, sketch in payload['sketches'].items()}
+        return cohort
+
+    def save(self, path):
+        write_json_atomic(path, self.to_dict())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+
+def merge_cohort_files(paths):
+    """Сливает когорты, сохраненные разными пакетами и узлами"""
+    cohort = CohortStats()
+    for path in paths:
+        try:
+            cohort.merge(CohortStats.load(path))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[WARNING] Когорта не прочитана: {path} ({e})")
+    return cohort
+
+
+# ============================================================================
+# 8. СОЗДАНИЕ ЛОГОТИПА
 # ============================================================================
 
 def create_logo():
@@ -252,6 +1169,7 @@ def create_logo():
 
             try:
                 font_paths = [
+                    BUNDLED_BOLD_FONT,
                     "/Library/Fonts/Arial Bold.ttf",
                     "/System/Library/Fonts/Arial.ttf",
                     "/System/Library/Fonts/Supplemental/Arial Bold.ttf",
@@ -294,7 +1212,8 @@ def create_logo():
 
             draw.line([(size // 2 - 50, 190), (size // 2 + 50, 190)], fill='#2E86AB', width=2)
 
-            img.save(logo_path, 'PNG', quality=95)
+            with atomic_path(logo_path) as temp_path:
+                img.save(temp_path, 'PNG', quality=95)
             print(f"[SUCCESS] Логотип создан: {logo_path}")
 
         except Exception as e:
@@ -302,405 +1221,553 @@ def create_logo():
             img = PILImage.new('RGB', (100, 100), color=(46, 134, 171))
             draw = ImageDraw.Draw(img)
             draw.text((10, 40), "FSA", fill='white')
-            img.save(logo_path, 'PNG')
+            with atomic_path(logo_path) as temp_path:
+                img.save(temp_path, 'PNG')
 
     return logo_path
 
 
 # ============================================================================
-# 4. ИЗВЛЕЧЕНИЕ ДАННЫХ ИЗ PDF
+# 9. РАЗМЕРНЫЕ СЕТКИ ОБУВИ
 # ============================================================================
 
-def extract_data_from_pdf(pdf_path):
-    """Извлекает данные ТОЛЬКО из PDF файла с учетом структуры таблиц"""
-    print(f"\n{'=' * 60}")
-    print(f"📄 ИЗВЛЕЧЕНИЕ ДАННЫХ ИЗ: {os.path.basename(pdf_path)}")
-    print('=' * 60)
-
-    data = {
-        'client_name': '',
-        'foot_length': {'left': 0, 'right': 0},
-        'foot_width': {'left': 0, 'right': 0},
-        'ball_girth': {'left': 0, 'right': 0},
-        'arch_index': {'left': 0, 'right': 0},
-        'heel_angle': {'left': 0, 'right': 0},
-        'hallux_angle': {'left': 0, 'right': 0},
-        'shoe_size': {'left': 0, 'right': 0},
-        'shoe_width': '',
-        'toe_type': '',
-        'gender': '',
-        'scan_date': '',
-        'scanner_id': '',
-        'notes': '',
-        'age': '',
-        'shop_name': ''
+SIZE_MIN_MM = 100.0
+SIZE_MAX_MM = 350.0
+SIZE_STEP_MM = 0.5
+# Колодка длиннее стопы; при этом припуске EU совпадает с прежней формулой (L * 1.5 + 15.5) / 10
+LAST_ALLOWANCE_MM = 31 / 3
+SHOE_SIZE_SYSTEMS = (
+    ('eu', 'EU'),
+    ('uk', 'UK'),
+    ('us_m', 'US (муж.)'),
+    ('us_w', 'US (жен.)'),
+    ('mondopoint', 'Mondopoint'),
+    ('cn', 'CN'),
+)
+WIDTH_LETTERS = ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H')
+# Границы полнот как доля ширины от длины стопы (ориентировочно, между соседними буквами)
+WIDTH_RATIOS = (0.355, 0.37, 0.385, 0.40, 0.415, 0.43, 0.445)
+
+
+def _build_shoe_size_tables():
+    """Таблицы систем, кроме EU, по длине стопы с шагом SIZE_STEP_MM"""
+    lengths = np.arange(SIZE_MIN_MM, SIZE_MAX_MM + SIZE_STEP_MM / 2, SIZE_STEP_MM)
+    last_inches = (lengths + LAST_ALLOWANCE_MM) / 25.4
+    uk_adult = 3 * last_inches - 25
+    child = uk_adult < 1
+    # Детская шкала UK/US начинается от 12 барликорнов
+    uk = np.where(child, 3 * last_inches - 12, uk_adult)
+    tables = {
+        'uk': np.round(uk * 2) / 2,
+        'us_m': np.round(np.where(child, uk + 0.5, uk + 1) * 2) / 2,
+        'us_w': np.round(np.where(child, uk + 0.5, uk + 2) * 2) / 2,
+        'mondopoint': np.round(lengths),
+        'cn': np.round(lengths / 5) * 5,
+        'child': child,
     }
+    width_thresholds = lengths[:, None] * np.array(WIDTH_RATIOS)[None, :]
+    return tables, width_thresholds
 
-    if not pdf_path or not os.path.exists(pdf_path):
-        print("[ERROR] Файл PDF не найден!")
-        return data
 
-    try:
-        # Чтение PDF
-        with open(pdf_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            print(f"[INFO] PDF содержит {len(reader.pages)} страниц")
-
-            all_text = ""
-            for page_num, page in enumerate(reader.pages, 1):
-                text = page.extract_text()
-                text = re.sub(r'\s+', ' ', text)
-                all_text += text + "\n"
-
-        # Сохраняем для отладки
-        debug_dir = "extracted_data_debug"
-        if not os.path.exists(debug_dir):
-            os.makedirs(debug_dir)
-
-        safe_filename = os.path.basename(pdf_path).replace('.pdf', '')
-        debug_path = os.path.join(debug_dir, f"{safe_filename}_extracted.txt")
-        with open(debug_path, 'w', encoding='utf-8') as f:
-            f.write("=" * 80 + "\n")
-            f.write(f"ДЕБАГ ИЗВЛЕЧЕНИЯ: {pdf_path}\n")
-            f.write("=" * 80 + "\n\n")
-            f.write(all_text)
-
-        print(f"[DEBUG] Текст сохранен в: {debug_path}")
-
-        # ========== ИЗВЛЕЧЕНИЕ ИМЕНИ ==========
-        print("\n[INFO] Поиск имени пациента...")
-
-        lines = all_text.split('\n')
-
-        # Стратегия 1: Ищем заголовок с #
-        for line in lines[:20]:
+SHOE_SIZE_TABLES, WIDTH_THRESHOLDS = _build_shoe_size_tables()
+
+
+def _eu_size(foot_lengths):
+    """EU по прежней формуле от точной длины: на сетке таблиц размер у границ сдвигался бы на полразмера"""
+    return np.round((np.asarray(foot_lengths, dtype=float) * 1.5 + 15.5) / 10 * 2) / 2
+
+
+def _size_index(foot_lengths):
+    return np.clip(np.rint((np.asarray(foot_lengths, dtype=float) - SIZE_MIN_MM) / SIZE_STEP_MM),
+                   0, len(WIDTH_THRESHOLDS) - 1).astype(int)
+
+
+def convert_shoe_sizes(foot_lengths, foot_widths=None):
+    """Векторный пересчет для архивов: {система: массив}, плюс 'child' и 'width' (буквы полноты)
+
+    Нулевая длина (нет данных) дает NaN во всех системах.
+    """
+    foot_lengths = np.asarray(foot_lengths, dtype=float)
+    index = _size_index(foot_lengths)
+    missing = foot_lengths <= 0
+    sizes = {system: np.where(missing, np.nan,
+                              _eu_size(foot_lengths) if system == 'eu' else SHOE_SIZE_TABLES[system][index])
+             for system, _ in SHOE_SIZE_SYSTEMS}
+    sizes['child'] = SHOE_SIZE_TABLES['child'][index] & ~missing
+    if foot_widths is not None:
+        foot_widths = np.asarray(foot_widths, dtype=float)
+        grades = (foot_widths[..., None] >= WIDTH_THRESHOLDS[index]).sum(axis=-1)
+        sizes['width'] = np.where(missing | (foot_widths <= 0), '', np.array(WIDTH_LETTERS)[grades])
+    return sizes
+
+
+def convert_shoe_size(foot_length_mm, foot_width_mm=0):
+    """Размеры одной стопы во всех системах; None, если длина неизвестна"""
+    if foot_length_mm <= 0:
+        return None
+    index = int(_size_index(foot_length_mm))
+    sizes = {system: float(_eu_size(foot_length_mm) if system == 'eu' else SHOE_SIZE_TABLES[system][index])
+             for system, _ in SHOE_SIZE_SYSTEMS}
+    sizes['child'] = bool(SHOE_SIZE_TABLES['child'][index])
+    sizes['width'] = (WIDTH_LETTERS[int(np.searchsorted(WIDTH_THRESHOLDS[index], foot_width_mm, side='right'))]
+                      if foot_width_mm > 0 else '')
+    return sizes
+
+
+def shoe_size_source(data):
+    """Откуда размер EU в строке параметров: поле сканера или пересчет по длине стопы"""
+    derived = [(convert_shoe_size(length) or {}).get('eu', 0) for length in data.foot_length]
+    return 'По длине стопы' if list(data.shoe_size) == derived else 'По данным сканера'
+
+
+def format_shoe_size(system, value, child=False):
+    if value != value:
+        return '—'
+    if system in ('mondopoint', 'cn'):
+        return f"{value:.0f}"
+    text = f"{value:g}"
+    return f"{text} (дет.)" if child and system in ('uk', 'us_m', 'us_w') else text
+
+
+# ============================================================================
+# 10. ИЗВЛЕЧЕНИЕ ДАННЫХ ИЗ PDF
+# ============================================================================
+
+class FootPair:
+    """Значения левой и правой стопы"""
+
+    __slots__ = ('left', 'right')
+
+    def __init__(self, left=0, right=0):
+        self.left = left
+        self.right = right
+
+    def __iter__(self):
+        yield self.left
+        yield self.right
+
+    def __eq__(self, other):
+        return isinstance(other, FootPair) and self.left == other.left and self.right == other.right
+
+    def __repr__(self):
+        return f"FootPair(left={self.left!r}, right={self.right!r})"
+
+    def to_dict(self):
+        return {'left': self.left, 'right': self.right}
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value.get('left', 0), value.get('right', 0))
+
+
+class FootScanRecord:
+    """Данные одного сканирования: парные измерения стоп и сведения о клиенте"""
+
+    PAIR_FIELDS = ('foot_length', 'foot_width', 'ball_girth', 'arch_index',
+                   'heel_angle', 'hallux_angle', 'shoe_size')
+    TEXT_FIELDS = ('client_name', 'shoe_width', 'toe_type', 'gender', 'scan_date',
+                   'scanner_id', 'notes', 'age', 'shop_name')
+    # Порядок ключей совпадает с прежним словарем данных (JSON, отладочный журнал)
+    FIELDS = ('client_name',) + PAIR_FIELDS + TEXT_FIELDS[1:]
+    # Плоская строка: текстовые поля, затем пары как <поле>_left, <поле>_right
+    ROW_FIELDS = TEXT_FIELDS + tuple(f"{name}_{side}" for name in PAIR_FIELDS for side in ('left', 'right'))
+
+    __slots__ = FIELDS
+
+    def __init__(self, **values):
+        for name in self.PAIR_FIELDS:
+            setattr(self, name, values.get(name) or FootPair())
+        for name in self.TEXT_FIELDS:
+            setattr(self, name, values.get(name, ''))
+
+    def __eq__(self, other):
+        return isinstance(other, FootScanRecord) and self.to_row() == other.to_row()
+
+    def __repr__(self):
+        return f"FootScanRecord(client_name={self.client_name!r}, scanner_id={self.scanner_id!r})"
+
+    def to_dict(self):
+        """Вложенный словарь в прежнем формате данных"""
+        return {name: value.to_dict() if isinstance(value, FootPair) else value
+                for name, value in ((name, getattr(self, name)) for name in self.FIELDS)}
+
+    @classmethod
+    def from_dict(cls, data):
+        values = {name: FootPair.from_dict(data[name]) for name in cls.PAIR_FIELDS if name in data}
+        values.update((name, data[name]) for name in cls.TEXT_FIELDS if name in data)
+        return cls(**values)
+
+    def to_row(self):
+        """Кортеж значений в порядке ROW_FIELDS"""
+        row = [getattr(self, name) for name in self.TEXT_FIELDS]
+        for name in self.PAIR_FIELDS:
+            row.extend(getattr(self, name))
+        return tuple(row)
+
+    @classmethod
+    def from_row(cls, row):
+        text_count = len(cls.TEXT_FIELDS)
+        values = dict(zip(cls.TEXT_FIELDS, row[:text_count]))
+        pairs = row[text_count:]
+        for i, name in enumerate(cls.PAIR_FIELDS):
+            values[name] = FootPair(pairs[2 * i], pairs[2 * i + 1])
+        return cls(**values)
+
+
+def read_pdf_text(pdf_path):
+    """Читает текст всех страниц PDF (по строке на страницу)"""
+    with open(pdf_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        print(f"[INFO] PDF содержит {len(reader.pages)} страниц")
+
+        page_texts = [re.sub(r'\s+', ' ', page.extract_text()) + "\n" for page in reader.pages]
+
+        # Страницы держат ссылки на reader — освобождаем сразу после чтения
+        reader = None
+
+    return "".join(page_texts)
+
+
+def parse_scan_text(all_text, pdf_path, data):
+    """Разбирает текст скана и заполняет словарь данных"""
+    # ========== ИЗВЛЕЧЕНИЕ ИМЕНИ ==========
+    print("\n[INFO] Поиск имени пациента...")
+
+    lines = all_text.split('\n')
+
+    # Стратегия 1: Ищем заголовок с #
+    for line in lines[:20]:
+        clean_line = line.strip()
+        if clean_line.startswith('# ') and len(clean_line) > 2:
+            name = clean_line[2:].strip()
+            if (len(name) > 2 and
+                    not any(keyword in name.lower() for keyword in
+                            ['snapshot', 'foot', 'length', 'width', 'scan', 'report', 'page']) and
+                    re.search(r'[а-яА-ЯёЁa-zA-Z]{2,}', name)):
+                data.client_name = name
+                print(f"[FOUND] Имя из заголовка: {data.client_name}")
+                break
+
+    # Стратегия 2: Ищем имя в первых строках
+    if not data.client_name:
+        for line in lines[:10]:
             clean_line = line.strip()
-            if clean_line.startswith('# ') and len(clean_line) > 2:
-                name = clean_line[2:].strip()
-                if (len(name) > 2 and
-                        not any(keyword in name.lower() for keyword in
-                                ['snapshot', 'foot', 'length', 'width', 'scan', 'report', 'page']) and
-                        re.search(r'[а-яА-ЯёЁa-zA-Z]{2,}', name)):
-                    data['client_name'] = name
-                    print(f"[FOUND] Имя из заголовка: {data['client_name']}")
+            if (len(clean_line) > 2 and
+                    not re.match(r'^\W*$', clean_line) and  # Не только символы
+                    not re.match(r'^\d+\.?\d*$', clean_line) and  # Не число
+                    not any(term in clean_line.lower() for term in
+                            ['left', 'right', 'foot', 'length', 'width', 'girth', 'snapshot',
+                             'scan', 'date', 'scanner', 'gender', 'male', 'female']) and
+                    re.search(r'[а-яА-ЯёЁa-zA-Z]{2,}', clean_line)):
+
+                # Проверяем, что это не тип стопы
+                if not any(toe_type in clean_line.lower() for toe_type in
+                           ['египетский', 'римский', 'греческий', 'квадратный',
+                            'egyptian', 'roman', 'greek', 'square']):
+                    data.client_name = clean_line
+                    print(f"[FOUND] Имя из текста: {data.client_name}")
                     break
 
-        # Стратегия 2: Ищем имя в первых строках
-        if not data['client_name']:
-            for line in lines[:10]:
-                clean_line = line.strip()
-                if (len(clean_line) > 2 and
-                        not re.match(r'^\W*$', clean_line) and  # Не только символы
-                        not re.match(r'^\d+\.?\d*$', clean_line) and  # Не число
-                        not any(term in clean_line.lower() for term in
-                                ['left', 'right', 'foot', 'length', 'width', 'girth', 'snapshot',
-                                 'scan', 'date', 'scanner', 'gender', 'male', 'female']) and
-                        re.search(r'[а-яА-ЯёЁa-zA-Z]{2,}', clean_line)):
-
-                    # Проверяем, что это не тип стопы
-                    if not any(toe_type in clean_line.lower() for toe_type in
-                               ['египетский', 'римский', 'греческий', 'квадратный',
-                                'egyptian', 'roman', 'greek', 'square']):
-                        data['client_name'] = clean_line
-                        print(f"[FOUND] Имя из текста: {data['client_name']}")
-                        break
-
-        # Стратегия 3: Из имени файла
-        if not data['client_name']:
-            file_name = os.path.basename(pdf_path)
-            name = file_name.replace('_Report.pdf', '').replace('.pdf', '')
-            name = re.sub(r'_\d+_\d+', '', name)
-            name = name.replace('_', ' ').strip()
-
-            if name and re.search(r'[а-яА-ЯёЁa-zA-Z]{2,}', name):
-                data['client_name'] = name
-                print(f"[FOUND] Имя из файла: {data['client_name']}")
-
-        # ========== ИЗВЛЕЧЕНИЕ ВСЕХ ЧИСЕЛ ==========
-        print("\n[INFO] Извлечение всех числовых данных...")
-
-        # Находим ВСЕ числа с плавающей точкой
-        all_floats = re.findall(r'\d+\.\d+', all_text)
-        all_ints = re.findall(r'\b\d+\b', all_text)
-
-        print(f"[INFO] Найдено чисел с точкой: {len(all_floats)}")
-        print(f"[INFO] Найдено целых чисел: {len(all_ints)}")
-
-        # Выводим первые 20 чисел для анализа
-        if all_floats:
-            print(f"[DEBUG] Первые 20 чисел с точкой: {all_floats[:20]}")
-
-        # ========== АВТОМАТИЧЕСКИЙ АНАЛИЗ ЧИСЕЛ ==========
-        print("\n[INFO] Автоматический анализ числовых данных...")
-
-        # 1. ДЛИНА СТОПЫ - самые большие числа (230-300)
-        foot_length_candidates = []
-        for num in all_floats:
-            val = float(num)
-            if 230 <= val <= 300:
-                foot_length_candidates.append(val)
-
-        if len(foot_length_candidates) >= 2:
-            data['foot_length']['left'] = foot_length_candidates[0]
-            data['foot_length']['right'] = foot_length_candidates[1]
-            print(f"[FOUND] Длина стопы: Л={foot_length_candidates[0]}, П={foot_length_candidates[1]}")
-        elif len(foot_length_candidates) == 1:
-            data['foot_length']['left'] = foot_length_candidates[0]
-            data['foot_length']['right'] = foot_length_candidates[0] + 1.0
-            print(f"[FOUND] Длина стопы (одно значение): {foot_length_candidates[0]}")
-
-        # 2. ШИРИНА СТОПЫ - средние числа (80-120)
-        foot_width_candidates = []
-        for num in all_floats:
-            val = float(num)
-            if 80 <= val <= 120:
-                foot_width_candidates.append(val)
-
-        if len(foot_width_candidates) >= 2:
-            data['foot_width']['left'] = foot_width_candidates[0]
-            data['foot_width']['right'] = foot_width_candidates[1]
-            print(f"[FOUND] Ширина стопы: Л={foot_width_candidates[0]}, П={foot_width_candidates[1]}")
-
-        # 3. ОБХВАТ ПЛЮСНЫ - средние числа (220-270)
-        ball_girth_candidates = []
-        for num in all_floats:
-            val = float(num)
-            if 220 <= val <= 270:
-                ball_girth_candidates.append(val)
-
-        if len(ball_girth_candidates) >= 2:
-            data['ball_girth']['left'] = ball_girth_candidates[0]
-            data['ball_girth']['right'] = ball_girth_candidates[1]
-            print(f"[FOUND] Обхват плюсны: Л={ball_girth_candidates[0]}, П={ball_girth_candidates[1]}")
-
-        # 4. ИНДЕКС СВОДА - маленькие числа (0.2-0.4)
-        arch_index_candidates = []
-        for num in all_floats:
-            val = float(num)
-            if 0.2 <= val <= 0.4:
-                arch_index_candidates.append(val)
-
-        if len(arch_index_candidates) >= 2:
-            data['arch_index']['left'] = arch_index_candidates[0]
-            data['arch_index']['right'] = arch_index_candidates[1]
-            print(f"[FOUND] Индекс свода: Л={arch_index_candidates[0]}, П={arch_index_candidates[1]}")
-
-        # 5. УГОЛЬ ПЯТКИ - маленькие целые числа (0-10)
-        heel_angle_candidates = []
-        for num in all_ints:
-            val = int(num)
-            if 0 <= val <= 10:
-                heel_angle_candidates.append(val)
-
-        if len(heel_angle_candidates) >= 2:
-            data['heel_angle']['left'] = heel_angle_candidates[0]
-            data['heel_angle']['right'] = heel_angle_candidates[1]
-            print(f"[FOUND] Угол пятки: Л={heel_angle_candidates[0]}, П={heel_angle_candidates[1]}")
-
-        # 6. УГОЛЬ БОЛЬШОГО ПАЛЬЦА - маленькие-средние числа (0-30)
-        hallux_angle_candidates = []
-        for num in all_floats:
-            val = float(num)
-            if 0 <= val <= 30:
-                hallux_angle_candidates.append(val)
-
-        if len(hallux_angle_candidates) >= 2:
-            data['hallux_angle']['left'] = hallux_angle_candidates[0]
-            data['hallux_angle']['right'] = hallux_angle_candidates[1]
-            print(f"[FOUND] Угол большого пальца: Л={hallux_angle_candidates[0]}, П={hallux_angle_candidates[1]}")
-
-        # 7. РАЗМЕР ОБУВИ - расчет на основе длины
-        def calculate_shoe_size(foot_length_mm):
-            if foot_length_mm <= 0:
-                return 0
-            # Формула: EU size = (foot_length_mm * 1.5 + 15.5) / 10
-            eu_size = (foot_length_mm * 1.5 + 15.5) / 10
-            # Округляем до 0.5
-            eu_size = round(eu_size * 2) / 2
-            return eu_size
-
-        if data['foot_length']['left'] > 0:
-            data['shoe_size']['left'] = calculate_shoe_size(data['foot_length']['left'])
-
-        if data['foot_length']['right'] > 0:
-            data['shoe_size']['right'] = calculate_shoe_size(data['foot_length']['right'])
-
-        # Также ищем размер обуви в тексте (35-50)
-        shoe_size_candidates = []
-        for num in all_floats + all_ints:
-            try:
-                val = float(num)
-                if 35 <= val <= 50:
-                    shoe_size_candidates.append(val)
-            except:
-                continue
-
-        if shoe_size_candidates:
-            data['shoe_size']['left'] = shoe_size_candidates[0]
-            data['shoe_size']['right'] = shoe_size_candidates[0]
-            print(f"[FOUND] Размер обуви в тексте: {shoe_size_candidates[0]}")
-
-        # ========== ТЕКСТОВЫЕ ДАННЫЕ ==========
-        print("\n[INFO] Извлечение текстовых данных...")
-
-        # Ширина обуви
-        width_match = re.search(r'Shoe Width.*?([A-G])', all_text, re.IGNORECASE)
-        if width_match:
-            data['shoe_width'] = width_match.group(1)
-            print(f"[FOUND] Ширина обуви: {data['shoe_width']}")
-
-        # Тип стопы
-        if 'Egyptian' in all_text:
-            data['toe_type'] = 'Египетский'
-        elif 'Roman' in all_text:
-            data['toe_type'] = 'Римский'
-        elif 'Greek' in all_text:
-            data['toe_type'] = 'Греческий'
-        elif 'Square' in all_text:
-            data['toe_type'] = 'Квадратный'
-
-        if data['toe_type']:
-            print(f"[FOUND] Тип стопы: {data['toe_type']}")
-
-        # Пол
-        if 'Male' in all_text or 'мужской' in all_text.lower():
-            data['gender'] = 'Мужской'
-        elif 'Female' in all_text or 'женский' in all_text.lower():
-            data['gender'] = 'Женский'
-
-        if data['gender']:
-            print(f"[FOUND] Пол: {data['gender']}")
-
-        # Дата сканирования
-        date_match = re.search(r'Scan date\s*(\d{4}/\d{2}/\d{2})', all_text)
+    # Стратегия 3: Из имени файла
+    if not data.client_name:
+        file_name = os.path.basename(pdf_path)
+        name = file_name.replace('_Report.pdf', '').replace('.pdf', '')
+        name = re.sub(r'_\d+_\d+', '', name)
+        name = name.replace('_', ' ').strip()
+
+        if name and re.search(r'[а-яА-ЯёЁa-zA-Z]{2,}', name):
+            data.client_name = name
+            print(f"[FOUND] Имя из файла: {data.client_name}")
+
+    # ========== ИЗВЛЕЧЕНИЕ ВСЕХ ЧИСЕЛ ==========
+    print("\n[INFO] Извлечение всех числовых данных...")
+
+    # Находим ВСЕ числа с плавающей точкой
+    all_floats = re.findall(r'\d+\.\d+', all_text)
+    all_ints = re.findall(r'\b\d+\b', all_text)
+
+    print(f"[INFO] Найдено чисел с точкой: {len(all_floats)}")
+    print(f"[INFO] Найдено целых чисел: {len(all_ints)}")
+
+    # Выводим первые 20 чисел для анализа
+    if all_floats:
+        print(f"[DEBUG] Первые 20 чисел с точкой: {all_floats[:20]}")
+
+    # ========== АВТОМАТИЧЕСКИЙ АНАЛИЗ ЧИСЕЛ ==========
+    print("\n[INFO] Автоматический анализ числовых данных...")
+
+    # 1. ДЛИНА СТОПЫ - самые большие числа (230-300)
+    foot_length_candidates = []
+    for num in all_floats:
+        val = float(num)
+        if 230 <= val <= 300:
+            foot_length_candidates.append(val)
+
+    if len(foot_length_candidates) >= 2:
+        data.foot_length.left = foot_length_candidates[0]
+        data.foot_length.right = foot_length_candidates[1]
+        print(f"[FOUND] Длина стопы: Л={foot_length_candidates[0]}, П={foot_length_candidates[1]}")
+    elif len(foot_length_candidates) == 1:
+        data.foot_length.left = foot_length_candidates[0]
+        data.foot_length.right = foot_length_candidates[0] + 1.0
+        print(f"[FOUND] Длина стопы (одно значение): {foot_length_candidates[0]}")
+
+    # 2. ШИРИНА СТОПЫ - средние числа (80-120)
+    foot_width_candidates = []
+    for num in all_floats:
+        val = float(num)
+        if 80 <= val <= 120:
+            foot_width_candidates.append(val)
+
+    if len(foot_width_candidates) >= 2:
+        data.foot_width.left = foot_width_candidates[0]
+        data.foot_width.right = foot_width_candidates[1]
+        print(f"[FOUND] Ширина стопы: Л={foot_width_candidates[0]}, П={foot_width_candidates[1]}")
+
+    # 3. ОБХВАТ ПЛЮСНЫ - средние числа (220-270)
+    ball_girth_candidates = []
+    for num in all_floats:
+        val = float(num)
+        if 220 <= val <= 270:
+            ball_girth_candidates.append(val)
+
+    if len(ball_girth_candidates) >= 2:
+        data.ball_girth.left = ball_girth_candidates[0]
+        data.ball_girth.right = ball_girth_candidates[1]
+        print(f"[FOUND] Обхват плюсны: Л={ball_girth_candidates[0]}, П={ball_girth_candidates[1]}")
+
+    # 4. ИНДЕКС СВОДА - маленькие числа (0.2-0.4)
+    arch_index_candidates = []
+    for num in all_floats:
+        val = float(num)
+        if 0.2 <= val <= 0.4:
+            arch_index_candidates.append(val)
+
+    if len(arch_index_candidates) >= 2:
+        data.arch_index.left = arch_index_candidates[0]
+        data.arch_index.right = arch_index_candidates[1]
+        print(f"[FOUND] Индекс свода: Л={arch_index_candidates[0]}, П={arch_index_candidates[1]}")
+
+    # 5. УГОЛЬ ПЯТКИ - маленькие целые числа (0-10)
+    heel_angle_candidates = []
+    for num in all_ints:
+        val = int(num)
+        if 0 <= val <= 10:
+            heel_angle_candidates.append(val)
+
+    if len(heel_angle_candidates) >= 2:
+        data.heel_angle.left = heel_angle_candidates[0]
+        data.heel_angle.right = heel_angle_candidates[1]
+        print(f"[FOUND] Угол пятки: Л={heel_angle_candidates[0]}, П={heel_angle_candidates[1]}")
+
+    # 6. УГОЛЬ БОЛЬШОГО ПАЛЬЦА - маленькие-средние числа (0-30)
+    hallux_angle_candidates = []
+    for num in all_floats:
+        val = float(num)
+        if 0 <= val <= 30:
+            hallux_angle_candidates.append(val)
+
+    if len(hallux_angle_candidates) >= 2:
+        data.hallux_angle.left = hallux_angle_candidates[0]
+        data.hallux_angle.right = hallux_angle_candidates[1]
+        print(f"[FOUND] Угол большого пальца: Л={hallux_angle_candidates[0]}, П={hallux_angle_candidates[1]}")
+
+    # 7. РАЗМЕР ОБУВИ - поле сканера "(EU) Л П", иначе по длине стопы
+    shoe_size_match = re.search(r'\(EU\)\s*(\d{2}(?:\.\d)?)\s+(\d{2}(?:\.\d)?)', all_text)
+    if shoe_size_match:
+        data.shoe_size.left = float(shoe_size_match.group(1))
+        data.shoe_size.right = float(shoe_size_match.group(2))
+        print(f"[FOUND] Размер обуви в тексте: Л={data.shoe_size.left}, П={data.shoe_size.right}")
+    else:
+        for side in ('left', 'right'):
+            sizes = convert_shoe_size(getattr(data.foot_length, side))
+            if sizes:
+                setattr(data.shoe_size, side, sizes['eu'])
+
+    # ========== ТЕКСТОВЫЕ ДАННЫЕ ==========
+    print("\n[INFO] Извлечение текстовых данных...")
+
+    # Ширина обуви
+    width_match = re.search(r'Shoe Width.*?([A-G])', all_text, re.IGNORECASE)
+    if width_match:
+        data.shoe_width = width_match.group(1)
+        print(f"[FOUND] Ширина обуви: {data.shoe_width}")
+
+    # Тип стопы
+    if 'Egyptian' in all_text:
+        data.toe_type = 'Египетский'
+    elif 'Roman' in all_text:
+        data.toe_type = 'Римский'
+    elif 'Greek' in all_text:
+        data.toe_type = 'Греческий'
+    elif 'Square' in all_text:
+        data.toe_type = 'Квадратный'
+
+    if data.toe_type:
+        print(f"[FOUND] Тип стопы: {data.toe_type}")
+
+    # Пол
+    if 'Male' in all_text or 'мужской' in all_text.lower():
+        data.gender = 'Мужской'
+    elif 'Female' in all_text or 'женский' in all_text.lower():
+        data.gender = 'Женский'
+
+    if data.gender:
+        print(f"[FOUND] Пол: {data.gender}")
+
+    # Дата сканирования
+    date_match = re.search(r'Scan date\s*(\d{4}/\d{2}/\d{2})', all_text)
+    if date_match:
+        try:
+            date_obj = datetime.strptime(date_match.group(1), '%Y/%m/%d')
+            data.scan_date = date_obj.strftime('%d.%m.%Y')
+            print(f"[FOUND] Дата сканирования: {data.scan_date}")
+        except:
+            data.scan_date = date_match.group(1)
+    else:
+        # Ищем любую дату
+        date_match = re.search(r'(\d{4}/\d{2}/\d{2})', all_text)
         if date_match:
-            try:
-                date_obj = datetime.strptime(date_match.group(1), '%Y/%m/%d')
-                data['scan_date'] = date_obj.strftime('%d.%m.%Y')
-                print(f"[FOUND] Дата сканирования: {data['scan_date']}")
-            except:
-                data['scan_date'] = date_match.group(1)
-        else:
-            # Ищем любую дату
-            date_match = re.search(r'(\d{4}/\d{2}/\d{2})', all_text)
-            if date_match:
-                data['scan_date'] = date_match.group(1)
+            data.scan_date = date_match.group(1)
 
-        # ID сканера
-        scanner_match = re.search(r'Scanner No\s*(\d+_\d+)', all_text)
+    # ID сканера
+    scanner_match = re.search(r'Scanner No\s*(\d+_\d+)', all_text)
+    if scanner_match:
+        data.scanner_id = scanner_match.group(1)
+        print(f"[FOUND] ID сканера: {data.scanner_id}")
+    else:
+        # Из имени файла
+        file_base = os.path.basename(pdf_path)
+        scanner_match = re.search(r'_(\d+_\d+)_', file_base)
         if scanner_match:
-            data['scanner_id'] = scanner_match.group(1)
-            print(f"[FOUND] ID сканера: {data['scanner_id']}")
-        else:
-            # Из имени файла
-            file_base = os.path.basename(pdf_path)
-            scanner_match = re.search(r'_(\d+_\d+)_', file_base)
-            if scanner_match:
-                data['scanner_id'] = scanner_match.group(1)
+            data.scanner_id = scanner_match.group(1)
 
-        # ========== РУЧНОЙ ПОИСК ПО ПАТТЕРНАМ (если автоматический не сработал) ==========
-        print(f"\n{'=' * 60}")
-        print("📊 ПРОВЕРКА И КОРРЕКЦИЯ ДАННЫХ:")
-        print('=' * 60)
+    # ========== РУЧНОЙ ПОИСК ПО ПАТТЕРНАМ (если автоматический не сработал) ==========
+    print(f"\n{'=' * 60}")
+    print("📊 ПРОВЕРКА И КОРРЕКЦИЯ ДАННЫХ:")
+    print('=' * 60)
 
-        # Если данных недостаточно, используем эвристику
-        if data['foot_length']['left'] == 0:
-            print("[WARNING] Длина стопы не найдена автоматически!")
+    # Если данных недостаточно, используем эвристику
+    if data.foot_length.left == 0:
+        print("[WARNING] Длина стопы не найдена автоматически!")
 
-            try:
-                with open(debug_path, 'r', encoding='utf-8') as f:
-                    debug_content = f.read()
-
-                # Ищем конкретные паттерны
-                # Паттерн: "Foot Length (mm) 271.7 273.8"
-                foot_pattern = r'Foot Length.*?\(mm\).*?(\d+\.\d+).*?(\d+\.\d+)'
-                foot_match = re.search(foot_pattern, debug_content, re.IGNORECASE)
-                if foot_match:
-                    data['foot_length']['left'] = float(foot_match.group(1))
-                    data['foot_length']['right'] = float(foot_match.group(2))
-                    print(
-                        f"[FOUND] Длина стопы (паттерн): Л={data['foot_length']['left']}, П={data['foot_length']['right']}")
-
-                # Паттерн: "Foot Width (mm) 100.2 106.8"
-                width_pattern = r'Foot Width.*?\(mm\).*?(\d+\.\d+).*?(\d+\.\d+)'
-                width_match = re.search(width_pattern, debug_content, re.IGNORECASE)
-                if width_match:
-                    data['foot_width']['left'] = float(width_match.group(1))
-                    data['foot_width']['right'] = float(width_match.group(2))
-                    print(
-                        f"[FOUND] Ширина стопы (паттерн): Л={data['foot_width']['left']}, П={data['foot_width']['right']}")
-
-                # Паттерн: "Ball Girth (mm) 238.4 249.2"
-                ball_pattern = r'Ball Girth.*?\(mm\).*?(\d+\.\d+).*?(\d+\.\d+)'
-                ball_match = re.search(ball_pattern, debug_content, re.IGNORECASE)
-                if ball_match:
-                    data['ball_girth']['left'] = float(ball_match.group(1))
-                    data['ball_girth']['right'] = float(ball_match.group(2))
-                    print(
-                        f"[FOUND] Обхват плюсны (паттерн): Л={data['ball_girth']['left']}, П={data['ball_girth']['right']}")
-
-                # Паттерн: "Arch Index 0.27 0.37"
-                arch_pattern = r'Arch Index.*?(\d+\.\d+).*?(\d+\.\d+)'
-                arch_match = re.search(arch_pattern, debug_content, re.IGNORECASE)
-                if arch_match:
-                    data['arch_index']['left'] = float(arch_match.group(1))
-                    data['arch_index']['right'] = float(arch_match.group(2))
-                    print(
-                        f"[FOUND] Индекс свода (паттерн): Л={data['arch_index']['left']}, П={data['arch_index']['right']}")
-
-                # Паттерн: "Hallux Angle 10.4 16.0"
-                hallux_pattern = r'Hallux Angle.*?(\d+\.\d+).*?(\d+\.\d+)'
-                hallux_match = re.search(hallux_pattern, debug_content, re.IGNORECASE)
-                if hallux_match:
-                    data['hallux_angle']['left'] = float(hallux_match.group(1))
-                    data['hallux_angle']['right'] = float(hallux_match.group(2))
-                    print(
-                        f"[FOUND] Угол большого пальца (паттерн): Л={data['hallux_angle']['left']}, П={data['hallux_angle']['right']}")
-
-                # Паттерн: "Heel Angle 1 Inv 6 Eve" или "Heel Angle 1 6"
-                heel_pattern1 = r'Heel Angle.*?(\d+).*?Inv.*?(\d+).*?Eve'
-                heel_pattern2 = r'Heel Angle.*?(\d+).*?(\d+)'
-
-                heel_match = re.search(heel_pattern1, debug_content, re.IGNORECASE)
+        try:
+            debug_content = all_text
+
+            # Ищем конкретные паттерны
+            # Паттерн: "Foot Length (mm) 271.7 273.8"
+            foot_pattern = r'Foot Length.*?\(mm\).*?(\d+\.\d+).*?(\d+\.\d+)'
+            foot_match = re.search(foot_pattern, debug_content, re.IGNORECASE)
+            if foot_match:
+                data.foot_length.left = float(foot_match.group(1))
+                data.foot_length.right = float(foot_match.group(2))
+                print(
+                    f"[FOUND] Длина стопы (паттерн): Л={data.foot_length.left}, П={data.foot_length.right}")
+
+            # Паттерн: "Foot Width (mm) 100.2 106.8"
+            width_pattern = r'Foot Width.*?\(mm\).*?(\d+\.\d+).*?(\d+\.\d+)'
+            width_match = re.search(width_pattern, debug_content, re.IGNORECASE)
+            if width_match:
+                data.foot_width.left = float(width_match.group(1))
+                data.foot_width.right = float(width_match.group(2))
+                print(
+                    f"[FOUND] Ширина стопы (паттерн): Л={data.foot_width.left}, П={data.foot_width.right}")
+
+            # Паттерн: "Ball Girth (mm) 238.4 249.2"
+            ball_pattern = r'Ball Girth.*?\(mm\).*?(\d+\.\d+).*?(\d+\.\d+)'
+            ball_match = re.search(ball_pattern, debug_content, re.IGNORECASE)
+            if ball_match:
+                data.ball_girth.left = float(ball_match.group(1))
+                data.ball_girth.right = float(ball_match.group(2))
+                print(
+                    f"[FOUND] Обхват плюсны (паттерн): Л={data.ball_girth.left}, П={data.ball_girth.right}")
+
+            # Паттерн: "Arch Index 0.27 0.37"
+            arch_pattern = r'Arch Index.*?(\d+\.\d+).*?(\d+\.\d+)'
+            arch_match = re.search(arch_pattern, debug_content, re.IGNORECASE)
+            if arch_match:
+                data.arch_index.left = float(arch_match.group(1))
+                data.arch_index.right = float(arch_match.group(2))
+                print(
+                    f"[FOUND] Индекс свода (паттерн): Л={data.arch_index.left}, П={data.arch_index.right}")
+
+            # Паттерн: "Hallux Angle 10.4 16.0"
+            hallux_pattern = r'Hallux Angle.*?(\d+\.\d+).*?(\d+\.\d+)'
+            hallux_match = re.search(hallux_pattern, debug_content, re.IGNORECASE)
+            if hallux_match:
+                data.hallux_angle.left = float(hallux_match.group(1))
+                data.hallux_angle.right = float(hallux_match.group(2))
+                print(
+                    f"[FOUND] Угол большого пальца (паттерн): Л={data.hallux_angle.left}, П={data.hallux_angle.right}")
+
+            # Паттерн: "Heel Angle 1 Inv 6 Eve" или "Heel Angle 1 6"
+            heel_pattern1 = r'Heel Angle.*?(\d+).*?Inv.*?(\d+).*?Eve'
+            heel_pattern2 = r'Heel Angle.*?(\d+).*?(\d+)'
+
+            heel_match = re.search(heel_pattern1, debug_content, re.IGNORECASE)
+            if heel_match:
+                data.heel_angle.left = int(heel_match.group(1))
+                data.heel_angle.right = int(heel_match.group(2))
+            else:
+                heel_match = re.search(heel_pattern2, debug_content, re.IGNORECASE)
                 if heel_match:
-                    data['heel_angle']['left'] = int(heel_match.group(1))
-                    data['heel_angle']['right'] = int(heel_match.group(2))
-                else:
-                    heel_match = re.search(heel_pattern2, debug_content, re.IGNORECASE)
-                    if heel_match:
-                        data['heel_angle']['left'] = int(heel_match.group(1))
-                        data['heel_angle']['right'] = int(heel_match.group(2))
+                    data.heel_angle.left = int(heel_match.group(1))
+                    data.heel_angle.right = int(heel_match.group(2))
 
-                if data['heel_angle']['left'] > 0:
-                    print(
-                        f"[FOUND] Угол пятки (паттерн): Л={data['heel_angle']['left']}, П={data['heel_angle']['right']}")
+            if data.heel_angle.left > 0:
+                print(
+                    f"[FOUND] Угол пятки (паттерн): Л={data.heel_angle.left}, П={data.heel_angle.right}")
 
-            except Exception as e:
-                print(f"[ERROR] Ошибка при ручном анализе: {e}")
+        except Exception as e:
+            print(f"[ERROR] Ошибка при ручном анализе: {e}")
+
+    return data
+
+
+def extract_data_from_pdf(pdf_path, debug_record=None):
+    """Извлекает данные ТОЛЬКО из PDF файла с учетом структуры таблиц
+
+    В debug_record (если передан) сохраняется извлеченный текст для отладочного журнала.
+    """
+    print(f"\n{'=' * 60}")
+    print(f"📄 ИЗВЛЕЧЕНИЕ ДАННЫХ ИЗ: {os.path.basename(pdf_path)}")
+    print('=' * 60)
+
+    data = FootScanRecord()
+
+    if not pdf_path or not os.path.exists(pdf_path):
+        print("[ERROR] Файл PDF не найден!")
+        return data
+
+    try:
+        with pipeline_stage('extract.read'):
+            all_text = read_pdf_text(pdf_path)
+
+        if debug_record is not None:
+            debug_record['text'] = all_text
+
+        with pipeline_stage('extract.parse'):
+            parse_scan_text(all_text, pdf_path, data)
 
         # ========== ВЫВОД РЕЗУЛЬТАТОВ ==========
         print(f"\n{'=' * 60}")
         print("📊 ИТОГОВЫЕ ИЗВЛЕЧЕННЫЕ ДАННЫЕ:")
         print('=' * 60)
 
-        for key, value in data.items():
+        for key, value in data.to_dict().items():
             if isinstance(value, dict):
                 print(f"{key}: Л={value['left']}, П={value['right']}")
             else:
                 print(f"{key}: {value}")
 
-        # Сохраняем в JSON
-        json_path = os.path.join(debug_dir, f"{safe_filename}_data.json")
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        print(f"[DEBUG] Данные сохранены в JSON: {json_path}")
-
         # Проверяем, достаточно ли данных для генерации отчета
-        if data['foot_length']['left'] == 0:
+        if data.foot_length.left == 0:
             print(f"\n[ERROR] Не удалось извлечь основные данные!")
         else:
             print(f"\n[SUCCESS] Данные успешно извлечены!")
 
+    except MemoryError:
+        raise
     except Exception as e:
         print(f"[ERROR] Ошибка чтения PDF: {e}")
         import traceback
@@ -708,13 +1775,195 @@ def extract_data_from_pdf(pdf_path):
 
         # В случае ошибки - данные из имени файла
         file_name = os.path.basename(pdf_path)
-        data['client_name'] = file_name.replace('_Report.pdf', '').replace('_', ' ')
-        data['scan_date'] = datetime.now().strftime('%d.%m.%Y')
+        data.client_name = file_name.replace('_Report.pdf', '').replace('_', ' ')
+        data.scan_date = datetime.now().strftime('%d.%m.%Y')
 
     return data
 
+
+# Выгрузка сеанса сканера: много пациентов в одном PDF, по две страницы на пациента
+EXPORT_PAGE_ONE = re.compile(r'\bPage 1\b')
+EXPORT_SCANNER_NO = re.compile(r'Scanner No\s*(\d+_\d+)')
+# PdfReader хранит все разобранные объекты; сверх порога кэш сбрасывается
+READER_CACHE_LIMIT = 200
+
+
+def iter_pdf_pages(pdf_path):
+    """Текст страниц PDF по одной (по строке на страницу); файл не читается в память целиком"""
+    with open(pdf_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        for index in range(len(reader.pages)):
+            yield re.sub(r'\s+', ' ', reader.pages[index].extract_text()) + "\n"
+            # resolved_objects — внутренний атрибут PyPDF2; в других версиях его может не быть
+            cache = getattr(reader, 'resolved_objects', None)
+            if cache is not None and len(cache) > READER_CACHE_LIMIT:
+                cache.clear()
+
+
+def split_export_pages(page_texts):
+    """Группирует страницы выгрузки по пациентам: (первая страница, последняя, текст)
+
+    Пациент начинается со страницы с заголовком «Page 1» или со страницы, где
+    номер сканера отличается от номера текущего пациента. В памяти держатся
+    только страницы одного пациента.
+    """
+    pages, first, scanner_no = [], 1, None
+    for number, text in enumerate(page_texts, 1):
+        match = EXPORT_SCANNER_NO.search(text)
+        page_scanner_no = match.group(1) if match else None
+        if pages and (EXPORT_PAGE_ONE.search(text)
+                      or (page_scanner_no and scanner_no and page_scanner_no != scanner_no)):
+            yield first, number - 1, "".join(pages)
+            pages, scanner_no = [], None
+        if not pages:
+            first = number
+        pages.append(text)
+        scanner_no = scanner_no or page_scanner_no
+    if pages:
+        yield first, first + len(pages) - 1, "".join(pages)
+
+# ============================================================================
+# 11. СПРАВОЧНЫЕ НОРМЫ
+# ============================================================================
+
+NORMS_ENV = 'FOOTSCAN_NORMS_FILE'
+NORM_GENDERS = ('', 'Женский', 'Мужской')
+DEFAULT_AGE_BANDS = (0, 7, 12, 16, 18)
+DEFAULT_LENGTH_BANDS = (0, 200, 230, 260)
+DEFAULT_NORMS = {
+    'foot_length': (230, 260),
+    'foot_width': (90, 105),
+    'ball_girth': (230, 250),
+    'arch_index': (0.26, 0.29),
+    'heel_angle': (0, 4),
+    'hallux_angle': (0, 8),
+}
+_norm_tables = None
+
+
+class NormTable:
+    """Справочные нормы по полу, возрастной группе и группе длины стопы
+
+    Границы групп — отсортированные нижние пределы; группа находится бинарным
+    поиском. Нормы каждого параметра хранятся в двух плоских массивах
+    (нижняя и верхняя граница) по всем сочетаниям групп, поэтому поиск для
+    пациента — одно вычисление смещения. Без файла норм все группы получают
+    DEFAULT_NORMS.
+    """
+
+    def __init__(self, age_bands=DEFAULT_AGE_BANDS, length_bands=DEFAULT_LENGTH_BANDS, defaults=None):
+        self.age_bands = tuple(age_bands)
+        self.length_bands = tuple(length_bands)
+        size = len(NORM_GENDERS) * len(self.age_bands) * len(self.length_bands)
+        self.low = {}
+        self.high = {}
+        for param, (low, high) in (defaults or DEFAULT_NORMS).items():
+            self.low[param] = array('d', [low]) * size
+            self.high[param] = array('d', [high]) * size
+
+    @staticmethod
+    def _band(bands, value):
+        return max(0, bisect.bisect_right(bands, value) - 1)
+
+    def _bands_in(self, bands, value_range):
+        """Индексы групп, пересекающихся с [от, до): группа i — [bands[i], bands[i + 1])"""
+        if value_range is None:
+            return range(len(bands))
+        start, stop = value_range
+        uppers = bands[1:] + (math.inf,)
+        return [index for index, (lower, upper) in enumerate(zip(bands, uppers)) if lower < stop and upper > start]
+
+    def offset(self, gender_index, age_index, length_index):
+        return (gender_index * len(self.age_bands) + age_index) * len(self.length_bands) + length_index
+
+    def set(self, param, low, high, gender=None, age=None, foot_length=None):
+        """Задает норму для групп; None — все группы, age/foot_length — диапазон [от, до)"""
+        genders = range(len(NORM_GENDERS)) if gender is None else [NORM_GENDERS.index(gender)]
+        for gender_index in genders:
+            for age_index in self._bands_in(self.age_bands, age):
+                for length_index in self._bands_in(self.length_bands, foot_length):
+                    offset = self.offset(gender_index, age_index, length_index)
+                    self.low[param][offset] = low
+                    self.high[param][offset] = high
+
+    def lookup(self, data):
+        """Нормы пациента: {параметр: (нижняя, верхняя)}"""
+        gender = str(data.gender or '').strip()
+        gender_index = NORM_GENDERS.index(gender) if gender in NORM_GENDERS else 0
+        age_match = re.search(r'\d+', str(data.age or ''))
+        # Возраст не указан — нормы взрослых
+        age_index = (self._band(self.age_bands, int(age_match.group())) if age_match
+                     else len(self.age_bands) - 1)
+        length_index = self._band(self.length_bands, (data.foot_length.left + data.foot_length.right) / 2)
+        offset = self.offset(gender_index, age_index, length_index)
+        return {param: (self.low[param][offset], self.high[param][offset]) for param in self.low}
+
+    @classmethod
+    def load(cls, path):
+        """Файл норм JSON: {"age_bands": [...], "length_bands": [...],
+        "norms": [{"gender": ..., "age_range": [от, до], "length_range": [от, до], "<параметр>": [min, max]}]}
+
+        Правила применяются по порядку поверх DEFAULT_NORMS; не указанный
+        признак группы означает все группы. Ошибка в файле — ValueError с
+        номером правила: таблица загружается в каждом воркере, и молча
+        пропущенное правило дало бы отчеты с чужими нормами.
+        """
+        with open(path, encoding='utf-8') as f:
+            payload = json.load(f)
+        bands = {}
+        for key, default in (('age_bands', DEFAULT_AGE_BANDS), ('length_bands', DEFAULT_LENGTH_BANDS)):
+            bands[key] = payload.get(key, default)
+            if not (_numbers(bands[key]) and list(bands[key]) == sorted(set(bands[key]))):
+                raise ValueError(f"{path}: {key} — возрастающий список чисел")
+        table = cls(bands['age_bands'], bands['length_bands'])
+
+        genders = {gender.casefold(): gender for gender in NORM_GENDERS if gender}
+        for number, rule in enumerate(payload.get('norms', []), 1):
+            where = f"{path}, правило {number}"
+            gender = rule.get('gender')
+            if gender is not None:
+                gender = genders.get(str(gender).strip().casefold())
+                if gender is None:
+                    raise ValueError(f"{where}: пол {rule['gender']!r}, ожидается "
+                                     + " или ".join(repr(name) for name in genders.values()))
+            for key in ('age_range', 'length_range'):
+                value_range = rule.get(key)
+                if value_range is not None and not (_numbers(value_range, 2) and value_range[0] < value_range[1]):
+                    raise ValueError(f"{where}: {key} — [от, до], от < до")
+            for param in DEFAULT_NORMS:
+                if param in rule:
+                    if not (_numbers(rule[param], 2) and rule[param][0] <= rule[param][1]):
+                        raise ValueError(f"{where}: {param} — [min, max], min <= max")
+                    low, high = rule[param]
+                    table.set(param, low, high, gender=gender, age=rule.get('age_range'),
+                              foot_length=rule.get('length_range'))
+        return table
+
+
+def _numbers(values, count=None):
+    """Список чисел (заданной длины)"""
+    return (isinstance(values, (list, tuple)) and (count is None or len(values) == count)
+            and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values))
+
+
+def configure_norms(path):
+    """Задает файл норм для процесса и его воркеров; None — встроенные нормы"""
+    global _norm_tables
+    os.environ[NORMS_ENV] = os.path.abspath(path) if path else ''
+    _norm_tables = None
+
+
+def norm_tables():
+    """Таблица норм процесса; загружается один раз"""
+    global _norm_tables
+    if _norm_tables is None:
+        path = os.environ.get(NORMS_ENV)
+        _norm_tables = NormTable.load(path) if path else NormTable()
+    return _norm_tables
+
+
 # ============================================================================
-# 5. РАСЧЕТ РИСКОВ И РЕКОМЕНДАЦИЙ
+# 12. РАСЧЕТ РИСКОВ И РЕКОМЕНДАЦИЙ
 # ============================================================================
 
 def calculate_risk_scores(data):
@@ -732,15 +1981,16 @@ def calculate_risk_scores(data):
     }
 
     # Анализ индекса свода
-    avg_arch = (data['arch_index']['left'] + data['arch_index']['right']) / 2
+    avg_arch = (data.arch_index.left + data.arch_index.right) / 2
+    arch_low, arch_high = norm_tables().lookup(data)['arch_index']
     arch_status = ""
 
-    if avg_arch < 0.26:
+    if avg_arch < arch_low:
         scores['degenerative'] += 25
         scores['spinal'] += 20
         arch_status = "Высокий свод стопы (полая стопа)"
         print(f"  ⚠️ {arch_status}: {avg_arch:.3f}")
-    elif avg_arch > 0.29:
+    elif avg_arch > arch_high:
         scores['traumatic'] += 20
         scores['comfort'] += 15
         arch_status = "Низкий свод стопы (плоскостопие)"
@@ -750,7 +2000,7 @@ def calculate_risk_scores(data):
         print(f"  ✓ {arch_status}: {avg_arch:.3f}")
 
     # Асимметрия длины
-    length_diff = abs(data['foot_length']['left'] - data['foot_length']['right'])
+    length_diff = abs(data.foot_length.left - data.foot_length.right)
     if length_diff > 3:
         scores['spinal'] += 15
         scores['progression'] += 10
@@ -759,7 +2009,7 @@ def calculate_risk_scores(data):
         print(f"  ✓ Симметрия длины: {length_diff:.1f} мм")
 
     # Асимметрия ширины
-    width_diff = abs(data['foot_width']['left'] - data['foot_width']['right'])
+    width_diff = abs(data.foot_width.left - data.foot_width.right)
     if width_diff > 2:
         scores['comfort'] += 15
         print(f"  ⚠️ Асимметрия ширины: {width_diff:.1f} мм")
@@ -768,9 +2018,7 @@ def calculate_risk_scores(data):
 
     # Угол пятки
     heel_issues = []
-    for side in ['left', 'right']:
-        angle = data['heel_angle'][side]
-        side_name = 'Левая' if side == 'left' else 'Правая'
+    for side_name, angle in zip(('Левая', 'Правая'), data.heel_angle):
         if abs(angle) > 4:
             scores['traumatic'] += 10
             scores['comfort'] += 8
@@ -783,9 +2031,7 @@ def calculate_risk_scores(data):
 
     # Угол большого пальца
     hallux_issues = []
-    for side in ['left', 'right']:
-        angle = data['hallux_angle'][side]
-        side_name = 'Левая' if side == 'left' else 'Правая'
+    for side_name, angle in zip(('Левая', 'Правая'), data.hallux_angle):
         if angle > 15:
             scores['degenerative'] += 20
             scores['comfort'] += 15
@@ -849,15 +2095,15 @@ def generate_recommendations(data, risk_scores, arch_status):
         })
 
     # 2. Рекомендации по размеру и ширине
-    if data['shoe_width']:
+    if data.shoe_width:
         recommendations.append({
             "title": "📏 Ширина обуви",
-            "description": f"Ваш размер: {data['shoe_size']['left']} EU. Рекомендуемая ширина: {data['shoe_width']}.",
+            "description": f"Ваш размер: {data.shoe_size.left} EU. Рекомендуемая ширина: {data.shoe_width}.",
             "priority": "medium"
         })
 
     # 3. Рекомендации по углу пятки
-    if any(abs(angle) > 4 for angle in [data['heel_angle']['left'], data['heel_angle']['right']]):
+    if any(abs(angle) > 4 for angle in [data.heel_angle.left, data.heel_angle.right]):
         recommendations.append({
             "title": "🦶 Коррекция положения пятки",
             "description": "При отклонениях пятки рекомендуются упражнения на укрепление мышц голеностопа и индивидуальные ортопедические стельки с коррекцией заднего отдела.",
@@ -865,8 +2111,8 @@ def generate_recommendations(data, risk_scores, arch_status):
         })
 
     # 4. Рекомендации при вальгусной деформации
-    if any(angle > 8 for angle in [data['hallux_angle']['left'], data['hallux_angle']['right']]):
-        hallux_max = max(data['hallux_angle']['left'], data['hallux_angle']['right'])
+    if any(angle > 8 for angle in [data.hallux_angle.left, data.hallux_angle.right]):
+        hallux_max = max(data.hallux_angle.left, data.hallux_angle.right)
         severity = "выраженной" if hallux_max > 15 else "умеренной"
         recommendations.append({
             "title": "🦶 Профилактика Hallux Valgus",
@@ -875,8 +2121,8 @@ def generate_recommendations(data, risk_scores, arch_status):
         })
 
     # 5. Рекомендации по асимметрии
-    length_diff = abs(data['foot_length']['left'] - data['foot_length']['right'])
-    width_diff = abs(data['foot_width']['left'] - data['foot_width']['right'])
+    length_diff = abs(data.foot_length.left - data.foot_length.right)
+    width_diff = abs(data.foot_width.left - data.foot_width.right)
 
     if length_diff > 3 or width_diff > 2:
         recommendations.append({
@@ -894,7 +2140,7 @@ def generate_recommendations(data, risk_scores, arch_status):
 
     recommendations.append({
         "title": "🩺 Регулярное наблюдение",
-        "description": f"Повторное обследование через 6-12 месяцев. При появлении болей или дискомфорта - консультация врача-ортопеда. ID вашего скана: {data['scanner_id']}",
+        "description": f"Повторное обследование через 6-12 месяцев. При появлении болей или дискомфорта - консультация врача-ортопеда. ID вашего скана: {data.scanner_id}",
         "priority": "low"
     })
 
@@ -906,14 +2152,131 @@ def generate_recommendations(data, risk_scores, arch_status):
 
 
 # ============================================================================
-# 6. СОЗДАНИЕ ГРАФИКОВ
+# 13. ПРОФИЛИ ВЫВОДА
 # ============================================================================
 
-def create_radar_chart(risk_scores, output_path):
-    """Создает радарную диаграмму рисков"""
-    try:
+OUTPUT_PROFILE_ENV = 'FOOTSCAN_OUTPUT_PROFILE'
+DEFAULT_OUTPUT_PROFILE = 'archive'
+
+
+class OutputProfile:
+    """Размер и качество вывода: разрешение и формат графиков, сжатие PDF"""
+
+    __slots__ = ('name', 'chart_dpi', 'image_format', 'palette_colors', 'jpeg_quality',
+                 'page_compression', 'image_dpi')
+
+    def __init__(self, name, chart_dpi, image_format='png', palette_colors=0, jpeg_quality=85,
+                 page_compression=1, image_dpi=None):
+        self.name = name
+        self.chart_dpi = chart_dpi
+        self.image_format = image_format
+        self.palette_colors = palette_colors
+        self.jpeg_quality = jpeg_quality
+        self.page_compression = page_compression
+        # Предельное разрешение картинок на странице; крупнее — уменьшаются перед вставкой
+        self.image_dpi = image_dpi
+
+    @property
+    def chart_extension(self):
+        # По расширению .jpg reportlab встраивает JPEG без перекодирования
+        return '.jpg' if self.image_format == 'jpeg' else '.png'
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def encode(self, image, target):
+        """Сохраняет PIL-изображение в файл или буфер в формате профиля"""
+        if self.image_format == 'jpeg':
+            image.convert('RGB').save(target, 'JPEG', quality=self.jpeg_quality, optimize=True)
+        elif self.palette_colors:
+            image.convert('RGB').quantize(colors=self.palette_colors).save(target, 'PNG', optimize=True)
+        else:
+            image.save(target, 'PNG')
+
+    def save_figure(self, fig, output_path):
+        with atomic_path(output_path) as temp_path:
+            if self.image_format == 'png' and not self.palette_colors:
+                fig.savefig(temp_path, format='png', dpi=self.chart_dpi, bbox_inches='tight', facecolor='white')
+                return
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format='png', dpi=self.chart_dpi, bbox_inches='tight', facecolor='white')
+            buffer.seek(0)
+            with PILImage.open(buffer) as image:
+                self.encode(image, temp_path)
+
+    def image_source(self, path, width, height):
+        """Путь или уменьшенная копия в памяти для картинки размером width×height пунктов"""
+        if not self.image_dpi:
+            return path
+        max_size = (max(1, round(width / inch * self.image_dpi)), max(1, round(height / inch * self.image_dpi)))
+        with PILImage.open(path) as image:
+            if image.width <= max_size[0] and image.height <= max_size[1]:
+                return path
+            # Палитру уменьшаем в RGB: иначе PIL ресэмплирует по ближайшему соседу
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('RGBA', 'LA')
+                                  else 'RGB')
+            image.thumbnail(max_size, PILImage.LANCZOS)
+        buffer = io.BytesIO()
+        if image.mode == 'RGBA':
+            image.save(buffer, 'PNG')
+        else:
+            self.encode(image, buffer)
+        buffer.seek(0)
+        return buffer
+
+
+OUTPUT_PROFILES = {
+    # Рассылка по почте: минимальный размер
+    'screen': OutputProfile('screen', chart_dpi=100, palette_colors=64, image_dpi=110),
+    # Печать: графики с запасом по разрешению, без потерь
+    'print': OutputProfile('print', chart_dpi=300),
+    # Хранение: без потерь, как до появления профилей
+    'archive': OutputProfile('archive', chart_dpi=150),
+}
+
+_output_profile = None
+
+
+def configure_output_profile(name):
+    """Задает профиль вывода для процесса и его воркеров; None — профиль по умолчанию"""
+    global _output_profile
+    os.environ[OUTPUT_PROFILE_ENV] = name or DEFAULT_OUTPUT_PROFILE
+    _output_profile = None
+
+
+def output_profile():
+    """Профиль вывода процесса"""
+    global _output_profile
+    if _output_profile is None:
+        name = os.environ.get(OUTPUT_PROFILE_ENV) or DEFAULT_OUTPUT_PROFILE
+        _output_profile = OUTPUT_PROFILES.get(name, OUTPUT_PROFILES[DEFAULT_OUTPUT_PROFILE])
+    return _output_profile
+
+
+def profiled_inputs(inputs):
+    """Ключевые данные артефакта; профиль по умолчанию не меняет прежние ключи хранилища"""
+    profile = output_profile()
+    if profile.name == DEFAULT_OUTPUT_PROFILE:
+        return inputs
+    return {'inputs': inputs, 'profile': profile.to_dict()}
+
+
+# ============================================================================
+# 14. СОЗДАНИЕ ГРАФИКОВ
+# ============================================================================
+
+def create_figure(figsize, projection=None):
+    """Создает фигуру без глобального менеджера фигур pyplot"""
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot(projection=projection)
+
+
+def create_radar_chart(risk_scores, output_path):
+    """Создает радарную диаграмму рисков"""
+    try:
         plt.rcParams.update({
-            'font.family': 'Arial',
+            'font.family': register_chart_fonts(),
             'axes.unicode_minus': False,
             'figure.autolayout': True,
             'savefig.dpi': 150
@@ -932,7 +2295,7 @@ def create_radar_chart(risk_scores, output_path):
         angles += angles[:1]
         values += values[:1]
 
-        fig, ax = plt.subplots(figsize=(6, 6), subplot_kw=dict(projection='polar'))
+        fig, ax = create_figure((6, 6), projection='polar')
 
         ax.set_theta_offset(np.pi / 2)
         ax.set_theta_direction(-1)
@@ -959,10 +2322,9 @@ def create_radar_chart(risk_scores, output_path):
             ax.text(angle, value + 4, f'{value:.0f}',
                     ha='center', va='center', fontsize=7, fontweight='bold')
 
-        plt.title('Профиль биомеханических рисков', size=12, pad=20, fontweight='bold', color=PRIMARY_DARK_HEX)
-        plt.tight_layout()
-        plt.savefig(output_path, dpi=150, bbox_inches='tight', facecolor='white')
-        plt.close()
+        ax.set_title('Профиль биомеханических рисков', size=12, pad=20, fontweight='bold', color=PRIMARY_DARK_HEX)
+        fig.tight_layout()
+        output_profile().save_figure(fig, output_path)
 
         print(f"[GRAPH] Радарная диаграмма сохранена: {output_path}")
         return True
@@ -976,7 +2338,7 @@ def create_comparison_chart(data, output_path):
     """Создает сравнительную диаграмму параметров стоп"""
     try:
         plt.rcParams.update({
-            'font.family': 'Arial',
+            'font.family': register_chart_fonts(),
             'axes.unicode_minus': False,
             'figure.autolayout': True
         })
@@ -985,25 +2347,25 @@ def create_comparison_chart(data, output_path):
                       'Индекс\nсвода (×100)', 'Угол\nпятки, °', 'Угол\nпальца, °']
 
         left_values = [
-            data['foot_length']['left'],
-            data['foot_width']['left'],
-            data['arch_index']['left'] * 100,
-            data['heel_angle']['left'],
-            data['hallux_angle']['left']
+            data.foot_length.left,
+            data.foot_width.left,
+            data.arch_index.left * 100,
+            data.heel_angle.left,
+            data.hallux_angle.left
         ]
 
         right_values = [
-            data['foot_length']['right'],
-            data['foot_width']['right'],
-            data['arch_index']['right'] * 100,
-            data['heel_angle']['right'],
-            data['hallux_angle']['right']
+            data.foot_length.right,
+            data.foot_width.right,
+            data.arch_index.right * 100,
+            data.heel_angle.right,
+            data.hallux_angle.right
         ]
 
         x = np.arange(len(categories))
         width = 0.35
 
-        fig, ax = plt.subplots(figsize=(9, 5))
+        fig, ax = create_figure((9, 5))
 
         bars_left = ax.bar(x - width / 2, left_values, width,
                            label='Левая стопа', color=MATPLOT_PRIMARY, alpha=0.85,
@@ -1032,9 +2394,8 @@ def create_comparison_chart(data, output_path):
         autolabel(bars_left)
         autolabel(bars_right)
 
-        plt.tight_layout()
-        plt.savefig(output_path, dpi=150, bbox_inches='tight', facecolor='white')
-        plt.close()
+        fig.tight_layout()
+        output_profile().save_figure(fig, output_path)
 
         print(f"[GRAPH] Сравнительная диаграмма сохранена: {output_path}")
         return True
@@ -1044,46 +2405,181 @@ def create_comparison_chart(data, output_path):
         return False
 
 
-# ============================================================================
-# 7. ГЕНЕРАЦИЯ PDF ОТЧЕТА
-# ============================================================================
+def _render_chart_process(output_path, render):
+    # Код выхода процесса сообщает родителю, построен ли график
+    sys.exit(0 if render(output_path) else 1)
 
-def create_pdf_report(data, risk_scores, recommendations, output_filename):
-    """Создает профессиональный PDF отчет"""
-    print(f"\n{'=' * 60}")
-    print("📄 СОЗДАНИЕ PDF ОТЧЕТА")
-    print('=' * 60)
 
-    normal_font, bold_font = register_fonts()
-    styles = create_styles(normal_font, bold_font)
+class ChartRenders:
+    """Графики отчета в отдельных процессах, пока основной процесс собирает текст
 
-    temp_dir = "temp_graphs"
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir, exist_ok=True)
+    Процессы порождаются через fork, поэтому не импортируют модуль заново.
+    Форк допустим только из однопоточного процесса, который сам не демон
+    (воркеры пула — демоны и не могут иметь дочерних процессов), и имеет
+    смысл только при нескольких ядрах; в остальных случаях графики строятся
+    последовательно прямо в start().
 
-    print("[1/6] Создание графиков...")
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    radar_chart_path = os.path.join(temp_dir, f"radar_chart_{timestamp}.png")
-    comparison_chart_path = os.path.join(temp_dir, f"comparison_chart_{timestamp}.png")
+    Хранилище артефактов используется только из основного процесса: поиск —
+    до форка, сохранение — после join(), иначе учет добавленного объема
+    (и вытеснение по бюджету) оставался бы в дочерних процессах.
+    """
+
+    def __init__(self):
+        self.concurrent = ('fork' in multiprocessing.get_all_start_methods()
+                           and (os.cpu_count() or 1) > 1
+                           and not multiprocessing.current_process().daemon
+                           and threading.active_count() == 1)
+        self.created = {}
+        self._processes = {}
+
+    def start(self, name, kind, inputs, output_path, render):
+        if not self.concurrent:
+            self.created[name] = render_cached(kind, inputs, output_path, render)
+            return
 
-    radar_created = create_radar_chart(risk_scores, radar_chart_path)
-    comparison_created = create_comparison_chart(data, comparison_chart_path)
+        store = artifact_store()
+        key = store.key(kind, inputs) if store else None
+        if store and store.fetch(kind, key, output_path):
+            print(f"[CACHE] График {kind} взят из хранилища")
+            self.created[name] = True
+            return
+        process = multiprocessing.get_context('fork').Process(
+            target=_render_chart_process, args=(output_path, render), daemon=True)
+        process.start()
+        self._processes[name] = (process, kind, key, output_path)
+
+    def join(self):
+        """Ждет все графики и сохраняет новые в хранилище; {имя: построен ли}"""
+        for name, (process, kind, key, output_path) in self._processes.items():
+            process.join()
+            self.created[name] = process.exitcode == 0
+            if self.created[name] and key:
+                artifact_store().put(kind, key, output_path)
+        self._processes.clear()
+        return self.created
+
+
+class ChartSlot:
+    """Место графика в story; после построения графиков заменяется на Image"""
+
+    __slots__ = ('name', 'path', 'width', 'height')
+
+    def __init__(self, name, path, width, height):
+        self.name = name
+        self.path = path
+        self.width = width
+        self.height = height
+
+    def flowable(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            image = Image(output_profile().image_source(self.path, self.width, self.height),
+                          width=self.width, height=self.height)
+        except Exception:
+            return None
+        image.hAlign = 'CENTER'
+        return image
+
+
+def fill_chart_slots(story, created):
+    """Подставляет построенные графики вместо ChartSlot; непостроенные убираются"""
+    filled = []
+    for flowable in story:
+        if isinstance(flowable, ChartSlot):
+            flowable = flowable.flowable() if created.get(flowable.name) else None
+            if flowable is None:
+                continue
+        filled.append(flowable)
+    return filled
 
-    logo_path = create_logo()
 
-    print("[2/6] Настройка документа...")
-    doc = SimpleDocTemplate(
-        output_filename,
-        pagesize=A4,
-        topMargin=1.5 * cm,
-        bottomMargin=1.5 * cm,
-        leftMargin=1.5 * cm,
-        rightMargin=1.5 * cm,
-        title=f"FootScan Analytics - Отчет для {data['client_name']}",
-        author="FootScan Analytics",
-        creator="FootScan Analytics System"
-    )
+# ============================================================================
+# 15. ГЕНЕРАЦИЯ PDF ОТЧЕТА
+# ============================================================================
+
+TREND_MAX_SCANS = 6
+TREND_RISK_LABELS = (
+    ('degenerative', 'Дегенеративный риск'),
+    ('spinal', 'Позвоночный риск'),
+    ('traumatic', 'Травматический риск'),
+    ('comfort', 'Комфортный риск'),
+    ('progression', 'Риск прогрессирования'),
+)
+RISK_CATEGORY_INFO = (
+    ('degenerative', 'Дегенеративный риск', 'Риск развития артрозов и дегенеративных изменений суставов'),
+    ('spinal', 'Позвоночный риск', 'Влияение на осанку и здоровье позвоночника'),
+    ('traumatic', 'Травматический риск', 'Вероятность получения травм при нагрузках'),
+    ('comfort', 'Комфортный риск', 'Сложности с подбором комфортной обуви'),
+    ('progression', 'Риск прогрессирования', 'Вероятность усугубления существующих особенностей'),
+)
+
 
+def build_trend_section(previous_scans, data, risk_scores, styles, normal_font, bold_font, number):
+    """Раздел динамики: параметры по прошлым обследованиям и изменение рисков"""
+    cell_style = ParagraphStyle(name='TrendCell', parent=styles['Normal'], fontSize=8, alignment=TA_CENTER)
+    current = {metric: list(getattr(data, metric)) for metric in HISTORY_METRICS}
+    current.update(scan_date=data.scan_date, risk_scores=risk_scores)
+    scans = previous_scans[-TREND_MAX_SCANS:] + [current]
+
+    headers = ['Дата', 'Длина, мм<br/>Л / П', 'Ширина, мм<br/>Л / П', 'Индекс свода<br/>Л / П',
+               'Угол пальца, °<br/>Л / П', 'Общий риск']
+    trend_data = [[Paragraph(f"<font name='{bold_font}'><b>{header}</b></font>", styles['TableHeader'])
+                   for header in headers]]
+    for scan in scans:
+        (length_left, length_right), (width_left, width_right) = scan['foot_length'], scan['foot_width']
+        (arch_left, arch_right), (hallux_left, hallux_right) = scan['arch_index'], scan['hallux_angle']
+        total = sum(scan['risk_scores'].values()) / len(scan['risk_scores'])
+        date_text = scan['scan_date'] + (" (текущее)" if scan is current else "")
+        trend_data.append([Paragraph(f"<font name='{normal_font}'>{text}</font>", cell_style) for text in (
+            date_text,
+            f"{length_left:.1f} / {length_right:.1f}",
+            f"{width_left:.1f} / {width_right:.1f}",
+            f"{arch_left:.3f} / {arch_right:.3f}",
+            f"{hallux_left:.1f} / {hallux_right:.1f}",
+            f"{total:.1f}",
+        )])
+
+    trend_table = Table(trend_data, colWidths=[3.2 * cm, 2.8 * cm, 2.8 * cm, 2.8 * cm, 2.8 * cm, 2 * cm])
+    trend_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), PRIMARY_DARK),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('GRID', (0, 0), (-1, -1), 0.5, BORDER_COLOR),
+        ('PADDING', (0, 0), (-1, -1), 5),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, BG_LIGHT]),
+        ('BACKGROUND', (0, -1), (-1, -1), LIGHT_BLUE_BG),
+    ]))
+    # Заголовок не отрывается от таблицы на границе страницы
+    flowables = [KeepTogether([Paragraph(f"{number}. ДИНАМИКА ПО ПРЕДЫДУЩИМ ОБСЛЕДОВАНИЯМ", styles['SectionTitle']),
+                               Spacer(1, 0.4 * cm), trend_table]),
+                 Spacer(1, 0.6 * cm)]
+
+    last = previous_scans[-1]
+    lines = [f"<font name='{normal_font}'><b>Изменение рисков с {last['scan_date']}:</b></font>"]
+    for key, label in TREND_RISK_LABELS:
+        before, after = last['risk_scores'].get(key, 0), risk_scores[key]
+        delta = after - before
+        delta_color = HIGH_RISK_HEX if delta > 0 else LOW_RISK_HEX if delta < 0 else TEXT_MUTED_HEX
+        lines.append(f"<font name='{normal_font}'>• {label}: {before} → {after} "
+                     f"(<font color=\"{delta_color}\">{delta:+g}</font>)</font>")
+
+    first = previous_scans[0]
+    length_change = [now - then for now, then in zip(data.foot_length, first['foot_length'])]
+    lines.append(f"<font name='{normal_font}'>• Длина стопы с {first['scan_date']}: "
+                 f"Л {length_change[0]:+.1f} мм, П {length_change[1]:+.1f} мм</font>")
+
+    flowables += [Paragraph("<br/>".join(lines), styles['BoxedText']), Spacer(1, 0.8 * cm)]
+    return flowables
+
+
+def build_report_story(data, risk_scores, recommendations, styles, normal_font, bold_font,
+                       logo_path, radar_chart_path=None, comparison_chart_path=None, previous_scans=None,
+                       percentiles=None):
+    """Формирует содержимое (story) PDF отчета
+
+    Графики входят в story как ChartSlot: они могут еще строиться, и
+    create_pdf_report подставляет их через fill_chart_slots.
+    """
     story = []
 
     # ==================== ТИТУЛЬНАЯ СТРАНИЦА ====================
@@ -1091,7 +2587,7 @@ def create_pdf_report(data, risk_scores, recommendations, output_filename):
 
     if os.path.exists(logo_path):
         try:
-            logo = Image(logo_path, width=4 * cm, height=4 * cm)
+            logo = Image(output_profile().image_source(logo_path, 4 * cm, 4 * cm), width=4 * cm, height=4 * cm)
             logo.hAlign = 'CENTER'
             story.append(logo)
             story.append(Spacer(1, 0.5 * cm))
@@ -1115,15 +2611,15 @@ def create_pdf_report(data, risk_scores, recommendations, output_filename):
 
     patient_info = [
         [Paragraph(f"<font name='{bold_font}'><b>Пациент</b></font>", styles['Important']),
-         Paragraph(f"<font name='{normal_font}'>{data['client_name']}</font>", styles['Normal'])],
+         Paragraph(f"<font name='{normal_font}'>{data.client_name}</font>", styles['Normal'])],
         [Paragraph(f"<font name='{bold_font}'><b>Пол</b></font>", styles['Important']),
-         Paragraph(f"<font name='{normal_font}'>{data['gender']}</font>", styles['Normal'])],
+         Paragraph(f"<font name='{normal_font}'>{data.gender}</font>", styles['Normal'])],
         [Paragraph(f"<font name='{bold_font}'><b>Дата обследования</b></font>", styles['Important']),
-         Paragraph(f"<font name='{normal_font}'>{data['scan_date']}</font>", styles['Normal'])],
+         Paragraph(f"<font name='{normal_font}'>{data.scan_date}</font>", styles['Normal'])],
         [Paragraph(f"<font name='{bold_font}'><b>ID отчета</b></font>", styles['Important']),
          Paragraph(f"<font name='{normal_font}'>FSA-{datetime.now().strftime('%Y%m%d%H%M')}</font>", styles['Normal'])],
         [Paragraph(f"<font name='{bold_font}'><b>Сканер</b></font>", styles['Important']),
-         Paragraph(f"<font name='{normal_font}'>{data['scanner_id']}</font>", styles['Normal'])],
+         Paragraph(f"<font name='{normal_font}'>{data.scanner_id}</font>", styles['Normal'])],
     ]
 
     patient_table = Table(patient_info, colWidths=[4 * cm, 9 * cm])
@@ -1185,28 +2681,11 @@ def create_pdf_report(data, risk_scores, recommendations, output_filename):
     story.append(Paragraph(analysis_text, styles['Normal']))
     story.append(Spacer(1, 0.8 * cm))
 
-    if radar_created and os.path.exists(radar_chart_path):
-        try:
-            radar_img = Image(radar_chart_path, width=14 * cm, height=14 * cm)
-            radar_img.hAlign = 'CENTER'
-            story.append(radar_img)
-            story.append(Spacer(1, 0.5 * cm))
-        except Exception:
-            pass
+    if radar_chart_path:
+        story.append(ChartSlot('radar', radar_chart_path, 14 * cm, 14 * cm))
+        story.append(Spacer(1, 0.5 * cm))
 
     risk_data = []
-    risk_categories_info = [
-        ('Дегенеративный риск', 'Риск развития артрозов и дегенеративных изменений суставов',
-         risk_scores['degenerative']),
-        ('Позвоночный риск', 'Влияение на осанку и здоровье позвоночника',
-         risk_scores['spinal']),
-        ('Травматический риск', 'Вероятность получения травм при нагрузках',
-         risk_scores['traumatic']),
-        ('Комфортный риск', 'Сложности с подбором комфортной обуви',
-         risk_scores['comfort']),
-        ('Риск прогрессирования', 'Вероятность усугубления существующих особенностей',
-         risk_scores['progression'])
-    ]
 
     risk_data.append([
         Paragraph(f"<font name='{bold_font}'><b>Категория риска</b></font>", styles['TableHeader']),
@@ -1214,7 +2693,8 @@ def create_pdf_report(data, risk_scores, recommendations, output_filename):
         Paragraph(f"<font name='{bold_font}'><b>Уровень</b></font>", styles['TableHeader'])
     ])
 
-    for name, description, score in risk_categories_info:
+    for key, name, description in RISK_CATEGORY_INFO:
+        score = risk_scores[key]
         if score >= 70:
             color = HIGH_RISK
             level = "ВЫСОКИЙ"
@@ -1276,17 +2756,15 @@ def create_pdf_report(data, risk_scores, recommendations, output_filename):
     story.append(Paragraph("2. ДЕТАЛЬНЫЙ БИОМЕХАНИЧЕСКИЙ АНАЛИЗ", styles['SectionTitle']))
     story.append(Spacer(1, 0.4 * cm))
 
-    if comparison_created and os.path.exists(comparison_chart_path):
-        try:
-            comp_img = Image(comparison_chart_path, width=15 * cm, height=9 * cm)
-            comp_img.hAlign = 'CENTER'
-            story.append(comp_img)
-            story.append(Spacer(1, 0.5 * cm))
-        except Exception:
-            pass
+    if comparison_chart_path:
+        story.append(ChartSlot('comparison', comparison_chart_path, 15 * cm, 9 * cm))
+        story.append(Spacer(1, 0.5 * cm))
 
     story.append(Paragraph(f"<font name='{bold_font}'><b>Измеренные параметры стоп:</b></font>", styles['SubSection']))
 
+    norms = norm_tables().lookup(data)
+    norm_text = {param: f"{low:g}-{high:g}" for param, (low, high) in norms.items()}
+
     params_data = [
         [Paragraph(f"<font name='{bold_font}'><b>Параметр</b></font>", styles['TableHeader']),
          Paragraph(f"<font name='{bold_font}'><b>Левая стопа</b></font>", styles['TableHeader']),
@@ -1294,43 +2772,43 @@ def create_pdf_report(data, risk_scores, recommendations, output_filename):
          Paragraph(f"<font name='{bold_font}'><b>Норма</b></font>", styles['TableHeader'])],
 
         [Paragraph(f"<font name='{normal_font}'>Длина стопы (мм)</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['foot_length']['left']:.1f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['foot_length']['right']:.1f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>230-260 мм</font>", styles['Normal'])],
+         Paragraph(f"<font name='{normal_font}'>{data.foot_length.left:.1f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{data.foot_length.right:.1f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{norm_text['foot_length']} мм</font>", styles['Normal'])],
 
         [Paragraph(f"<font name='{normal_font}'>Ширина стопы (мм)</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['foot_width']['left']:.1f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['foot_width']['right']:.1f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>90-105 мм</font>", styles['Normal'])],
+         Paragraph(f"<font name='{normal_font}'>{data.foot_width.left:.1f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{data.foot_width.right:.1f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{norm_text['foot_width']} мм</font>", styles['Normal'])],
 
         [Paragraph(f"<font name='{normal_font}'>Обхват плюсны (мм)</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['ball_girth']['left']:.1f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['ball_girth']['right']:.1f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>230-250 мм</font>", styles['Normal'])],
+         Paragraph(f"<font name='{normal_font}'>{data.ball_girth.left:.1f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{data.ball_girth.right:.1f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{norm_text['ball_girth']} мм</font>", styles['Normal'])],
 
         [Paragraph(f"<font name='{normal_font}'>Индекс свода</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['arch_index']['left']:.3f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['arch_index']['right']:.3f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>0.26-0.29</font>", styles['Normal'])],
+         Paragraph(f"<font name='{normal_font}'>{data.arch_index.left:.3f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{data.arch_index.right:.3f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{norm_text['arch_index']}</font>", styles['Normal'])],
 
         [Paragraph(f"<font name='{normal_font}'>Угол пятки (°)</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['heel_angle']['left']}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['heel_angle']['right']}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>0-4°</font>", styles['Normal'])],
+         Paragraph(f"<font name='{normal_font}'>{data.heel_angle.left}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{data.heel_angle.right}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{norm_text['heel_angle']}°</font>", styles['Normal'])],
 
         [Paragraph(f"<font name='{normal_font}'>Угол пальца (°)</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['hallux_angle']['left']:.1f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['hallux_angle']['right']:.1f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>0-8°</font>", styles['Normal'])],
+         Paragraph(f"<font name='{normal_font}'>{data.hallux_angle.left:.1f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{data.hallux_angle.right:.1f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{norm_text['hallux_angle']}°</font>", styles['Normal'])],
 
         [Paragraph(f"<font name='{normal_font}'>Размер обуви (EU)</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['shoe_size']['left']:.1f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['shoe_size']['right']:.1f}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>По измерениям</font>", styles['Normal'])],
+         Paragraph(f"<font name='{normal_font}'>{data.shoe_size.left:.1f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{data.shoe_size.right:.1f}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{shoe_size_source(data)}</font>", styles['Normal'])],
 
         [Paragraph(f"<font name='{normal_font}'>Тип стопы</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['toe_type']}</font>", styles['Normal']),
-         Paragraph(f"<font name='{normal_font}'>{data['toe_type']}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{data.toe_type}</font>", styles['Normal']),
+         Paragraph(f"<font name='{normal_font}'>{data.toe_type}</font>", styles['Normal']),
          Paragraph(f"<font name='{normal_font}'>-</font>", styles['Normal'])],
     ]
 
@@ -1346,71 +2824,78 @@ def create_pdf_report(data, risk_scores, recommendations, output_filename):
         ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, BG_LIGHT]),
     ])
 
-    norms = {
-        'Длина': (230, 260),
-        'Ширина': (90, 105),
-        'Обхват': (230, 250),
-        'Индекс': (0.26, 0.29),
-        'Угол пятки': (0, 4),
-        'Угол пальца': (0, 8)
-    }
-
-    for row_idx in range(1, len(params_data)):
-        param_text = params_data[row_idx][0]
-        if isinstance(param_text, Paragraph):
-            param_name = param_text.text
-        else:
-            param_name = str(param_text)
-
-        for key, (low, high) in norms.items():
-            if key in param_name:
-                try:
-                    left_val_text = params_data[row_idx][1]
-                    if isinstance(left_val_text, Paragraph):
-                        left_val_str = left_val_text.text
-                    else:
-                        left_val_str = str(left_val_text)
-
-                    left_match = re.search(r'\d+\.?\d*', left_val_str)
-                    if left_match:
-                        left_val = float(left_match.group())
-                        if left_val < low or left_val > high:
-                            table_style.add('BACKGROUND', (1, row_idx), (1, row_idx), colors.HexColor('#FFF3CD'))
-
-                    right_val_text = params_data[row_idx][2]
-                    if isinstance(right_val_text, Paragraph):
-                        right_val_str = right_val_text.text
-                    else:
-                        right_val_str = str(right_val_text)
-
-                    right_match = re.search(r'\d+\.?\d*', right_val_str)
-                    if right_match:
-                        right_val = float(right_match.group())
-                        if right_val < low or right_val > high:
-                            table_style.add('BACKGROUND', (2, row_idx), (2, row_idx), colors.HexColor('#FFF3CD'))
-                except (ValueError, AttributeError):
-                    pass
+    # Строки таблицы параметров по порядку; знак угла, как и раньше, не учитывается
+    for row_idx, param in enumerate(('foot_length', 'foot_width', 'ball_girth', 'arch_index',
+                                     'heel_angle', 'hallux_angle'), 1):
+        low, high = norms[param]
+        for col_idx, value in enumerate(getattr(data, param), 1):
+            if abs(value) < low or abs(value) > high:
+                table_style.add('BACKGROUND', (col_idx, row_idx), (col_idx, row_idx), colors.HexColor('#FFF3CD'))
 
     params_table.setStyle(table_style)
     story.append(params_table)
     story.append(Spacer(1, 0.8 * cm))
 
-    length_diff = abs(data['foot_length']['left'] - data['foot_length']['right'])
-    width_diff = abs(data['foot_width']['left'] - data['foot_width']['right'])
+    length_diff = abs(data.foot_length.left - data.foot_length.right)
+    width_diff = abs(data.foot_width.left - data.foot_width.right)
 
     asymmetry_text = f"""
     <font name='{normal_font}'><b>Анализ асимметрии:</b></font><br/>
     <font name='{normal_font}'>• Разница в длине: {length_diff:.1f} мм ({'норма' if length_diff <= 3 else 'требует внимания'})</font><br/>
     <font name='{normal_font}'>• Разница в ширине: {width_diff:.1f} мм ({'норма' if width_diff <= 2 else 'требует внимания'})</font><br/>
-    <font name='{normal_font}'>• Тип стопы: {data['toe_type']}</font><br/>
-    <font name='{normal_font}'>• Рекомендуемая ширина обуви: {data['shoe_width']}</font>
+    <font name='{normal_font}'>• Тип стопы: {data.toe_type}</font><br/>
+    <font name='{normal_font}'>• Рекомендуемая ширина обуви: {data.shoe_width}</font>
     """
 
     story.append(Paragraph(asymmetry_text, styles['BoxedText']))
     story.append(Spacer(1, 0.8 * cm))
 
+    # Обе стопы пересчитываются одним векторным вызовом
+    sizes = convert_shoe_sizes(list(data.foot_length), list(data.foot_width))
+    sizes_data = [[Paragraph(f"<font name='{bold_font}'><b>{text}</b></font>", styles['TableHeader'])
+                   for text in ('Система', 'Левая стопа', 'Правая стопа')]]
+    for system, label in SHOE_SIZE_SYSTEMS:
+        sizes_data.append([Paragraph(f"<font name='{normal_font}'>{text}</font>", styles['Normal']) for text in (
+            label, *(format_shoe_size(system, value, child)
+                     for value, child in zip(sizes[system], sizes['child'])))])
+    sizes_data.append([Paragraph(f"<font name='{normal_font}'>{text}</font>", styles['Normal']) for text in (
+        'Полнота (по ширине)', *(letter or '—' for letter in sizes['width']))])
+
+    sizes_table = Table(sizes_data, colWidths=[4 * cm, 2.8 * cm, 2.8 * cm])
+    sizes_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), PRIMARY_DARK),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('GRID', (0, 0), (-1, -1), 0.5, BORDER_COLOR),
+        ('PADDING', (0, 0), (-1, -1), 4),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, BG_LIGHT]),
+    ]))
+    story.append(KeepTogether([
+        Paragraph(f"<font name='{bold_font}'><b>Размер обуви в разных системах (по длине стопы):</b></font>",
+                  styles['SubSection']),
+        sizes_table]))
+    story.append(Spacer(1, 0.8 * cm))
+
+    if percentiles:
+        group = "все обследованные" if percentiles['group'] == 'all' else percentiles['group'].lower()
+        cohort_lines = [f"<font name='{normal_font}'><b>Положение в группе обследования</b> "
+                        f"({group}, {percentiles['size']} чел.):</font>"]
+        for metric, label in COHORT_METRICS:
+            left_pct, right_pct = percentiles['metrics'][metric]
+            cohort_lines.append(f"<font name='{normal_font}'>• {label}: Л — {left_pct}-й, "
+                                f"П — {right_pct}-й перцентиль</font>")
+        story.append(Paragraph("<br/>".join(cohort_lines), styles['BoxedText']))
+        story.append(Spacer(1, 0.8 * cm))
+
+    # ==================== ДИНАМИКА ====================
+    section_number = 3
+    if previous_scans:
+        story.extend(build_trend_section(previous_scans, data, risk_scores, styles, normal_font, bold_font,
+                                         section_number))
+        section_number += 1
+
     # ==================== РЕКОМЕНДАЦИИ ====================
-    story.append(Paragraph("3. ПЕРСОНАЛИЗИРОВАННЫЕ РЕКОМЕНДАЦИИ", styles['SectionTitle']))
+    story.append(Paragraph(f"{section_number}. ПЕРСОНАЛИЗИРОВАННЫЕ РЕКОМЕНДАЦИИ", styles['SectionTitle']))
     story.append(Spacer(1, 0.4 * cm))
 
     intro_rec_text = f"""
@@ -1451,7 +2936,7 @@ def create_pdf_report(data, risk_scores, recommendations, output_filename):
     story.append(Spacer(1, 1.2 * cm))
 
     conclusion_text = f"""
-    <font name='{normal_font}'><b>Важно:</b> Данные рекомендации составлены на основе анализа от {data['scan_date']}. 
+    <font name='{normal_font}'><b>Важно:</b> Данные рекомендации составлены на основе анализа от {data.scan_date}. 
     При появлении болей, дискомфорта или изменений в походке обязательно обратитесь к врачу-ортопеду.</font>
     """
 
@@ -1471,7 +2956,7 @@ def create_pdf_report(data, risk_scores, recommendations, output_filename):
     Цифровая лаборатория здоровья стоп</font><br/>
     <font name='{normal_font}' size='8'>Отчет сгенерирован автоматически {datetime.now().strftime('%d.%m.%Y %H:%M')}. 
     Данный документ носит рекомендательный характер и не заменяет консультацию специалиста.<br/>
-    ID сканера: {data['scanner_id']} | Пациент: {data['client_name']}<br/>
+    ID сканера: {data.scanner_id} | Пациент: {data.client_name}<br/>
     © 2024 FootScan Analytics. Все права защищены.</font>
     """
 
@@ -1480,306 +2965,3102 @@ def create_pdf_report(data, risk_scores, recommendations, output_filename):
                                           alignment=TA_CENTER, fontSize=9,
                                           textColor=TEXT_MUTED)))
 
-    # ==================== СОЗДАНИЕ PDF ====================
-    print("[6/6] Генерация PDF файла...")
-    try:
-        doc.build(story)
-        print(f"[SUCCESS] PDF отчет успешно создан: {output_filename}")
+    return story
+
+
+def create_pdf_report(data, risk_scores, recommendations, output_filename, percentiles=None):
+    """Создает профессиональный PDF отчет"""
+    print(f"\n{'=' * 60}")
+    print("📄 СОЗДАНИЕ PDF ОТЧЕТА")
+    print('=' * 60)
+
+    history = patient_history()
+    previous_scans = history.previous_scans(data.to_dict()) if history else []
+    if previous_scans:
+        print(f"[INFO] Предыдущих обследований пациента: {len(previous_scans)}")
 
-        debug_dir = "generated_reports_debug"
-        if not os.path.exists(debug_dir):
-            os.makedirs(debug_dir)
+    normal_font, bold_font = register_fonts()
+    styles = create_styles(normal_font, bold_font)
+
+    temp_dir = scratch_dir()
+    profile = output_profile()
+
+    print("[1/6] Создание графиков...")
+    timestamp = unique_stamp()
+    radar_chart_path = os.path.join(temp_dir, f"radar_chart_{timestamp}{profile.chart_extension}")
+    comparison_chart_path = os.path.join(temp_dir, f"comparison_chart_{timestamp}{profile.chart_extension}")
+
+    comparison_inputs = {key: getattr(data, key).to_dict() for key in
+                         ('foot_length', 'foot_width', 'arch_index', 'heel_angle', 'hallux_angle')}
+    charts = ChartRenders()
+    with pipeline_stage('charts'):
+        charts.start('radar', 'radar', profiled_inputs(risk_scores), radar_chart_path,
+                     lambda path: create_radar_chart(risk_scores, path))
+        charts.start('comparison', 'comparison', profiled_inputs(comparison_inputs), comparison_chart_path,
+                     lambda path: create_comparison_chart(data, path))
+
+    logo_path = create_logo()
+
+    print("[2/6] Настройка документа...")
+    # Пишем во временный файл: незавершенный отчет не появится под итоговым именем
+    temp_output = temp_sibling(output_filename)
+    doc = SimpleDocTemplate(
+        temp_output,
+        pagesize=A4,
+        topMargin=1.5 * cm,
+        bottomMargin=1.5 * cm,
+        leftMargin=1.5 * cm,
+        rightMargin=1.5 * cm,
+        pageCompression=profile.page_compression,
+        title=f"FootScan Analytics - Отчет для {data.client_name}",
+        author="FootScan Analytics",
+        creator="FootScan Analytics System"
+    )
 
-        safe_name = re.sub(r'[^\w\s-]', '', data['client_name'])
-        safe_name = re.sub(r'[-\s]+', '_', safe_name).strip('-_')
-        json_path = os.path.join(debug_dir, f"{safe_name}_{timestamp}_data.json")
+    with pipeline_stage('story'):
+        story = build_report_story(data, risk_scores, recommendations, styles, normal_font, bold_font,
+                                   logo_path, radar_chart_path, comparison_chart_path,
+                                   previous_scans=previous_scans, percentiles=percentiles)
 
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump({
-                'data': data,
-                'risk_scores': risk_scores,
-                'recommendations': recommendations,
-                'generated': datetime.now().isoformat(),
-                'pdf_file': output_filename
-            }, f, ensure_ascii=False, indent=2)
+    # Графики нужны только верстке: ждем их непосредственно перед doc.build
+    with pipeline_stage('charts.join'):
+        story = fill_chart_slots(story, charts.join())
 
-        print(f"[DEBUG] Данные отчета сохранены в: {json_path}")
+    # ==================== СОЗДАНИЕ PDF ====================
+    print("[6/6] Генерация PDF файла...")
+    try:
+        with pipeline_stage('build'):
+            doc.build(story)
+        os.replace(temp_output, output_filename)
+        print(f"[SUCCESS] PDF отчет успешно создан: {output_filename}")
 
+    except MemoryError:
+        raise
     except Exception as e:
         print(f"[ERROR] Ошибка создания PDF: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        # Графики уже встроены в PDF
+        charts.join()
+        for path in (temp_output, radar_chart_path, comparison_chart_path):
+            if os.path.exists(path):
+                os.remove(path)
 
     return output_filename
 
 
-# ============================================================================
-# 8. ОСНОВНАЯ ФУНКЦИЯ
-# ============================================================================
+def create_cohort_summary(cohort, output_filename, subtitle=""):
+    """Одностраничная сводка по когорте пакета: квантили параметров по группам"""
+    normal_font, bold_font = register_fonts()
+    styles = create_styles(normal_font, bold_font)
+    labels = dict(COHORT_METRICS)
 
-def main():
-    print("\n" + "=" * 70)
-    print("🏥 FOOTSCAN ANALYTICS - Генератор медицинских отчетов")
-    print("=" * 70)
+    story = [Paragraph("СВОДКА ПО ГРУППЕ ОБСЛЕДОВАННЫХ", styles['ReportTitle'])]
+    patients_text = ", ".join(f"{'все' if group == 'all' else group}: {count}"
+                              for group, count in sorted(cohort.patients.items(),
+                                                         key=lambda item: (item[0] != 'all', item[0])))
+    story.append(Paragraph(
+        f"<font name='{normal_font}'>{subtitle}{' · ' if subtitle else ''}"
+        f"{datetime.now().strftime('%d.%m.%Y %H:%M')} · пациентов — {patients_text}</font>",
+        ParagraphStyle(name='CohortSubtitle', parent=styles['Normal'], alignment=TA_CENTER, spaceAfter=12)))
+
+    cell_style = ParagraphStyle(name='CohortCell', parent=styles['Normal'], fontSize=8, alignment=TA_CENTER)
+    header = ['Группа', 'Параметр', 'N'] + [f"P{round(q * 100)}" for q in COHORT_QUANTILES]
+    table_data = [[Paragraph(f"<font name='{bold_font}'><b>{text}</b></font>", styles['TableHeader'])
+                   for text in header]]
+    for group, patients, metric, count, quantiles in cohort.rows():
+        precision = 3 if metric == 'arch_index' else 1
+        table_data.append([Paragraph(f"<font name='{normal_font}'>{text}</font>", cell_style) for text in (
+            f"{'Все' if group == 'all' else group} ({patients})", labels[metric], count,
+            *(f"{value:.{precision}f}" for value in quantiles))])
+
+    table = Table(table_data, colWidths=[3.2 * cm, 3.8 * cm, 1.2 * cm] + [1.8 * cm] * len(COHORT_QUANTILES),
+                  repeatRows=1)
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), PRIMARY_DARK),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('GRID', (0, 0), (-1, -1), 0.5, BORDER_COLOR),
+        ('PADDING', (0, 0), (-1, -1), 3),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, BG_LIGHT]),
+    ]))
+    story += [table, Spacer(1, 0.5 * cm), Paragraph(
+        f"<font name='{normal_font}' size='8'>Квантили приближенные (относительная точность "
+        f"{SKETCH_ACCURACY:.0%}); каждая стопа учитывается как отдельное значение.</font>",
+        ParagraphStyle(name='CohortNote', parent=styles['Normal'], textColor=TEXT_MUTED))]
+
+    with atomic_path(output_filename) as temp_path:
+        SimpleDocTemplate(temp_path, pagesize=A4, topMargin=1.5 * cm, bottomMargin=1.5 * cm,
+                          leftMargin=1.5 * cm, rightMargin=1.5 * cm,
+                          pageCompression=output_profile().page_compression,
+                          title="FootScan Analytics - Сводка по группе").build(story)
+    return output_filename
 
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    reports_dir = os.path.join(current_dir, "../reports")
-    students_dir = os.path.join(reports_dir, "students")
-    students_result_dir = os.path.join(reports_dir, "students_result")
 
-    print(f"[INFO] Текущая директория: {current_dir}")
-    print(f"[INFO] Директория с PDF файлами: {students_dir}")
-    print(f"[INFO] Директория для результатов: {students_result_dir}")
+# ============================================================================
+# 16. HTML ОТЧЕТ
+# ============================================================================
 
-    for directory in [students_dir, students_result_dir]:
-        if not os.path.exists(directory):
-            try:
-                os.makedirs(directory, exist_ok=True)
-                print(f"[INFO] Создана директория: {directory}")
-            except Exception as e:
-                print(f"[ERROR] Не удалось создать директорию {directory}: {e}")
+REPORT_FORMAT_ENV = 'FOOTSCAN_REPORT_FORMAT'
+REPORT_FORMATS = ('pdf', 'html')
+# Общие файлы HTML отчетов: одна копия в папке отчетов на версию оформления
+HTML_ASSETS_DIR = '_assets'
+
+RADAR_SIZE = 460
+RADAR_RADIUS = 150
+RADAR_CENTER = (RADAR_SIZE / 2, RADAR_SIZE / 2 + 12)  # ниже середины: сверху место для заголовка
+COMPARISON_WIDTH, COMPARISON_HEIGHT = 640, 360
+COMPARISON_PLOT = (70, 50, 620, 290)  # левый, верхний, правый, нижний край области построения
+COMPARISON_CATEGORIES = ('Длина\nстопы, мм', 'Ширина\nстопы, мм', 'Индекс\nсвода (×100)',
+                         'Угол\nпятки, °', 'Угол\nпальца, °')
+
+HTML_CSS = """
+@font-face { font-family: 'DejaVu Sans'; src: url('DejaVuSans.ttf') format('truetype'); font-weight: normal; }
+@font-face { font-family: 'DejaVu Sans'; src: url('DejaVuSans-Bold.ttf') format('truetype'); font-weight: bold; }
+* { box-sizing: border-box; }
+body { margin: 0; background: var(--bg-light); color: var(--text-dark);
+       font: 15px/1.45 'DejaVu Sans', 'Segoe UI', Arial, sans-serif; }
+.report { max-width: 820px; margin: 0 auto; padding: 24px 20px 40px; background: #fff; }
+section { margin-bottom: 36px; }
+.cover { text-align: center; }
+.logo { width: 120px; height: 120px; }
+.company { color: var(--primary-dark); font-size: 28px; margin: 8px 0 0; }
+.muted { color: var(--text-muted); }
+.report-title { color: var(--primary-dark); font-size: 22px; margin: 28px 0 4px; }
+.section-title { color: var(--primary-dark); font-size: 19px; border-bottom: 2px solid var(--primary-blue);
+                 padding-bottom: 4px; margin: 0 0 14px; }
+h3 { font-size: 16px; margin: 18px 0 8px; }
+.boxed { background: var(--light-blue-bg); border-left: 4px solid var(--primary-blue);
+         padding: 10px 14px; margin: 16px 0; text-align: left; }
+.boxed p { margin: 0 0 4px; }
+table { border-collapse: collapse; margin: 10px auto; }
+th { background: var(--primary-dark); color: #fff; padding: 6px 10px; font-size: 13px; }
+td { border: 1px solid var(--border); padding: 6px 10px; text-align: center; }
+.data tbody tr:nth-child(even) td { background: var(--bg-light); }
+.patient { border: 2px solid var(--primary-blue); text-align: left; min-width: 60%; }
+.patient th { background: var(--light-blue-bg); color: var(--text-dark); text-align: left; }
+.patient td { border: none; text-align: left; }
+.risk td:first-child { text-align: left; }
+.risk small { display: block; color: var(--text-muted); }
+td.out-of-norm, .data tbody tr:nth-child(even) td.out-of-norm { background: #FFF3CD; }
+tr.current td, .data tbody tr.current:nth-child(even) td { background: var(--light-blue-bg); }
+.chart { display: block; width: 100%; height: auto; margin: 0 auto 12px; }
+.chart.radar { max-width: 460px; }
+.high { color: var(--high-risk); } .medium { color: var(--med-risk); } .low { color: var(--low-risk); }
+.rec { margin: 12px 0; }
+.rec h4 { margin: 0 0 2px; font-size: 15px; }
+.rec h4 span { color: var(--text-muted); font-size: 11px; font-weight: normal; }
+.rec p { margin: 0 0 0 10px; }
+.confidential { color: var(--neutral); font-size: 12px; font-weight: bold; }
+footer { border-top: 1px solid var(--border); padding-top: 12px; text-align: center;
+         color: var(--text-muted); font-size: 12px; }
+@media print { body { background: #fff; } .report { max-width: none; } section { break-inside: avoid-page; } }
+"""
+
+_report_format = None
+
+
+def configure_report_format(name):
+    """Задает формат отчетов для процесса и его воркеров; None — PDF"""
+    global _report_format
+    os.environ[REPORT_FORMAT_ENV] = name or 'pdf'
+    _report_format = None
+
+
+def report_format():
+    global _report_format
+    if _report_format is None:
+        name = os.environ.get(REPORT_FORMAT_ENV)
+        _report_format = name if name in REPORT_FORMATS else 'pdf'
+    return _report_format
+
+
+def _tint(hex_color, alpha):
+    """Цвет hex_color с прозрачностью alpha на белом фоне (SVG-шаблоны без наложений)"""
+    channels = [int(hex_color[i:i + 2], 16) for i in (1, 3, 5)]
+    return '#' + ''.join(f"{round(255 - (255 - channel) * alpha):02X}" for channel in channels)
+
+
+def _svg_text(x, y, text, size, anchor='middle', weight='normal', color=TEXT_DARK_HEX, rotate=0,
+              line_height=1.2):
+    """Текст SVG; переводы строк становятся строками tspan"""
+    lines = text.split('\n')
+    first_dy = -(len(lines) - 1) * line_height / 2
+    spans = ''.join(f'<tspan x="{x:.1f}" dy="{first_dy if i == 0 else line_height}em">{escape(line)}</tspan>'
+                    for i, line in enumerate(lines))
+    transform = f' transform="rotate({rotate} {x:.1f} {y:.1f})"' if rotate else ''
+    return (f'<text x="{x:.1f}" y="{y:.1f}" font-size="{size}" text-anchor="{anchor}" font-weight="{weight}" '
+            f'fill="{color}" dominant-baseline="middle"{transform}>{spans}</text>')
+
+
+def _radar_point(index, value, count=5):
+    angle = -math.pi / 2 + 2 * math.pi * index / count
+    radius = RADAR_RADIUS * value / 100
+    return RADAR_CENTER[0] + radius * math.cos(angle), RADAR_CENTER[1] + radius * math.sin(angle)
+
+
+def radar_template_svg():
+    """Общая подложка радарной диаграммы: зоны риска, сетка, подписи осей"""
+    center_x, center_y = RADAR_CENTER
+    labels = ('Дегенеративный\n(суставы)', 'Позвоночный\n(осанка)', 'Травматический\n(риск травм)',
+              'Комфорт\n(обувь)', 'Прогрессия\n(деформация)')
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {RADAR_SIZE} {RADAR_SIZE}" '
+             f'font-family="DejaVu Sans, Arial, sans-serif">',
+             f'<rect width="{RADAR_SIZE}" height="{RADAR_SIZE}" fill="white"/>']
+    for limit, color in ((100, HIGH_RISK_HEX), (70, MED_RISK_HEX), (40, LOW_RISK_HEX)):
+        parts.append(f'<circle cx="{center_x}" cy="{center_y}" r="{RADAR_RADIUS * limit / 100:.1f}" '
+                     f'fill="{_tint(color, 0.1)}"/>')
+    for limit in (25, 50, 75, 100):
+        parts.append(f'<circle cx="{center_x}" cy="{center_y}" r="{RADAR_RADIUS * limit / 100:.1f}" fill="none" '
+                     f'stroke="{BORDER_COLOR_HEX}" stroke-dasharray="3 3"/>')
+        parts.append(_svg_text(center_x + 3, center_y - RADAR_RADIUS * limit / 100, str(limit), 9,
+                               anchor='start', color=TEXT_MUTED_HEX))
+    for index, label in enumerate(labels):
+        x, y = _radar_point(index, 100)
+        parts.append(f'<line x1="{center_x}" y1="{center_y}" x2="{x:.1f}" y2="{y:.1f}" '
+                     f'stroke="{BORDER_COLOR_HEX}"/>')
+        label_x, label_y = _radar_point(index, 124)
+        parts.append(_svg_text(label_x, label_y, label, 11))
+    parts.append(_svg_text(center_x, 18, 'Профиль биомеханических рисков', 14, weight='bold',
+                           color=PRIMARY_DARK_HEX))
+    parts.append('</svg>')
+    return ''.join(parts)
+
+
+def comparison_scale(values):
+    """Верх оси сравнительной диаграммы: кратен 50, чтобы подложка повторялась между отчетами"""
+    return max(50, math.ceil(max(values) / 50) * 50)
+
+
+def comparison_template_svg(y_max):
+    """Общая подложка сравнительной диаграммы для шкалы 0..y_max"""
+    left, top, right, bottom = COMPARISON_PLOT
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {COMPARISON_WIDTH} {COMPARISON_HEIGHT}" '
+             f'font-family="DejaVu Sans, Arial, sans-serif">',
+             f'<rect width="{COMPARISON_WIDTH}" height="{COMPARISON_HEIGHT}" fill="white"/>']
+    for tick in range(0, y_max + 1, 50):
+        y = bottom - (bottom - top) * tick / y_max
+        parts.append(f'<line x1="{left}" y1="{y:.1f}" x2="{right}" y2="{y:.1f}" stroke="{BORDER_COLOR_HEX}" '
+                     f'stroke-dasharray="3 3"/>')
+        parts.append(_svg_text(left - 6, y, str(tick), 10, anchor='end', color=TEXT_MUTED_HEX))
+    parts.append(f'<line x1="{left}" y1="{bottom}" x2="{right}" y2="{bottom}" stroke="{TEXT_MUTED_HEX}"/>')
+    group_width = (right - left) / len(COMPARISON_CATEGORIES)
+    for index, label in enumerate(COMPARISON_CATEGORIES):
+        parts.append(_svg_text(left + group_width * (index + 0.5), bottom + 26, label, 11))
+    parts.append(_svg_text(18, (top + bottom) / 2, 'Значение', 11, weight='bold', rotate=-90))
+    parts.append(_svg_text(COMPARISON_WIDTH / 2, 22, 'Сравнительный анализ стоп', 14, weight='bold',
+                           color=PRIMARY_DARK_HEX))
+    for index, (label, color) in enumerate((('Левая стопа', MATPLOT_PRIMARY), ('Правая стопа', MATPLOT_SECONDARY))):
+        y = top + 4 + index * 18
+        parts.append(f'<rect x="{right - 120}" y="{y - 5}" width="16" height="10" fill="{color}"/>')
+        parts.append(_svg_text(right - 98, y, label, 11, anchor='start'))
+    parts.append('</svg>')
+    return ''.join(parts)
+
+
+@lru_cache(maxsize=None)
+def html_asset_version():
+    """Версия оформления: меняется вместе со стилями и подложками графиков"""
+    payload = json.dumps([TEMPLATE_VERSION, HTML_CSS, radar_template_svg(), comparison_template_svg(300)])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:10]
+
+
+def _write_asset(path, text=None, source=None):
+    """Записывает общий файл, если его еще нет; параллельные воркеры не мешают друг другу"""
+    if os.path.exists(path):
+        return
+    with atomic_path(path) as temp_path:
+        if source:
+            shutil.copyfile(source, temp_path)
+        else:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
 
-    debug_dirs = ["extracted_data_debug", "generated_reports_debug", "temp_graphs"]
-    for dir_name in debug_dirs:
-        if not os.path.exists(dir_name):
-            os.makedirs(dir_name, exist_ok=True)
 
-    pdf_patterns = [
-        os.path.join(students_dir, "*.pdf"),
-        os.path.join(students_dir, "*_Report.pdf"),
-        os.path.join(current_dir, "*.pdf"),
-        os.path.join(reports_dir, "*.pdf")
-    ]
+def ensure_html_assets(output_dir, comparison_max=None):
+    """Создает недостающие общие файлы отчетов в output_dir; возвращает их путь относительно output_dir
 
-    pdf_files = []
-    for pattern in pdf_patterns:
-        found_files = glob.glob(pattern)
-        for file in found_files:
-            if file not in pdf_files and os.path.getsize(file) > 1000:
-                pdf_files.append(file)
+    Имя папки содержит версию оформления, поэтому файлы можно отдавать
+    статическим сервером с долгим кэшированием.
+    """
+    relative = f"{HTML_ASSETS_DIR}/{html_asset_version()}"
+    assets_dir = os.path.join(output_dir, HTML_ASSETS_DIR, html_asset_version())
+    os.makedirs(assets_dir, exist_ok=True)
+
+    palette = {
+        'bg-light': '#F8F9FA', 'text-dark': TEXT_DARK_HEX, 'text-muted': TEXT_MUTED_HEX,
+        'primary-blue': PRIMARY_BLUE_HEX, 'primary-dark': PRIMARY_DARK_HEX, 'high-risk': HIGH_RISK_HEX,
+        'med-risk': MED_RISK_HEX, 'low-risk': LOW_RISK_HEX, 'neutral': NEUTRAL_HEX,
+        'border': BORDER_COLOR_HEX, 'light-blue-bg': LIGHT_BLUE_BG_HEX,
+    }
+    root_rules = ":root { " + " ".join(f"--{name}: {value};" for name, value in palette.items()) + " }\n"
+    _write_asset(os.path.join(assets_dir, 'report.css'), root_rules + HTML_CSS.lstrip())
+    _write_asset(os.path.join(assets_dir, 'radar.svg'), radar_template_svg())
+    if comparison_max:
+        _write_asset(os.path.join(assets_dir, f'comparison_{comparison_max}.svg'),
+                     comparison_template_svg(comparison_max))
+    for font_path in (BUNDLED_FONT, BUNDLED_BOLD_FONT):
+        if os.path.exists(font_path):
+            _write_asset(os.path.join(assets_dir, os.path.basename(font_path)), source=font_path)
+    logo_path = create_logo()
+    if os.path.exists(logo_path):
+        _write_asset(os.path.join(assets_dir, 'logo.png'), source=logo_path)
+    return relative
+
+
+def radar_chart_svg(risk_scores, assets):
+    """Радарная диаграмма: подложка из общих файлов и данные пациента"""
+    keys = ('degenerative', 'spinal', 'traumatic', 'comfort', 'progression')
+    points = [_radar_point(index, risk_scores[key]) for index, key in enumerate(keys)]
+    polygon = ' '.join(f"{x:.1f},{y:.1f}" for x, y in points)
+    parts = [f'<svg class="chart radar" viewBox="0 0 {RADAR_SIZE} {RADAR_SIZE}" role="img" '
+             f'aria-label="Профиль биомеханических рисков" font-family="DejaVu Sans, Arial, sans-serif">',
+             f'<image href="{assets}/radar.svg" width="{RADAR_SIZE}" height="{RADAR_SIZE}"/>',
+             f'<polygon points="{polygon}" fill="{MATPLOT_PRIMARY}" fill-opacity="0.15" '
+             f'stroke="{MATPLOT_PRIMARY}" stroke-width="2"/>']
+    for index, ((x, y), key) in enumerate(zip(points, keys)):
+        parts.append(f'<circle cx="{x:.1f}" cy="{y:.1f}" r="4" fill="white" stroke="{MATPLOT_PRIMARY}" '
+                     f'stroke-width="1.5"/>')
+        label_x, label_y = _radar_point(index, risk_scores[key] + 8)
+        parts.append(_svg_text(label_x, label_y, f"{risk_scores[key]:.0f}", 10, weight='bold'))
+    parts.append('</svg>')
+    return ''.join(parts)
+
+
+def comparison_values(data):
+    """Значения столбцов (левая, правая стопа) в порядке COMPARISON_CATEGORIES"""
+    pairs = (data.foot_length, data.foot_width, data.arch_index, data.heel_angle, data.hallux_angle)
+    scales = (1, 1, 100, 1, 1)
+    return tuple([getattr(pair, side) * scale for pair, scale in zip(pairs, scales)] for side in ('left', 'right'))
+
+
+def comparison_chart_svg(data, assets):
+    """Сравнительная диаграмма: подложка из общих файлов и столбцы пациента"""
+    left_values, right_values = comparison_values(data)
+    y_max = comparison_scale(left_values + right_values)
+    left, top, right, bottom = COMPARISON_PLOT
+    group_width = (right - left) / len(COMPARISON_CATEGORIES)
+    bar_width = group_width * 0.35
+
+    parts = [f'<svg class="chart" viewBox="0 0 {COMPARISON_WIDTH} {COMPARISON_HEIGHT}" role="img" '
+             f'aria-label="Сравнительный анализ стоп" font-family="DejaVu Sans, Arial, sans-serif">',
+             f'<image href="{assets}/comparison_{y_max}.svg" width="{COMPARISON_WIDTH}" '
+             f'height="{COMPARISON_HEIGHT}"/>']
+    for values, color, offset in ((left_values, MATPLOT_PRIMARY, -1), (right_values, MATPLOT_SECONDARY, 0)):
+        for index, value in enumerate(values):
+            height = (bottom - top) * max(value, 0) / y_max
+            x = left + group_width * (index + 0.5) + offset * bar_width
+            parts.append(f'<rect x="{x:.1f}" y="{bottom - height:.1f}" width="{bar_width:.1f}" '
+                         f'height="{height:.1f}" fill="{color}" fill-opacity="0.85"/>')
+            parts.append(_svg_text(x + bar_width / 2, bottom - height - 8, f"{value:.1f}", 9, weight='bold'))
+    parts.append('</svg>')
+    return ''.join(parts)
+
+
+RISK_LEVEL_TEXT = {'high': 'ВЫСОКИЙ', 'medium': 'УМЕРЕННЫЙ', 'low': 'НИЗКИЙ'}
+
+
+def _risk_class(score):
+    return 'high' if score >= 70 else 'medium' if score >= 50 else 'low'
+
+
+def _html_table(headers, rows, css_class='data', row_classes=None):
+    """rows — списки ячеек; ячейка — текст или (текст, css-класс). Текст уже экранирован"""
+    parts = [f'<table class="{css_class}"><thead><tr>']
+    parts += [f'<th>{header}</th>' for header in headers]
+    parts.append('</tr></thead><tbody>')
+    for index, row in enumerate(rows):
+        row_class = row_classes[index] if row_classes else ''
+        parts.append(f'<tr class="{row_class}">' if row_class else '<tr>')
+        for cell in row:
+            text, cell_class = cell if isinstance(cell, tuple) else (cell, '')
+            parts.append(f'<td class="{cell_class}">{text}</td>' if cell_class else f'<td>{text}</td>')
+        parts.append('</tr>')
+    parts.append('</tbody></table>')
+    return ''.join(parts)
+
+
+def build_html_trend_section(previous_scans, data, risk_scores, number):
+    """Раздел динамики в HTML: те же данные, что и build_trend_section"""
+    current = {metric: list(getattr(data, metric)) for metric in HISTORY_METRICS}
+    current.update(scan_date=data.scan_date, risk_scores=risk_scores)
+    scans = previous_scans[-TREND_MAX_SCANS:] + [current]
+
+    rows = []
+    for scan in scans:
+        (length_left, length_right), (width_left, width_right) = scan['foot_length'], scan['foot_width']
+        (arch_left, arch_right), (hallux_left, hallux_right) = scan['arch_index'], scan['hallux_angle']
+        total = sum(scan['risk_scores'].values()) / len(scan['risk_scores'])
+        rows.append([escape(scan['scan_date']) + (" (текущее)" if scan is current else ""),
+                     f"{length_left:.1f} / {length_right:.1f}", f"{width_left:.1f} / {width_right:.1f}",
+                     f"{arch_left:.3f} / {arch_right:.3f}", f"{hallux_left:.1f} / {hallux_right:.1f}",
+                     f"{total:.1f}"])
+    table = _html_table(['Дата', 'Длина, мм<br>Л / П', 'Ширина, мм<br>Л / П', 'Индекс свода<br>Л / П',
+                         'Угол пальца, °<br>Л / П', 'Общий риск'], rows,
+                        row_classes=[''] * (len(rows) - 1) + ['current'])
+
+    last = previous_scans[-1]
+    lines = [f"<p><b>Изменение рисков с {escape(last['scan_date'])}:</b></p>"]
+    for key, label in TREND_RISK_LABELS:
+        before, after = last['risk_scores'].get(key, 0), risk_scores[key]
+        delta = after - before
+        delta_class = 'high' if delta > 0 else 'low' if delta < 0 else 'muted'
+        lines.append(f'<p>• {label}: {before} → {after} (<span class="{delta_class}">{delta:+g}</span>)</p>')
+    first = previous_scans[0]
+    length_change = [now - then for now, then in zip(data.foot_length, first['foot_length'])]
+    lines.append(f"<p>• Длина стопы с {escape(first['scan_date'])}: "
+                 f"Л {length_change[0]:+.1f} мм, П {length_change[1]:+.1f} мм</p>")
+
+    return (f'<section><h2 class="section-title">{number}. ДИНАМИКА ПО ПРЕДЫДУЩИМ ОБСЛЕДОВАНИЯМ</h2>'
+            f'{table}<div class="boxed">{"".join(lines)}</div></section>')
+
+
+def build_report_html(data, risk_scores, recommendations, assets, previous_scans=None, percentiles=None):
+    """HTML страница отчета с теми же разделами, что и PDF (build_report_story)"""
+    client_name = escape(data.client_name)
+    parts = ['<!DOCTYPE html><html lang="ru"><head><meta charset="utf-8">',
+             '<meta name="viewport" content="width=device-width, initial-scale=1">',
+             f'<title>FootScan Analytics - Отчет для {client_name}</title>',
+             f'<link rel="stylesheet" href="{assets}/report.css"></head><body><main class="report">']
 
-    pdf_files.sort()
+    # ==================== ТИТУЛЬНАЯ СТРАНИЦА ====================
+    patient_rows = (('Пациент', client_name), ('Пол', escape(data.gender)),
+                    ('Дата обследования', escape(data.scan_date)),
+                    ('ID отчета', f"FSA-{datetime.now().strftime('%Y%m%d%H%M')}"),
+                    ('Сканер', escape(data.scanner_id)))
+    parts.append(
+        f'<section class="cover"><img class="logo" src="{assets}/logo.png" alt="">'
+        '<h1 class="company">FootScan Analytics</h1><p class="muted">Цифровая лаборатория здоровья стоп</p>'
+        '<h2 class="report-title">ПЕРСОНАЛИЗИРОВАННЫЙ ОТЧЕТ</h2><p>Биомеханический анализ стоп</p>'
+        '<table class="patient">'
+        + ''.join(f'<tr><th>{label}</th><td>{value}</td></tr>' for label, value in patient_rows)
+        + '</table><div class="boxed"><p><b>Данный отчет содержит:</b></p>'
+        '<p>• Детальный анализ биомеханических параметров ваших стоп</p>'
+        '<p>• Оценку индивидуальных рисков для здоровья</p>'
+        '<p>• Персонализированные рекомендации по подбору обуви</p>'
+        '<p>• Советы по поддержанию здоровья стоп и профилактике</p></div>'
+        '<p class="confidential">КОНФИДЕНЦИАЛЬНЫЙ МЕДИЦИНСКИЙ ДОКУМЕНТ<br>'
+        'Предназначен только для пациента и лечащего врача</p></section>')
+
+    # ==================== АНАЛИЗ РИСКОВ ====================
+    risk_rows = []
+    for key, name, description in RISK_CATEGORY_INFO:
+        score = risk_scores[key]
+        risk_class = _risk_class(score)
+        risk_rows.append([f"<b>{name}</b><small>{description}</small>",
+                          (f"<b>{score}/100</b>", risk_class), (f"<b>{RISK_LEVEL_TEXT[risk_class]}</b>", risk_class)])
+    total_risk = sum(risk_scores.values()) / len(risk_scores)
+    total_class = _risk_class(total_risk)
+    parts.append(
+        '<section><h2 class="section-title">1. АНАЛИЗ БИОМЕХАНИЧЕСКИХ РИСКОВ</h2>'
+        '<p>На основе анализа параметров ваших стоп, система определила индивидуальный профиль рисков. '
+        'Уровень риска оценивается по шкале от 0 до 100 баллов, где:<br>'
+        '• <b class="low">0-49</b> — низкий риск<br>• <b class="medium">50-69</b> — умеренный риск<br>'
+        '• <b class="high">70-100</b> — высокий риск</p>'
+        '<p>Рекомендуется обратить особое внимание на категории с оценкой выше 50 баллов.</p>'
+        + radar_chart_svg(risk_scores, assets)
+        + _html_table(['Категория риска', 'Оценка', 'Уровень'], risk_rows, css_class='data risk')
+        + f'<div class="boxed"><p><b>Общая оценка:</b> <span class="{total_class}">'
+        f'{RISK_LEVEL_TEXT[total_class]}</span> ({total_risk:.1f}/100)</p>'
+        '<p class="muted">На основе анализа всех параметров стопы</p></div></section>')
+
+    # ==================== ДЕТАЛЬНЫЙ АНАЛИЗ ====================
+    norms = norm_tables().lookup(data)
+    params_rows = []
+    for param, label, unit, precision in (('foot_length', 'Длина стопы (мм)', ' мм', '.1f'),
+                                          ('foot_width', 'Ширина стопы (мм)', ' мм', '.1f'),
+                                          ('ball_girth', 'Обхват плюсны (мм)', ' мм', '.1f'),
+                                          ('arch_index', 'Индекс свода', '', '.3f'),
+                                          ('heel_angle', 'Угол пятки (°)', '°', ''),
+                                          ('hallux_angle', 'Угол пальца (°)', '°', '.1f')):
+        low, high = norms[param]
+        params_rows.append([label] + [
+            (format(value, precision), 'out-of-norm' if abs(value) < low or abs(value) > high else '')
+            for value in getattr(data, param)] + [f"{low:g}-{high:g}{unit}"])
+    params_rows.append(['Размер обуви (EU)', f"{data.shoe_size.left:.1f}", f"{data.shoe_size.right:.1f}",
+                        shoe_size_source(data)])
+    params_rows.append(['Тип стопы', escape(data.toe_type), escape(data.toe_type), '-'])
+
+    length_diff = abs(data.foot_length.left - data.foot_length.right)
+    width_diff = abs(data.foot_width.left - data.foot_width.right)
+
+    sizes = convert_shoe_sizes(list(data.foot_length), list(data.foot_width))
+    sizes_rows = [[label, *(format_shoe_size(system, value, child)
+                            for value, child in zip(sizes[system], sizes['child']))]
+                  for system, label in SHOE_SIZE_SYSTEMS]
+    sizes_rows.append(['Полнота (по ширине)', *(letter or '—' for letter in sizes['width'])])
+
+    parts.append(
+        '<section><h2 class="section-title">2. ДЕТАЛЬНЫЙ БИОМЕХАНИЧЕСКИЙ АНАЛИЗ</h2>'
+        + comparison_chart_svg(data, assets)
+        + '<h3>Измеренные параметры стоп:</h3>'
+        + _html_table(['Параметр', 'Левая стопа', 'Правая стопа', 'Норма'], params_rows)
+        + '<div class="boxed"><p><b>Анализ асимметрии:</b></p>'
+        f"<p>• Разница в длине: {length_diff:.1f} мм ({'норма' if length_diff <= 3 else 'требует внимания'})</p>"
+        f"<p>• Разница в ширине: {width_diff:.1f} мм ({'норма' if width_diff <= 2 else 'требует внимания'})</p>"
+        f"<p>• Тип стопы: {escape(data.toe_type)}</p>"
+        f"<p>• Рекомендуемая ширина обуви: {escape(data.shoe_width)}</p></div>"
+        '<h3>Размер обуви в разных системах (по длине стопы):</h3>'
+        + _html_table(['Система', 'Левая стопа', 'Правая стопа'], sizes_rows))
+
+    if percentiles:
+        group = "все обследованные" if percentiles['group'] == 'all' else escape(percentiles['group'].lower())
+        parts.append(f'<div class="boxed"><p><b>Положение в группе обследования</b> '
+                     f'({group}, {percentiles["size"]} чел.):</p>')
+        for metric, label in COHORT_METRICS:
+            left_pct, right_pct = percentiles['metrics'][metric]
+            parts.append(f"<p>• {label}: Л — {left_pct}-й, П — {right_pct}-й перцентиль</p>")
+        parts.append('</div>')
+    parts.append('</section>')
+
+    # ==================== ДИНАМИКА ====================
+    section_number = 3
+    if previous_scans:
+        parts.append(build_html_trend_section(previous_scans, data, risk_scores, section_number))
+        section_number += 1
 
-    print(f"\n📁 НАЙДЕНО PDF ФАЙЛОВ: {len(pdf_files)}")
-    if pdf_files:
-        for i, pdf_file in enumerate(pdf_files, 1):
-            size_kb = os.path.getsize(pdf_file) / 1024
-            print(f"  {i:2d}. {os.path.basename(pdf_file)} ({size_kb:.1f} KB)")
-    else:
-        print("\n[ERROR] Не найдено ни одного PDF файла!")
-        print("[INFO] Поместите PDF файлы в папку:")
-        print(f"  • {students_dir}")
+    # ==================== РЕКОМЕНДАЦИИ ====================
+    parts.append(f'<section><h2 class="section-title">{section_number}. ПЕРСОНАЛИЗИРОВАННЫЕ РЕКОМЕНДАЦИИ</h2>'
+                 '<p>На основе анализа ваших данных сформированы следующие рекомендации:</p>')
+    for rec in recommendations:
+        priority_class, priority_text = {'high': ('high', 'Высокий приоритет'),
+                                         'medium': ('medium', 'Средний приоритет')}.get(
+            rec['priority'], ('low', 'Общие рекомендации'))
+        parts.append(f'<div class="rec"><h4 class="{priority_class}">{escape(rec["title"])} '
+                     f'<span>[{priority_text}]</span></h4><p>{escape(rec["description"])}</p></div>')
+    parts.append(f'<div class="boxed"><p><b>Важно:</b> Данные рекомендации составлены на основе анализа от '
+                 f'{escape(data.scan_date)}. При появлении болей, дискомфорта или изменений в походке '
+                 f'обязательно обратитесь к врачу-ортопеду.</p></div></section>')
 
-        manual_path = input("\nВведите путь к PDF файлу (или нажмите Enter для выхода): ").strip()
-        if manual_path and os.path.exists(manual_path):
-            pdf_files = [manual_path]
-        else:
-            print("[INFO] Выход из программы")
-            return
+    # ==================== ПОДВАЛ ====================
+    parts.append(
+        '<footer><p><b>FootScan Analytics</b><br>Цифровая лаборатория здоровья стоп</p>'
+        f"<p>Отчет сгенерирован автоматически {datetime.now().strftime('%d.%m.%Y %H:%M')}. "
+        'Данный документ носит рекомендательный характер и не заменяет консультацию специалиста.<br>'
+        f'ID сканера: {escape(data.scanner_id)} | Пациент: {client_name}<br>'
+        '© 2024 FootScan Analytics. Все права защищены.</p></footer></main></body></html>')
+    return ''.join(parts)
+
+
+def create_html_report(data, risk_scores, recommendations, output_filename, percentiles=None):
+    """Создает HTML отчет для быстрого просмотра; общие файлы кладутся рядом один раз"""
+    history = patient_history()
+    previous_scans = history.previous_scans(data.to_dict()) if history else []
+
+    output_dir = os.path.dirname(os.path.abspath(output_filename))
+    with pipeline_stage('html'):
+        left_values, right_values = comparison_values(data)
+        assets = ensure_html_assets(output_dir, comparison_scale(left_values + right_values))
+        page = build_report_html(data, risk_scores, recommendations, assets,
+                                 previous_scans=previous_scans, percentiles=percentiles)
+        with atomic_path(output_filename) as temp_path:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(page)
+    print(f"[SUCCESS] HTML отчет создан: {output_filename}")
+    return output_filename
 
-    processed_count = 0
-    failed_count = 0
-    results = []
 
-    print(f"\n{'=' * 70}")
-    print("🚀 НАЧАЛО ОБРАБОТКИ ФАЙЛОВ")
-    print('=' * 70)
+# ============================================================================
+# 17. ЭТАПЫ КОНВЕЙЕРА И ПАМЯТЬ
+# ============================================================================
 
-    for pdf_index, pdf_file in enumerate(pdf_files, 1):
-        print(f"\n{'=' * 60}")
-        print(f"🔄 ОБРАБОТКА ФАЙЛА {pdf_index}/{len(pdf_files)}")
-        print(f"📄 Файл: {os.path.basename(pdf_file)}")
-        print(f"📏 Размер: {os.path.getsize(pdf_file) / 1024:.1f} KB")
-        print('=' * 60)
+# Наблюдатели этапов (память, профилирование); пустой список — нулевая стоимость
+STAGE_HOOKS = []
 
-        try:
-            # Извлечение данных ИСКЛЮЧИТЕЛЬНО из PDF
-            data = extract_data_from_pdf(pdf_file)
 
-            # Проверка минимальных данных
-            if data['foot_length']['left'] == 0:
-                print(f"\n[ERROR] Не удалось извлечь данные из PDF!")
-                print("[INFO] Проблема с чтением PDF файла")
-                failed_count += 1
-                continue
+@contextmanager
+def pipeline_stage(name):
+    """Отмечает этап конвейера для подключенных наблюдателей"""
+    if not STAGE_HOOKS:
+        yield
+        return
 
-            # Расчет рисков
-            risk_scores, recommendations = calculate_risk_scores(data)
+    for hook in STAGE_HOOKS:
+        hook.enter(name)
+    try:
+        yield
+    finally:
+        for hook in reversed(STAGE_HOOKS):
+            hook.exit(name)
 
-            # Создание имени выходного файла
-            safe_name = re.sub(r'[^\w\s-]', '', data['client_name'])
-            safe_name = re.sub(r'[-\s]+', '_', safe_name).strip('-_')
 
-            if not safe_name:
-                safe_name = f"patient_{pdf_index}"
+def _proc_status_mb(field):
+    """Читает поле памяти из /proc/self/status в МБ (только Linux)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
 
-            output_filename = os.path.join(
-                students_result_dir,
-                f"FootScan_Report_{safe_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-            )
 
-            # Генерация PDF отчета
-            report_path = create_pdf_report(data, risk_scores, recommendations, output_filename)
+def current_rss_mb():
+    """Текущий резидентный объем памяти процесса, МБ"""
+    rss = _proc_status_mb('VmRSS')
+    if rss is None and resource is not None:
+        # Без /proc доступен только пик за все время жизни процесса
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss = peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    return rss or 0.0
 
-            # Сохранение метаданных
-            result_data = {
-                'input_pdf': os.path.basename(pdf_file),
-                'output_pdf': os.path.basename(report_path),
-                'client_name': data['client_name'],
-                'scan_date': data['scan_date'],
-                'foot_length_left': data['foot_length']['left'],
-                'foot_length_right': data['foot_length']['right'],
-                'total_risk': sum(risk_scores.values()) / len(risk_scores),
-                'generated_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'file_size': os.path.getsize(report_path) if os.path.exists(report_path) else 0
-            }
 
-            results.append(result_data)
-            processed_count += 1
+def peak_rss_mb():
+    """Пиковый резидентный объем памяти с последнего сброса, МБ"""
+    peak = _proc_status_mb('VmHWM')
+    return peak if peak is not None else current_rss_mb()
 
-            print(f"\n✅ УСПЕШНО ОБРАБОТАНО: {data['client_name']}")
-            print(f"📊 Результат сохранен в: {report_path}")
 
-        except Exception as e:
-            print(f"\n❌ ОШИБКА ПРИ ОБРАБОТКЕ {pdf_file}: {e}")
-            import traceback
-            traceback.print_exc()
-            failed_count += 1
+def reset_peak_rss():
+    """Сбрасывает счетчик пиковой памяти (Linux >= 4.0)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
 
-    # ==================== ИТОГИ ====================
-    print(f"\n{'=' * 70}")
-    print("📈 ИТОГИ ОБРАБОТКИ")
-    print('=' * 70)
 
-    print(f"✅ Успешно обработано: {processed_count} файлов")
-    print(f"❌ Не удалось обработать: {failed_count} файлов")
-    print(f"📂 Всего найдено: {len(pdf_files)} файлов")
+def release_render_caches():
+    """Освобождает кэши ReportLab и циклические ссылки PdfReader после файла"""
+    ImageReader._cache.clear()
+    gc.collect()
 
-    if results:
-        summary_file = os.path.join(students_result_dir,
-                                    f"processing_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt")
 
-        with open(summary_file, 'w', encoding='utf-8') as f:
-            f.write("=" * 70 + "\n")
-            f.write("FootScan Analytics - Итоги обработки\n")
-            f.write("=" * 70 + "\n\n")
-            f.write(f"Дата обработки: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n")
-            f.write(f"Успешно обработано: {processed_count} файлов\n")
-            f.write(f"Не удалось обработать: {failed_count} файлов\n")
-            f.write(f"Всего файлов: {len(pdf_files)}\n\n")
+class StageMemoryMonitor:
+    """Пиковая и установившаяся память процесса по этапам конвейера"""
 
-            f.write("=" * 70 + "\n")
-            f.write("ДЕТАЛЬНЫЕ РЕЗУЛЬТАТЫ:\n")
-            f.write("=" * 70 + "\n\n")
+    def __init__(self):
+        self.stages = {}
 
-            for i, result in enumerate(results, 1):
-                f.write(f"{i:2d}. {result['client_name']}\n")
-                f.write(f"    Входной файл: {result['input_pdf']}\n")
-                f.write(f"    Выходной файл: {result['output_pdf']}\n")
-                f.write(
-                    f"    Длина стопы: Л={result['foot_length_left']:.1f}мм, П={result['foot_length_right']:.1f}мм\n")
-                f.write(f"    Общий риск: {result['total_risk']:.1f}/100\n")
-                f.write(f"    Дата сканирования: {result['scan_date']}\n")
-                f.write(f"    Размер файла: {result['file_size']:,} байт\n")
-                f.write("-" * 50 + "\n")
+    def enter(self, name):
+        reset_peak_rss()
 
-        print(f"\n📋 Итоговый отчет сохранен в: {summary_file}")
+    def exit(self, name):
+        self.stages[name] = {
+            'peak_mb': round(peak_rss_mb(), 1),
+            'rss_mb': round(current_rss_mb(), 1)
+        }
 
-    print(f"\n📁 РЕЗУЛЬТАТЫ СОХРАНЕНЫ В:")
-    print(f"   Отчеты PDF: {os.path.abspath(students_result_dir)}")
-    print(f"   Извлеченные данные: {os.path.abspath('extracted_data_debug')}")
-    print(f"   Данные отчетов: {os.path.abspath('generated_reports_debug')}")
-    print(f"   Графики: {os.path.abspath('temp_graphs')}")
+    def collect(self):
+        """Возвращает замеры последней задачи и начинает новые"""
+        stages, self.stages = self.stages, {}
+        return {'rss_mb': round(current_rss_mb(), 1), 'stages': stages}
 
-    if os.path.exists(students_result_dir):
-        result_files = glob.glob(os.path.join(students_result_dir, "FootScan_Report_*.pdf"))
-        if result_files:
-            print(f"\n📄 СОЗДАННЫЕ ОТЧЕТЫ (первые 10):")
-            for i, file in enumerate(sorted(result_files)[:10], 1):
-                file_size = os.path.getsize(file) / 1024
-                print(f"  {i:2d}. {os.path.basename(file)} ({file_size:.1f} KB)")
 
-            if len(result_files) > 10:
-                print(f"  ... и еще {len(result_files) - 10} файлов")
+class StageMemoryStats:
+    """Сводка памяти по этапам за пакет: пик и установившийся уровень"""
 
-    print(f"\n{'=' * 70}")
-    print("🎉 ОБРАБОТКА ЗАВЕРШЕНА!")
-    print('=' * 70)
+    def __init__(self):
+        self.stages = {}
 
-    if sys.platform == "win32":
-        try:
-            os.startfile(os.path.abspath(students_result_dir))
-        except Exception:
-            pass
-    elif sys.platform == "darwin":
-        try:
-            import subprocess
-            subprocess.call(["open", os.path.abspath(students_result_dir)])
-        except Exception:
-            pass
+    def add(self, memory):
+        for name, values in (memory or {}).get('stages', {}).items():
+            stats = self.stages.setdefault(name, {'peak_mb': 0.0, 'rss_total_mb': 0.0, 'count': 0})
+            stats['peak_mb'] = max(stats['peak_mb'], values['peak_mb'])
+            stats['rss_total_mb'] += values['rss_mb']
+            stats['count'] += 1
+
+    def rows(self):
+        """(этап, пик МБ, установившийся МБ) в порядке появления этапов"""
+        return [(name, stats['peak_mb'], stats['rss_total_mb'] / stats['count'])
+                for name, stats in self.stages.items()]
 
 
 # ============================================================================
-# 9. ЗАПУСК ПРОГРАММЫ
+# 18. ПРОФИЛИРОВАНИЕ ЭТАПОВ
 # ============================================================================
 
-if __name__ == "__main__":
-    import argparse
+def profile_label(pdf_path):
+    """Метка файла для имен профилей"""
+    name = os.path.splitext(os.path.basename(pdf_path or 'task'))[0]
+    return re.sub(r'[^\w-]+', '_', name).strip('_') or 'task'
+
+
+class StageProfiler:
+    """cProfile и сэмплирующий профилировщик стеков по этапам конвейера"""
+
+    def __init__(self, output_dir, per_file=False, interval=0.005):
+        self.output_dir = output_dir
+        self.per_file = per_file
+        self.interval = interval
+        self.profiles = {}
+        self.stacks = {}
+        self._sampler = None
+        # Свое имя части: профилировщики фаз одного процесса не перезаписывают друг друга
+        self.part_name = f"{os.getpid()}_{uuid.uuid4().hex[:6]}"
+        os.makedirs(output_dir if per_file else os.path.join(output_dir, '.parts'), exist_ok=True)
+
+    def enter(self, name):
+        stop = threading.Event()
+        thread = threading.Thread(target=self._sample, args=(name, threading.get_ident(), stop), daemon=True)
+        self._sampler = (thread, stop)
+        thread.start()
+        self.profiles.setdefault(name, cProfile.Profile()).enable()
+
+    def exit(self, name):
+        self.profiles[name].disable()
+        thread, stop = self._sampler
+        stop.set()
+        thread.join()
+
+    def _sample(self, name, thread_id, stop):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            key = ';'.join([name] + frames[::-1])
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def _write_folded(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{stack} {count}\n")
+
+    def flush(self, label):
+        """Сохраняет профили: по файлу или накопительно для слияния в конце пакета"""
+        if self.per_file:
+            for stage, profile in self.profiles.items():
+                profile.dump_stats(os.path.join(self.output_dir, f"{label}.{stage}.prof"))
+            self._write_folded(os.path.join(self.output_dir, f"{label}.folded"))
+            self.profiles, self.stacks = {}, {}
+        else:
+            parts_dir = os.path.join(self.output_dir, '.parts')
+            for stage, profile in self.profiles.items():
+                profile.dump_stats(os.path.join(parts_dir, f"{self.part_name}.{stage}.prof"))
+            self._write_folded(os.path.join(parts_dir, f"{self.part_name}.folded"))
+
+
+def merge_profile_parts(output_dir, top=10):
+    """Сливает профили воркеров в batch.<этап>.prof и batch.folded"""
+    parts_dir = os.path.join(output_dir, '.parts')
+    if not os.path.isdir(parts_dir):
+        return
+
+    by_stage = {}
+    for path in sorted(glob.glob(os.path.join(parts_dir, '*.prof'))):
+        stage = os.path.basename(path).split('.', 1)[1][:-len('.prof')]
+        by_stage.setdefault(stage, []).append(path)
+
+    print(f"\n⏱️ ПРОФИЛИ ЭТАПОВ: {os.path.abspath(output_dir)}")
+    for stage, paths in by_stage.items():
+        stats = pstats.Stats(*paths, stream=sys.stdout)
+        stats.dump_stats(os.path.join(output_dir, f"batch.{stage}.prof"))
+        print(f"\n--- {stage}: {stats.total_tt:.2f} с ---")
+        stats.sort_stats('cumulative').print_stats(top)
+
+    stacks = {}
+    for path in glob.glob(os.path.join(parts_dir, '*.folded')):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                stack, count = line.rstrip('\n').rsplit(' ', 1)
+                stacks[stack] = stacks.get(stack, 0) + int(count)
+
+    with open(os.path.join(output_dir, 'batch.folded'), 'w', encoding='utf-8') as f:
+        for stack, count in stacks.items():
+            f.write(f"{stack} {count}\n")
+
+    shutil.rmtree(parts_dir, ignore_errors=True)
+
+
+class StageAllocationTracer:
+    """Снимки tracemalloc вокруг этапов: пик и основные места выделения памяти"""
+
+    FILTERS = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    )
 
-    parser = argparse.ArgumentParser(description='FootScan Analytics - Генератор медицинских отчетов')
-    parser.add_argument('--clean', action='store_true', help='Очистка временных файлов перед запуском')
-    parser.add_argument('--pdf', type=str, help='Путь к конкретному PDF файлу для обработки')
+    def __init__(self, output_dir, top=10, frames=1):
+        self.output_dir = output_dir
+        self.top = top
+        self.stages = []
+        self._before = None
+        os.makedirs(os.path.join(output_dir, '.parts'), exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def enter(self, name):
+        tracemalloc.reset_peak()
+        self._before = (tracemalloc.take_snapshot().filter_traces(self.FILTERS),
+                        tracemalloc.get_traced_memory()[0])
+
+    def exit(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot_before, size_before = self._before
+        snapshot_after = tracemalloc.take_snapshot().filter_traces(self.FILTERS)
+
+        top_sites = []
+        for stat in snapshot_after.compare_to(snapshot_before, 'lineno')[:self.top]:
+            frame = stat.traceback[0]
+            top_sites.append({
+                'site': f"{os.path.basename(frame.filename)}:{frame.lineno}",
+                'size_diff': stat.size_diff,
+                'count_diff': stat.count_diff
+            })
+
+        self.stages.append({
+            'stage': name,
+            'peak_bytes': peak - size_before,
+            'net_bytes': current - size_before,
+            'top': top_sites
+        })
 
-    args = parser.parse_args()
+    def flush(self, label):
+        """Дописывает замеры файла в часть журнала этого процесса"""
+        if not self.stages:
+            return
+        path = os.path.join(self.output_dir, '.parts', f"memprofile.{os.getpid()}.jsonl")
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'file': label, 'time': datetime.now().isoformat(timespec='seconds'),
+                                'stages': self.stages}, ensure_ascii=False) + "\n")
+        self.stages = []
+
+
+def merge_memprofile_parts(output_dir, top=5):
+    """Переносит замеры воркеров в memprofile.jsonl и печатает сводку по этапам"""
+    parts = sorted(glob.glob(os.path.join(output_dir, '.parts', 'memprofile.*.jsonl')))
+    if not parts:
+        return
+
+    peaks = {}
+    sites = {}
+    with open(os.path.join(output_dir, 'memprofile.jsonl'), 'a', encoding='utf-8') as out:
+        for path in parts:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    out.write(line)
+                    for stage in json.loads(line)['stages']:
+                        peaks[stage['stage']] = max(peaks.get(stage['stage'], 0), stage['peak_bytes'])
+                        stage_sites = sites.setdefault(stage['stage'], {})
+                        for site in stage['top']:
+                            stage_sites[site['site']] = stage_sites.get(site['site'], 0) + site['size_diff']
+            os.remove(path)
+
+    print(f"\n🧮 ВЫДЕЛЕНИЯ ПАМЯТИ ПО ЭТАПАМ: {os.path.abspath(output_dir)}")
+    for stage, peak in peaks.items():
+        print(f"   {stage}: пик {peak / 1024:.1f} КБ")
+        for site, size in sorted(sites[stage].items(), key=lambda item: -abs(item[1]))[:top]:
+            print(f"      {site:<40} {size / 1024:+.1f} КБ")
+
+
+def install_stage_hooks(profile_dir=None, profile_per_file=False, memprofile_dir=None):
+    """Подключает профилировщики этапов; возвращает список подключенных"""
+    hooks = []
+    if profile_dir:
+        hooks.append(StageProfiler(profile_dir, per_file=profile_per_file))
+    if memprofile_dir:
+        hooks.append(StageAllocationTracer(memprofile_dir))
+    STAGE_HOOKS.extend(hooks)
+    return hooks
+
+
+def flush_stage_hooks(hooks, pdf_path):
+    for hook in hooks:
+        hook.flush(profile_label(pdf_path))
 
-    if args.clean:
-        print("[INFO] Очистка временных файлов...")
-        for dir_name in ["temp_graphs", "extracted_data_debug", "generated_reports_debug"]:
-            if os.path.exists(dir_name):
-                import shutil
 
-                try:
-                    shutil.rmtree(dir_name)
-                    print(f"[INFO] Удалена папка: {dir_name}")
-                except Exception as e:
-                    print(f"[WARNING] Не удалось удалить {dir_name}: {e}")
+# ============================================================================
+# 19. ОБРАБОТКА ОДНОГО ФАЙЛА
+# ============================================================================
 
-    if args.pdf:
-        if os.path.exists(args.pdf):
-            print(f"Обработка указанного файла: {args.pdf}")
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            students_result_dir = os.path.join(current_dir, "students_result")
+def make_safe_name(client_name, fallback="patient"):
+    """Формирует безопасное имя файла из имени пациента"""
+    safe_name = re.sub(r'[^\w\s-]', '', client_name)
+    safe_name = re.sub(r'[-\s]+', '_', safe_name).strip('-_')
+    return safe_name or fallback
 
-            if not os.path.exists(students_result_dir):
-                os.makedirs(students_result_dir, exist_ok=True)
 
-            data = extract_data_from_pdf(args.pdf)
+def extract_and_score(pdf_path, result, debug_record):
+    """Извлечение данных и расчет рисков; None, если данных недостаточно (причина в result)"""
+    # Извлечение данных ИСКЛЮЧИТЕЛЬНО из PDF
+    data = extract_data_from_pdf(pdf_path, debug_record)
+    return score_scan(data, debug_record, result)
 
-            if data['foot_length']['left'] == 0:
-                print("[ERROR] Не удалось извлечь данные из PDF!")
-                print("[INFO] Проверьте структуру PDF файла")
-                sys.exit(1)
 
-            risk_scores, recommendations = calculate_risk_scores(data)
+def score_scan(data, debug_record, result):
+    """Проверка извлеченных данных и расчет рисков; в отладочный журнал пишется только сбой
 
-            safe_name = re.sub(r'[^\w\s-]', '', data['client_name'])
-            safe_name = re.sub(r'[-\s]+', '_', safe_name).strip('-_')
+    Успешная запись появляется после построения отчета (write_report_debug_record).
+    """
+    # Проверка минимальных данных
+    if data.foot_length.left == 0:
+        result['reason'] = "Не удалось извлечь данные из PDF"
+        write_debug_record(dict(debug_record, status='failed', data=data.to_dict(),
+                                generated=datetime.now().isoformat(timespec='seconds')))
+        return None
+
+    # Расчет рисков
+    with pipeline_stage('score'):
+        risk_scores, recommendations = calculate_risk_scores(data)
+    return data, risk_scores, recommendations
+
+
+def write_report_debug_record(debug_record, result):
+    """Запись журнала по итогу построения отчета: с именем отчета или с причиной сбоя"""
+    if result['status'] == 'ok':
+        write_debug_record(dict(debug_record, status='ok', output_pdf=result['output_pdf'],
+                                generated=datetime.now().isoformat(timespec='seconds'), **result['record']))
+    else:
+        write_debug_record(dict(debug_record, status='failed', reason=result['reason'],
+                                generated=datetime.now().isoformat(timespec='seconds')))
 
-            if not safe_name:
-                safe_name = "patient"
 
-            output_filename = os.path.join(
-                students_result_dir,
-                f"FootScan_Report_{safe_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-            )
+def scan_record(data, risk_scores, recommendations, debug_record):
+    """Запись сканирования для построения отчета позже
 
-            create_pdf_report(data, risk_scores, recommendations, output_filename)
+    Текст PDF в запись не входит: он сразу уходит в отладочный журнал (статус
+    extracted), а не пересылается вместе с записью между процессами.
+    """
+    record = {
+        'data': data.to_dict(),
+        'risk_scores': risk_scores,
+        'recommendations': recommendations,
+    }
+    write_debug_record(dict(debug_record, status='extracted', data=record['data'],
+                            generated=datetime.now().isoformat(timespec='seconds')))
+    return record
+
+
+def process_pdf_file(pdf_path, output_dir, fallback_name="patient"):
+    """Полный цикл обработки одного PDF: извлечение, расчет рисков, отчет"""
+    result = {
+        'status': 'failed',
+        'reason': '',
+        'input_pdf': os.path.basename(pdf_path),
+        'input_path': pdf_path
+    }
+
+    debug_record = {'input_pdf': result['input_pdf'], 'input_path': pdf_path}
+    scored = extract_and_score(pdf_path, result, debug_record)
+    if scored is None:
+        return result
+
+    data, risk_scores, recommendations = scored
+    build_report_result(data, risk_scores, recommendations, output_dir, fallback_name, result)
+    write_report_debug_record(debug_record, result)
+    return result
+
+
+def extract_scan_record(pdf_path, output_dir=None, fallback_name="patient"):
+    """Первая фаза пакета с дедупликацией: запись с данными и рисками, без отчета"""
+    result = {
+        'status': 'failed',
+        'reason': '',
+        'input_pdf': os.path.basename(pdf_path),
+        'input_path': pdf_path
+    }
+
+    debug_record = {'input_pdf': result['input_pdf'], 'input_path': pdf_path}
+    scored = extract_and_score(pdf_path, result, debug_record)
+    if scored is None:
+        return result
+
+    data, risk_scores, recommendations = scored
+    result.update({
+        'status': 'ok',
+        'client_name': data.client_name,
+        'scan_date': data.scan_date,
+        'source_mtime': os.path.getmtime(pdf_path),
+        'record': scan_record(data, risk_scores, recommendations, debug_record),
+        **dedupe_fields(data.to_dict()),
+    })
+    return result
+
+
+def iter_export_scans(pdf_path):
+    """Потоковый разбор выгрузки сеанса: результат как у extract_scan_record на каждого пациента"""
+    source = os.path.basename(pdf_path)
+    source_mtime = os.path.getmtime(pdf_path)
+    for first, last, text in split_export_pages(iter_pdf_pages(pdf_path)):
+        input_pdf = f"{source} [стр. {first}-{last}]"
+        result = {'status': 'failed', 'reason': '', 'input_pdf': input_pdf, 'input_path': pdf_path}
+        data = FootScanRecord()
+        with pipeline_stage('extract.parse'):
+            # Имя файла выгрузки к пациенту не относится, поэтому путь не передается
+            parse_scan_text(text, '', data)
+
+        debug_record = {'input_pdf': input_pdf, 'input_path': pdf_path, 'text': text}
+        scored = score_scan(data, debug_record, result)
+        if scored is not None:
+            data, risk_scores, recommendations = scored
+            result.update({
+                'status': 'ok',
+                'client_name': data.client_name,
+                'scan_date': data.scan_date,
+                'source_mtime': source_mtime,
+                'record': scan_record(data, risk_scores, recommendations, debug_record),
+                **dedupe_fields(data.to_dict()),
+            })
+        yield result
+
+
+def build_report_result(data, risk_scores, recommendations, output_dir, fallback_name, result, percentiles=None,
+                        record_history=True):
+    """Строит PDF отчет и дополняет result сведениями о нем
+
+    record_history=False — сканирование уже есть в истории пациентов (пересборка
+    сохраненной записи).
+    """
+    # Создание имени выходного файла
+    safe_name = make_safe_name(data.client_name, fallback_name)
+    output_format = report_format()
+    output_filename = os.path.join(
+        output_dir,
+        f"FootScan_Report_{safe_name}_{unique_stamp()}.{output_format}"
+    )
+
+    # Генерация отчета
+    create_report = create_html_report if output_format == 'html' else create_pdf_report
+    started = time.perf_counter()
+    report_path = create_report(data, risk_scores, recommendations, output_filename, percentiles=percentiles)
+    render_seconds = time.perf_counter() - started
+    if not os.path.exists(report_path):
+        result['reason'] = "Не удалось построить отчет"
+        return result
+
+    result.update({
+        'status': 'ok',
+        'output_pdf': os.path.basename(report_path),
+        'output_path': report_path,
+        'client_name': data.client_name,
+        'scan_date': data.scan_date,
+        'foot_length_left': data.foot_length.left,
+        'foot_length_right': data.foot_length.right,
+        'total_risk': sum(risk_scores.values()) / len(risk_scores),
+        'generated_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'file_size': os.path.getsize(report_path),
+        'output_profile': 'html' if output_format == 'html' else output_profile().name,
+        'render_seconds': round(render_seconds, 3),
+        'record': {
+            'data': data.to_dict(),
+            'risk_scores': risk_scores,
+            'recommendations': recommendations
+        }
+    })
+
+    history = patient_history() if record_history else None
+    if history:
+        history.add(result['record']['data'], risk_scores, input_pdf=result['input_pdf'])
+    return result
+
+
+def rerender_record(record, output_dir, pdf_path, fallback_name="patient", rescore=False, stored=False):
+    """Строит отчет по сохраненной записи без чтения исходного PDF
+
+    stored=True — запись взята из отладочного журнала: она уже есть там и в
+    истории пациентов, поэтому повторно не записывается.
+    """
+    result = {
+        'status': 'failed',
+        'reason': '',
+        'input_pdf': os.path.basename(pdf_path),
+        'input_path': record.get('input_path') or pdf_path
+    }
+
+    data = FootScanRecord.from_dict(record['data'])
+    if rescore:
+        with pipeline_stage('score'):
+            risk_scores, recommendations = calculate_risk_scores(data)
+    else:
+        risk_scores, recommendations = record['risk_scores'], record['recommendations']
+
+    build_report_result(data, risk_scores, recommendations, output_dir, fallback_name, result,
+                        percentiles=record.get('percentiles'), record_history=not stored)
+    if not stored:
+        write_report_debug_record({'input_pdf': result['input_pdf'], 'input_path': result['input_path']}, result)
+    return result
+
+
+# ============================================================================
+# 20. ПУЛ ПРОГРЕТЫХ ВОРКЕРОВ
+# ============================================================================
+
+# Классы приоритета: меньше — раньше получает свободный воркер
+PRIORITIES = {'interactive': 0, 'new': 1, 'backfill': 2}
+
+# Уступать ядра срочным отчетам, запущенным отдельными процессами
+PRIORITY_NICENESS = {'interactive': 0, 'new': 5, 'backfill': 10}
+
+
+class PoolSaturatedError(Exception):
+    """Очередь пула переполнена"""
+
+
+class WorkerCrashedError(Exception):
+    """Процесс-воркер завершился во время обработки задачи"""
+
+
+class TaskTimeoutError(Exception):
+    """Задача превысила лимит времени и воркер был остановлен"""
+
+
+def warm_up_worker():
+    """Прогревает процесс: шрифты, логотип, нормы, matplotlib"""
+    norm_tables()
+    normal_font, bold_font = register_fonts()
+    create_styles(normal_font, bold_font)
+    create_logo()
+    register_chart_fonts()
+
+    fig, ax = create_figure((1, 1))
+    ax.plot([0, 1], [0, 1])
+    ax.set_title('Прогрев')
+    fig.canvas.draw()
+
+
+def _address_space_bytes():
+    """Текущий объем виртуальной памяти процесса (только Linux)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _apply_memory_limit(memory_limit_mb):
+    """Ограничивает память воркера: базовый объем после прогрева + бюджет на файл"""
+    if resource is None:
+        print("[WARNING] Ограничение памяти недоступно на этой платформе")
+        return
+
+    baseline = _address_space_bytes()
+    if baseline is None:
+        print("[WARNING] Не удалось определить объем памяти воркера, лимит не установлен")
+        return
+
+    limit = baseline + memory_limit_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def lower_process_priority(priority):
+    """Понижает приоритет процесса в ОС для фоновых классов задач"""
+    niceness = PRIORITY_NICENESS[priority]
+    if niceness and hasattr(os, 'nice'):
+        try:
+            os.nice(niceness)
+        except OSError:
+            pass
+
+
+def _worker_loop(conn, warm, memory_limit_mb, profile_dir, profile_per_file, memprofile_dir, priority):
+    """Цикл процесса-воркера: получает задачи и возвращает результаты"""
+    lower_process_priority(priority)
+    monitor = StageMemoryMonitor()
+    STAGE_HOOKS.append(monitor)
+
+    if warm:
+        try:
+            warm_up_worker()
+        except Exception as e:
+            print(f"[WARNING] Прогрев воркера не удался: {e}")
+
+    profilers = install_stage_hooks(profile_dir, profile_per_file, memprofile_dir)
+
+    if memory_limit_mb:
+        _apply_memory_limit(memory_limit_mb)
+
+    conn.send(('ready', os.getpid()))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+
+        if message is None:
+            break
+
+        task_name, kwargs = message
+        try:
+            payload = WORKER_TASKS[task_name](**kwargs)
+            flush_stage_hooks(profilers, kwargs.get('pdf_path'))
+            release_render_caches()
+            memory = monitor.collect()
+            if isinstance(payload, dict):
+                payload['memory'] = memory
+            conn.send(('ok', payload, memory))
+        except MemoryError:
+            # После нехватки памяти состояние процесса ненадежно — воркер будет заменен
+            conn.send(('memory', f"Превышен лимит памяти ({memory_limit_mb} МБ)", None))
+            break
+        except Exception as e:
+            traceback.print_exc()
+            flush_stage_hooks(profilers, kwargs.get('pdf_path'))
+            release_render_caches()
+            conn.send(('error', f"{type(e).__name__}: {e}", monitor.collect()))
+
+    conn.close()
+
+
+class _Worker:
+    """Процесс-воркер и канал связи с ним"""
+
+    def __init__(self, ctx, warm, memory_limit_mb, profile_dir=None, profile_per_file=False,
+                 memprofile_dir=None, priority='interactive'):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_loop,
+                                   args=(child_conn, warm, memory_limit_mb, profile_dir, profile_per_file,
+                                         memprofile_dir, priority),
+                                   daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks_done = 0
+
+    def wait_ready(self):
+        status, pid = self.conn.recv()
+        return pid
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """Пул прогретых процессов с ограничением параллелизма и очередью ожидания
+
+    Свободный воркер получает ожидающая задача с наивысшим приоритетом
+    (PRIORITIES), при равном — пришедшая раньше. Выполняемые задачи не
+    прерываются: срочная задача ждет только окончания текущего файла.
+    priority задает класс процессов-воркеров в ОС (PRIORITY_NICENESS).
+    """
+
+    def __init__(self, size=None, max_queue=None, warm=True, task_timeout=None, memory_limit_mb=None,
+                 max_tasks_per_worker=None, rss_limit_mb=None, profile_dir=None, profile_per_file=False,
+                 memprofile_dir=None, priority='interactive'):
+        self.size = size or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.warm = warm
+        self.task_timeout = task_timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.rss_limit_mb = rss_limit_mb
+        self.profile_dir = profile_dir
+        self.profile_per_file = profile_per_file
+        self.memprofile_dir = memprofile_dir
+        self.priority = priority
+        self.recycled = 0
+        self._ctx = multiprocessing.get_context('spawn')
+        self._cond = threading.Condition()
+        self._idle = []
+        self._waiting = []
+        self._tickets = count()
+        self.queued = 0
+        self.queued_by_priority = dict.fromkeys(PRIORITIES, 0)
+        self.in_flight = 0
+        # Замены упавших воркеров, которые еще прогреваются, и замены, которые не удалось запустить
+        self._starting = 0
+        self._lost = 0
+        self._closed = False
+
+        print(f"[INFO] Запуск пула из {self.size} воркеров...")
+        started = time.perf_counter()
+        workers = [self._spawn() for _ in range(self.size)]
+        for worker in workers:
+            worker.wait_ready()
+        self._idle.extend(workers)
+        print(f"[SUCCESS] Пул готов за {time.perf_counter() - started:.1f} с")
+
+    def _spawn(self):
+        return _Worker(self._ctx, self.warm, self.memory_limit_mb, self.profile_dir, self.profile_per_file,
+                       self.memprofile_dir, self.priority)
+
+    def _acquire(self, priority):
+        with self._cond:
+            # Срочные задачи не отклоняются из-за переполненной фоновой очереди
+            if (not self._idle and priority != 'interactive'
+                    and self.max_queue is not None and self.queued >= self.max_queue):
+                raise PoolSaturatedError(f"В очереди уже {self.queued} задач")
+
+            ticket = (PRIORITIES[priority], next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            self.queued += 1
+            self.queued_by_priority[priority] += 1
+            try:
+                while not self._idle or self._waiting[0] != ticket:
+                    if self._lost >= self.size:
+                        raise WorkerCrashedError("Не осталось ни одного рабочего воркера")
+                    self._cond.wait()
+            finally:
+                self.queued -= 1
+                self.queued_by_priority[priority] -= 1
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                if self._idle and self._waiting:
+                    self._cond.notify_all()
+
+            self.in_flight += 1
+            return self._idle.pop()
+
+    def _release(self, worker):
+        with self._cond:
+            self.in_flight -= 1
+            self._idle.append(worker)
+            self._cond.notify_all()
+
+    def _retire(self, worker, graceful=False):
+        """Освобождает место воркера; замена запускается и прогревается в фоне
+
+        Задача не ждет прогрева нового процесса, а в _idle попадают только
+        готовые воркеры.
+        """
+        if not graceful:
+            worker.kill()
+        with self._cond:
+            self.in_flight -= 1
+            self._starting += 1
+        threading.Thread(target=self._replace, args=(worker, graceful), daemon=True).start()
+
+    def _replace(self, worker, graceful=False, attempts=3):
+        """Останавливает воркер и добавляет в пул новый прогретый процесс"""
+        if graceful:
+            worker.stop()
+        replacement = None
+        for attempt in range(1, attempts + 1):
+            if self._closed:
+                break
+            try:
+                replacement = self._spawn()
+                replacement.wait_ready()
+                break
+            except Exception as e:
+                print(f"[ERROR] Не удалось запустить воркер (попытка {attempt}/{attempts}): {e}")
+                if replacement is not None:
+                    replacement.kill()
+                    replacement = None
+                time.sleep(attempt)
+        if replacement is not None and self._closed:
+            replacement.stop()
+            replacement = None
+        with self._cond:
+            self._starting -= 1
+            if replacement is not None:
+                self._idle.append(replacement)
+            elif not self._closed:
+                self._lost += 1
+            self._cond.notify_all()
+
+    def _recycle_reason(self, worker, memory):
+        if self.max_tasks_per_worker and worker.tasks_done >= self.max_tasks_per_worker:
+            return f"{worker.tasks_done} задач"
+        if self.rss_limit_mb and memory and memory['rss_mb'] > self.rss_limit_mb:
+            return f"RSS {memory['rss_mb']:.0f} МБ > {self.rss_limit_mb} МБ"
+        return None
+
+    def run(self, task_name, priority='new', **kwargs):
+        """Выполняет задачу на свободном воркере, ожидая его в очереди по приоритету"""
+        worker = self._acquire(priority)
+        # None — воркер возвращается в пул; 'kill' или 'stop' — заменяется новым
+        retire = None
+        try:
+            try:
+                worker.conn.send((task_name, kwargs))
+                if not worker.conn.poll(self.task_timeout):
+                    retire = 'kill'
+                    raise TaskTimeoutError(f"Превышен лимит времени ({self.task_timeout} с)")
+                status, payload, memory = worker.conn.recv()
+            except (EOFError, OSError):
+                retire = 'kill'
+                raise WorkerCrashedError(f"Воркер завершился с кодом {worker.process.exitcode}")
+
+            worker.tasks_done += 1
+            if status == 'memory':
+                retire = 'kill'
+                raise MemoryError(payload)
+
+            reason = self._recycle_reason(worker, memory)
+            if reason:
+                print(f"[INFO] Перезапуск воркера pid={worker.process.pid}: {reason}")
+                retire = 'stop'
+                self.recycled += 1
+
+            if status == 'error':
+                raise RuntimeError(payload)
+            return payload
+        finally:
+            if retire:
+                self._retire(worker, graceful=(retire == 'stop'))
+            else:
+                self._release(worker)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            # Прогревающиеся замены должны успеть остановиться до выхода процесса
+            while self._starting:
+                self._cond.wait()
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            worker.stop()
+
+
+def run_supervised(pool, pdf_path, output_dir, fallback_name="patient", priority='new', task_name='process_pdf',
+                   **task_kwargs):
+    """Обрабатывает файл в пуле; сбои, таймауты и нехватка памяти становятся результатом с причиной"""
+    try:
+        return pool.run(task_name, priority=priority, pdf_path=pdf_path, output_dir=output_dir,
+                        fallback_name=fallback_name, **task_kwargs)
+    except TaskTimeoutError as e:
+        reason = f"Таймаут: {e}"
+    except MemoryError as e:
+        reason = f"Память: {e}"
+    except WorkerCrashedError as e:
+        reason = f"Сбой воркера: {e}"
+    except Exception as e:
+        reason = f"Ошибка: {e}"
+
+    return {
+        'status': 'failed',
+        'reason': reason,
+        'input_pdf': os.path.basename(pdf_path),
+        'input_path': pdf_path
+    }
+
+
+def process_guarded(pdf_path, output_dir, fallback_name="patient", task_name='process_pdf'):
+    """Задача воркера в текущем процессе; исключение становится результатом с причиной"""
+    try:
+        return WORKER_TASKS[task_name](pdf_path=pdf_path, output_dir=output_dir, fallback_name=fallback_name)
+    except Exception as e:
+        traceback.print_exc()
+        return {'status': 'failed', 'reason': f"Ошибка: {e}",
+                'input_pdf': os.path.basename(pdf_path), 'input_path': pdf_path}
+
+
+def iter_batch_results(pdf_files, output_dir, workers, task_timeout=None, memory_limit_mb=None,
+                       max_tasks_per_worker=None, rss_limit_mb=None, profile_dir=None, profile_per_file=False,
+                       memprofile_dir=None, lease_queue=None, priority='new', task_name='process_pdf', pool=None):
+    """Обрабатывает пакет файлов и выдает (номер, файл, результат) по мере готовности
+
+    С lease_queue файлы берутся под аренду; занятые другими узлами и уже
+    обработанные пропускаются без результата. Переданный pool не закрывается.
+    """
+    if not workers:
+        lower_process_priority(priority)
+        monitor = StageMemoryMonitor()
+        STAGE_HOOKS.append(monitor)
+        profilers = install_stage_hooks(profile_dir, profile_per_file, memprofile_dir)
+        try:
+            for pdf_index, pdf_file in enumerate(pdf_files, 1):
+                task = (process_guarded, pdf_file, output_dir, f"patient_{pdf_index}", task_name)
+                if lease_queue:
+                    result = run_leased(lease_queue, pdf_file, *task)
+                else:
+                    result = process_guarded(*task[1:])
+                if result is None:
+                    continue
+                flush_stage_hooks(profilers, pdf_file)
+                release_render_caches()
+                result['memory'] = monitor.collect()
+                yield pdf_index, pdf_file, result
+        finally:
+            for hook in [monitor] + profilers:
+                STAGE_HOOKS.remove(hook)
+        return
+
+    own_pool = pool is None
+    if own_pool:
+        pool = WorkerPool(size=min(workers, len(pdf_files)), task_timeout=task_timeout,
+                          memory_limit_mb=memory_limit_mb, max_tasks_per_worker=max_tasks_per_worker,
+                          rss_limit_mb=rss_limit_mb, profile_dir=profile_dir, profile_per_file=profile_per_file,
+                          memprofile_dir=memprofile_dir, priority=priority)
+    try:
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            futures = {}
+            for pdf_index, pdf_file in enumerate(pdf_files, 1):
+                task = (run_supervised, pool, pdf_file, output_dir, f"patient_{pdf_index}", priority, task_name)
+                future = (executor.submit(run_leased, lease_queue, pdf_file, *task) if lease_queue
+                          else executor.submit(*task))
+                futures[future] = (pdf_index, pdf_file)
+            for future in as_completed(futures):
+                pdf_index, pdf_file = futures[future]
+                result = future.result()
+                if result is not None:
+                    yield pdf_index, pdf_file, result
+    finally:
+        if own_pool:
+            pool.close()
+
+
+WORKER_TASKS = {
+    'extract_pdf': extract_scan_record,
+    'process_pdf': process_pdf_file,
+    'rerender': rerender_record
+}
+
+
+# ============================================================================
+# 21. ЛОКАЛЬНЫЙ HTTP СЕРВИС
+# ============================================================================
+
+class LatencyHistogram:
+    """Гистограмма задержек в формате Prometheus"""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += seconds
+            series['count'] += 1
+
+    def render(self, name):
+        lines = [f"# TYPE {name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                label_text = ','.join(f'{k}="{v}"' for k, v in key)
+                prefix = label_text + ',' if label_text else ''
+                for bound, bucket_count in zip(self.BUCKETS, series['buckets']):
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {bucket_count}')
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {series["count"]}')
+                lines.append(f'{name}_sum{{{label_text}}} {series["sum"]:.6f}')
+                lines.append(f'{name}_count{{{label_text}}} {series["count"]}')
+        return lines
+
+
+class ServiceMetrics:
+    """Метрики HTTP сервиса"""
+
+    def __init__(self):
+        self.request_latency = LatencyHistogram()
+        self.processing_latency = LatencyHistogram()
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.memory = StageMemoryStats()
+
+    def add_memory(self, memory):
+        with self._lock:
+            self.memory.add(memory)
+
+    def inc(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def render(self, pool):
+        lines = []
+        lines += self.request_latency.render('footscan_request_duration_seconds')
+        lines += self.processing_latency.render('footscan_processing_duration_seconds')
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{name}{{{label_text}}} {value}")
+            for stage, peak_mb, steady_mb in self.memory.rows():
+                lines.append(f'footscan_stage_peak_rss_mb{{stage="{stage}"}} {peak_mb:.1f}')
+                lines.append(f'footscan_stage_steady_rss_mb{{stage="{stage}"}} {steady_mb:.1f}')
+        lines.append(f"footscan_workers {pool.size}")
+        lines.append(f"footscan_workers_recycled_total {pool.recycled}")
+        lines.append(f"footscan_in_flight {pool.in_flight}")
+        lines.append(f"footscan_queued {pool.queued}")
+        for priority, waiting in pool.queued_by_priority.items():
+            lines.append(f'footscan_queued_by_priority{{priority="{priority}"}} {waiting}')
+        return '\n'.join(lines) + '\n'
+
+
+def _read_uploaded_pdf(handler):
+    """Читает PDF из тела запроса (application/pdf или multipart/form-data)"""
+    length = int(handler.headers.get('Content-Length') or 0)
+    if length <= 0:
+        return None, b''
+    if length > handler.server.max_upload_bytes:
+        raise ValueError(f"Файл слишком большой: {length} байт")
+
+    body = handler.rfile.read(length)
+    content_type = handler.headers.get('Content-Type', '')
+
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=email_policy.default).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+        for part in message.iter_parts():
+            if part.get_filename() or part.get_content_type() == 'application/pdf':
+                return part.get_filename(), part.get_payload(decode=True)
+        return None, b''
+
+    query = parse_qs(urlparse(handler.path).query)
+    return query.get('filename', [None])[0], body
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов сервиса отчетов"""
+
+    server_version = "FootScanService/1.0"
+
+    def _send(self, code, body, content_type='application/json; charset=utf-8', headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code, payload, headers=None):
+        self._send(code, json.dumps(payload, ensure_ascii=False), headers=headers)
+
+    def log_message(self, format, *args):
+        print(f"[HTTP] {self.address_string()} {format % args}")
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self._send(200, self.server.metrics.render(self.server.pool),
+                       content_type='text/plain; version=0.0.4')
+        elif path == '/health':
+            self._send_json(200, {'status': 'ok', 'workers': self.server.pool.size})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path != '/report':
+            self._send_json(404, {'error': 'not found'})
+            return
+
+        started = time.perf_counter()
+        query = parse_qs(urlparse(self.path).query)
+        output_format = query.get('format', ['pdf'])[0]
+        priority = query.get('priority', ['interactive'])[0]
+        code = self._handle_report(output_format, priority)
+        self.server.metrics.request_latency.observe(
+            time.perf_counter() - started, format=output_format, code=code)
+        self.server.metrics.inc('footscan_requests_total', code=code)
+
+    def _handle_report(self, output_format, priority):
+        if output_format not in ('pdf', 'json'):
+            self._send_json(400, {'error': "format должен быть pdf или json"})
+            return 400
+        if priority not in PRIORITIES:
+            self._send_json(400, {'error': f"priority должен быть одним из: {', '.join(PRIORITIES)}"})
+            return 400
+
+        try:
+            filename, payload = _read_uploaded_pdf(self)
+        except ValueError as e:
+            self._send_json(413, {'error': str(e)})
+            return 413
+
+        if not payload.startswith(b'%PDF'):
+            self._send_json(400, {'error': 'ожидается PDF файл сканера'})
+            return 400
+
+        filename = os.path.basename(filename or '') or f"upload_{uuid.uuid4().hex}.pdf"
+        if not filename.lower().endswith('.pdf'):
+            filename += '.pdf'
+
+        upload_dir = os.path.join(self.server.spool_dir, uuid.uuid4().hex)
+        os.makedirs(upload_dir, exist_ok=True)
+        pdf_path = os.path.join(upload_dir, filename)
+
+        try:
+            with open(pdf_path, 'wb') as f:
+                f.write(payload)
+
+            processing_started = time.perf_counter()
+            result = self.server.pool.run('process_pdf', priority=priority, pdf_path=pdf_path,
+                                          output_dir=self.server.output_dir)
+            self.server.metrics.processing_latency.observe(time.perf_counter() - processing_started)
+            self.server.metrics.add_memory(result.get('memory'))
+        except PoolSaturatedError as e:
+            self._send_json(503, {'error': str(e)}, headers={'Retry-After': '5'})
+            return 503
+        except TaskTimeoutError as e:
+            self._send_json(504, {'error': str(e)})
+            return 504
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return 500
+        finally:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+        if result['status'] != 'ok':
+            self._send_json(422, {'error': result['reason'], 'input_pdf': filename})
+            return 422
+
+        if output_format == 'json':
+            record = dict(result['record'], output_pdf=result['output_pdf'],
+                          generated=result['generated_time'])
+            self._send_json(200, record)
+            return 200
+
+        with open(result['output_path'], 'rb') as f:
+            self._send(200, f.read(), content_type='application/pdf', headers={
+                'Content-Disposition': f"attachment; filename*=UTF-8''{quote(result['output_pdf'])}"
+            })
+        return 200
+
+
+def _stop_on_signal(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_service(host, port, workers, max_queue, output_dir, task_timeout=None, memory_limit_mb=None,
+                max_tasks_per_worker=None, rss_limit_mb=None, profile_dir=None, profile_per_file=False,
+                memprofile_dir=None, max_upload_mb=50):
+    """Запускает локальный HTTP сервис генерации отчетов"""
+    print("\n" + "=" * 70)
+    print("🌐 FOOTSCAN ANALYTICS - Сервис отчетов")
+    print("=" * 70)
+
+    os.makedirs(output_dir, exist_ok=True)
+    pool = WorkerPool(size=workers, max_queue=max_queue, task_timeout=task_timeout,
+                      memory_limit_mb=memory_limit_mb, max_tasks_per_worker=max_tasks_per_worker,
+                      rss_limit_mb=rss_limit_mb, profile_dir=profile_dir, profile_per_file=profile_per_file,
+                      memprofile_dir=memprofile_dir)
+
+    server = ThreadingHTTPServer((host, port), ReportRequestHandler)
+    server.daemon_threads = True
+    server.pool = pool
+    server.metrics = ServiceMetrics()
+    server.output_dir = output_dir
+    server.spool_dir = os.path.join(output_dir, '.spool')
+    server.max_upload_bytes = max_upload_mb * 1024 * 1024
+    os.makedirs(server.spool_dir, exist_ok=True)
+
+    print(f"[INFO] Сервис слушает http://{host}:{port}")
+    print(f"[INFO] POST /report?format=pdf|json, GET /metrics, GET /health")
+    print(f"[INFO] Отчеты сохраняются в: {os.path.abspath(output_dir)}")
+
+    signal.signal(signal.SIGTERM, _stop_on_signal)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[INFO] Остановка сервиса...")
+    finally:
+        server.server_close()
+        pool.close()
+        if profile_dir and not profile_per_file:
+            merge_profile_parts(profile_dir)
+        if memprofile_dir:
+            merge_memprofile_parts(memprofile_dir)
+
+
+# ============================================================================
+# 22. ПОИСК ВХОДНЫХ ФАЙЛОВ
+# ============================================================================
+
+def parse_shard(value):
+    """Разбирает '--shard i/N' в пару (i, N), 0 <= i < N"""
+    match = re.fullmatch(r'(\d+)/(\d+)', value.strip())
+    if not match or not 0 <= int(match.group(1)) < int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"ожидается i/N, где 0 <= i < N: {value}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def shard_of(rel_path, shard_count):
+    """Номер шарда по хэшу относительного пути (одинаков на всех машинах)"""
+    digest = hashlib.blake2b(rel_path.replace(os.sep, '/').encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shard_count
+
+
+def discover_pdf_files(roots, recursive=False, include=('*.pdf',), exclude=(), min_size=1000,
+                       shard=None, skip_dirs=()):
+    """Один проход os.scandir по корням; выдает (путь, размер) подходящих PDF
+
+    Папки-ссылки обходятся, но каждая папка (st_dev, st_ino) — один раз,
+    поэтому петля из ссылок не зацикливает --recursive.
+    """
+    seen = set()
+    visited = set()
+    skip_dirs = {os.path.abspath(path) for path in skip_dirs}
+
+    for root in roots:
+        root = os.path.abspath(root)
+        pending = [root]
+        while pending:
+            directory = pending.pop()
+            try:
+                stat = os.stat(directory)
+                if (stat.st_dev, stat.st_ino) in visited:
+                    continue
+                visited.add((stat.st_dev, stat.st_ino))
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if recursive and not entry.name.startswith('.') and entry.path not in skip_dirs:
+                            pending.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    rel_path = os.path.relpath(entry.path, root)
+                    if not any(fnmatch.fnmatch(entry.name, pattern) for pattern in include):
+                        continue
+                    if any(fnmatch.fnmatch(entry.name, pattern) or fnmatch.fnmatch(rel_path, pattern)
+                           for pattern in exclude):
+                        continue
+                    if entry.path in seen:
+                        continue
+                    seen.add(entry.path)
+
+                    if shard and shard_of(rel_path, shard[1]) != shard[0]:
+                        continue
+                    size = entry.stat().st_size
+                except OSError:
+                    continue
+                if size > min_size:
+                    yield entry.path, size
+
+
+# ============================================================================
+# 23. ОЧЕРЕДЬ С АРЕНДОЙ НА ОБЩЕЙ ПАПКЕ
+# ============================================================================
+
+class LeaseQueue:
+    """Очередь файлов на общей папке: аренда через lock-файл, продление, отметки о готовности
+
+    Аренда — файл .queue/<ключ>.lease, созданный с O_EXCL; пока файл в работе,
+    фоновый поток обновляет его mtime. Аренда старше ttl считается брошенной
+    (узел упал) и забирается атомарным переименованием. После обработки
+    пишется .queue/<ключ>.done, и файл больше никем не берется.
+    """
+
+    def __init__(self, base_dir, ttl=120.0, node=None):
+        self.base_dir = os.path.abspath(base_dir)
+        self.queue_dir = os.path.join(self.base_dir, '.queue')
+        self.ttl = ttl
+        self.node = node or f"{socket.gethostname()}-{os.getpid()}"
+        self.busy = set()
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        os.makedirs(self.queue_dir, exist_ok=True)
+
+        self._heartbeat = threading.Thread(target=self._renew_loop, name='lease-heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    def _key(self, pdf_path):
+        rel_path = os.path.relpath(os.path.abspath(pdf_path), self.base_dir).replace(os.sep, '/')
+        return hashlib.blake2b(rel_path.encode('utf-8'), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _read_token(lease_path):
+        try:
+            with open(lease_path, encoding='utf-8') as f:
+                return json.load(f).get('token')
+        except (OSError, ValueError):
+            return None
+
+    def _create_lease(self, lease_path, token, pdf_path):
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'token': token, 'node': self.node, 'input_path': pdf_path,
+                       'claimed': datetime.now().isoformat(timespec='seconds')}, f, ensure_ascii=False)
+        return True
+
+    def _reclaim_expired(self, lease_path):
+        """Забирает просроченную аренду; True — путь свободен для новой аренды
+
+        Переименованная аренда снимается, только если это та же просроченная
+        аренда (тот же токен), а не свежая, взятая другим узлом за это время.
+        """
+        token = self._read_token(lease_path)
+        try:
+            if token is None or time.time() - os.stat(lease_path).st_mtime < self.ttl:
+                return False
+        except FileNotFoundError:
+            return True
+
+        stale_path = f"{lease_path}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return True
+
+        try:
+            if self._read_token(stale_path) == token and time.time() - os.stat(stale_path).st_mtime >= self.ttl:
+                print(f"[WARNING] Забрана просроченная аренда: {os.path.basename(lease_path)}")
+                return True
+            # Между проверкой и переименованием аренду взял другой узел — возвращаем ее
+            try:
+                os.link(stale_path, lease_path)
+            except FileExistsError:
+                # Путь уже занят третьим узлом: владелец возвращенной аренды
+                # увидит чужой токен в finish() и отбросит свой результат
+                print(f"[WARNING] Аренда перехвачена другим узлом: {os.path.basename(lease_path)}")
+            return False
+        finally:
+            os.remove(stale_path)
+
+    def claim(self, pdf_path):
+        """Берет файл в работу; None — файл уже обработан или занят другим узлом"""
+        key = self._key(pdf_path)
+        lease_path = os.path.join(self.queue_dir, key + '.lease')
+        done_path = os.path.join(self.queue_dir, key + '.done')
+        if os.path.exists(done_path):
+            return None
+
+        token = uuid.uuid4().hex
+        if not self._create_lease(lease_path, token, pdf_path):
+            if not (self._reclaim_expired(lease_path) and self._create_lease(lease_path, token, pdf_path)):
+                with self._lock:
+                    self.busy.add(pdf_path)
+                return None
+
+        # Файл мог быть завершен другим узлом, пока мы брали аренду
+        if os.path.exists(done_path):
+            os.remove(lease_path)
+            return None
+
+        lease = {'input_path': pdf_path, 'lease_path': lease_path, 'done_path': done_path, 'token': token}
+        with self._lock:
+            self._held[lease_path] = token
+            self.busy.discard(pdf_path)
+        return lease
+
+    def finish(self, lease, result):
+        """Снимает аренду и отмечает файл обработанным; True — результат засчитан этому узлу
+
+        Результат не засчитывается, если аренда потеряна (в файле чужой токен)
+        или файл уже отмечен другим узлом: .done создается через os.link,
+        который не перезаписывает существующий файл.
+        """
+        with self._lock:
+            self._held.pop(lease['lease_path'], None)
+
+        owned = self._read_token(lease['lease_path']) == lease['token']
+        recorded = False
+        if owned and result is not None:
+            temp_path = f"{lease['done_path']}.{lease['token']}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'node': self.node, 'status': result.get('status'), 'reason': result.get('reason'),
+                           'output_path': result.get('output_path'),
+                           'finished': datetime.now().isoformat(timespec='seconds')}, f, ensure_ascii=False)
+            try:
+                os.link(temp_path, lease['done_path'])
+                recorded = True
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(temp_path)
+
+        if owned:
+            os.remove(lease['lease_path'])
+        return recorded
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            with self._lock:
+                held = list(self._held.items())
+            for lease_path, token in held:
+                if self._read_token(lease_path) != token:
+                    print(f"[WARNING] Аренда потеряна, результат будет отброшен: {os.path.basename(lease_path)}")
+                    with self._lock:
+                        self._held.pop(lease_path, None)
+                    continue
+                try:
+                    os.utime(lease_path)
+                except OSError:
+                    pass
+
+    def wait_busy(self):
+        """Ждет часть ttl и возвращает файлы, занятые другими узлами, для повторной попытки"""
+        with self._lock:
+            busy, self.busy = sorted(self.busy), set()
+        if busy:
+            print(f"[INFO] Занято другими узлами: {len(busy)} файлов, повтор через {self.ttl / 4:.0f} с")
+            time.sleep(self.ttl / 4)
+        return busy
+
+    def close(self):
+        self._stop.set()
+        self._heartbeat.join()
+
+
+def run_leased(lease_queue, pdf_path, process, *args):
+    """Выполняет process(*args) под арендой pdf_path; None — файл взят не нами"""
+    lease = lease_queue.claim(pdf_path)
+    if lease is None:
+        return None
+
+    result = None
+    try:
+        result = process(*args)
+    finally:
+        recorded = lease_queue.finish(lease, result)
+
+    if not recorded:
+        # Аренда потеряна во время обработки: файл засчитан другому узлу
+        print(f"[WARNING] Результат отброшен, файл обработан другим узлом: {os.path.basename(pdf_path)}")
+        if result.get('status') == 'ok' and os.path.exists(result.get('output_path') or ''):
+            os.remove(result['output_path'])
+        return None
+    return result
+
+
+# ============================================================================
+# 24. ПОТОКОВЫЙ ЖУРНАЛ ОБРАБОТКИ
+# ============================================================================
+
+class ProcessingLog:
+    """Журнал пакета: строка JSONL и CSV на каждый файл сразу по готовности"""
+
+    CSV_FIELDS = ('status', 'reason', 'input_pdf', 'input_path', 'output_pdf', 'output_path',
+                  'client_name', 'scan_date', 'foot_length_left', 'foot_length_right',
+                  'total_risk', 'generated_time', 'file_size', 'output_profile', 'render_seconds')
+
+    def __init__(self, output_dir, flush_every=10, flush_interval=5.0, node=None):
+        stamp = unique_stamp()
+        if node:
+            stamp += f"_{node}"
+        self.base_path = os.path.join(output_dir, f"processing_summary_{stamp}")
+        self.jsonl_path = self.base_path + ".jsonl"
+        self.csv_path = self.base_path + ".csv"
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.count = 0
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+        self._jsonl = open(self.jsonl_path, 'w', encoding='utf-8')
+        # utf-8-sig: кириллица корректно открывается в Excel
+        self._csv_file = open(self.csv_path, 'w', encoding='utf-8-sig', newline='')
+        self._csv = csv.DictWriter(self._csv_file, fieldnames=self.CSV_FIELDS, extrasaction='ignore')
+        self._csv.writeheader()
+
+    def write(self, result):
+        """Записывает результат одного файла (без данных отчета)"""
+        row = {key: value for key, value in result.items() if key != 'record'}
+        self._jsonl.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._csv.writerow(row)
+        self.count += 1
+        self._pending += 1
+
+        if self._pending >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._jsonl.flush()
+        self._csv_file.flush()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._jsonl.close()
+        self._csv_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+
+class ReportArchive:
+    """Архив результатов пакета (zip или tar), пополняемый по мере готовности отчетов
+
+    Пишется во временный файл рядом с path и переименовывается при закрытии.
+    """
+
+    # Уже сжатые форматы кладутся в zip без повторного сжатия
+    STORED_EXTENSIONS = ('.pdf', '.png', '.jpg', '.ttf', '.gz')
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.members = []
+        self._temp_path = temp_sibling(self.path)
+        if self.path.lower().endswith('.zip'):
+            self._zip = zipfile.ZipFile(self._temp_path, 'w', compression=zipfile.ZIP_DEFLATED)
+            self._tar = None
+        else:
+            self._zip = None
+            self._tar = tarfile.open(self._temp_path,
+                                     'w:gz' if self.path.lower().endswith(('.tar.gz', '.tgz')) else 'w')
+
+    def add(self, path, arcname=None):
+        """Добавляет файл или папку (рекурсивно) под именем arcname"""
+        arcname = arcname or os.path.basename(path)
+        if os.path.isdir(path):
+            for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+                self.add(entry.path, f"{arcname}/{entry.name}")
+            return
+        size = os.path.getsize(path)
+        if self._zip:
+            stored = arcname.lower().endswith(self.STORED_EXTENSIONS)
+            self._zip.write(path, arcname, compress_type=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+        else:
+            self._tar.add(path, arcname)
+        self.members.append((arcname, size))
+
+    def close(self):
+        if self._temp_path is None:
+            return
+        (self._zip or self._tar).close()
+        os.replace(self._temp_path, self.path)
+        self._temp_path = None
+
+
+def read_processing_log(jsonl_path):
+    """Построчно читает журнал обработки; оборванная последняя строка пропускается"""
+    with open(jsonl_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def write_text_summary(jsonl_path, summary_file, total_files):
+    """Строит читаемую сводку processing_summary_*.txt по журналу обработки"""
+    results = []
+    failures = []
+    duplicates = []
+    memory_stats = StageMemoryStats()
+    for row in read_processing_log(jsonl_path):
+        memory_stats.add(row.get('memory'))
+        if row['status'] == 'ok':
+            results.append(row)
+        elif row['status'] == 'duplicate':
+            duplicates.append(row)
+        else:
+            failures.append(row)
+
+    results.sort(key=lambda item: item['input_path'])
+    duplicates.sort(key=lambda item: item['input_path'])
+    memory_rows = memory_stats.rows()
+    profile_rows = {}
+    for result in results:
+        sizes, seconds = profile_rows.setdefault(result.get('output_profile') or DEFAULT_OUTPUT_PROFILE, ([], []))
+        sizes.append(result['file_size'])
+        seconds.append(result.get('render_seconds') or 0.0)
+
+    with open(summary_file, 'w', encoding='utf-8') as f:
+        f.write("=" * 70 + "\n")
+        f.write("FootScan Analytics - Итоги обработки\n")
+        f.write("=" * 70 + "\n\n")
+        f.write(f"Дата обработки: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n")
+        f.write(f"Успешно обработано: {len(results)} файлов\n")
+        f.write(f"Не удалось обработать: {len(failures)} файлов\n")
+        if duplicates:
+            f.write(f"Свернуто дубликатов: {len(duplicates)} файлов\n")
+        f.write(f"Всего файлов: {total_files}\n\n")
+
+        f.write("=" * 70 + "\n")
+        f.write("ДЕТАЛЬНЫЕ РЕЗУЛЬТАТЫ:\n")
+        f.write("=" * 70 + "\n\n")
+
+        for i, result in enumerate(results, 1):
+            f.write(f"{i:2d}. {result['client_name']}\n")
+            f.write(f"    Входной файл: {result['input_pdf']}\n")
+            f.write(f"    Выходной файл: {result['output_pdf']}\n")
+            f.write(
+                f"    Длина стопы: Л={result['foot_length_left']:.1f}мм, П={result['foot_length_right']:.1f}мм\n")
+            f.write(f"    Общий риск: {result['total_risk']:.1f}/100\n")
+            f.write(f"    Дата сканирования: {result['scan_date']}\n")
+            f.write(f"    Размер файла: {result['file_size']:,} байт\n")
+            f.write("-" * 50 + "\n")
+
+        if profile_rows:
+            f.write("\n" + "=" * 70 + "\n")
+            f.write("ПРОФИЛИ ВЫВОДА:\n")
+            f.write("=" * 70 + "\n\n")
+
+            for name, (sizes, seconds) in sorted(profile_rows.items()):
+                profile = OUTPUT_PROFILES.get(name)
+                if profile:
+                    f.write(f"    {name}: графики {profile.chart_dpi} dpi "
+                            f"{'JPEG' if profile.image_format == 'jpeg' else 'PNG'}"
+                            f"{f' ({profile.palette_colors} цветов)' if profile.palette_colors else ''}, "
+                            f"сжатие страниц {'вкл' if profile.page_compression else 'выкл'}"
+                            f"{f', картинки до {profile.image_dpi} dpi' if profile.image_dpi else ''}\n")
+                else:
+                    f.write(f"    {name}:\n")
+                f.write(f"        отчетов {len(sizes)}, средний размер {sum(sizes) / len(sizes) / 1024:,.1f} КБ, "
+                        f"всего {sum(sizes) / 1024 / 1024:,.2f} МБ\n")
+                f.write(f"        построение: среднее {sum(seconds) / len(seconds):.2f} с, "
+                        f"максимум {max(seconds):.2f} с\n")
+
+        if memory_rows:
+            f.write("\n" + "=" * 70 + "\n")
+            f.write("ПАМЯТЬ ПО ЭТАПАМ:\n")
+            f.write("=" * 70 + "\n\n")
+
+            for stage, peak_mb, steady_mb in memory_rows:
+                f.write(f"    {stage}: пик {peak_mb:.1f} МБ, установившаяся {steady_mb:.1f} МБ\n")
+
+        if duplicates:
+            f.write("\n" + "=" * 70 + "\n")
+            f.write("ДУБЛИКАТЫ (отчет не строился):\n")
+            f.write("=" * 70 + "\n\n")
+
+            for i, duplicate in enumerate(duplicates, 1):
+                f.write(f"{i:2d}. {duplicate['input_pdf']}\n")
+                f.write(f"    {duplicate['reason']}\n")
+
+        if failures:
+            f.write("\n" + "=" * 70 + "\n")
+            f.write("НЕ ОБРАБОТАНЫ:\n")
+            f.write("=" * 70 + "\n\n")
+
+            for i, failure in enumerate(failures, 1):
+                f.write(f"{i:2d}. {failure['input_pdf']}\n")
+                f.write(f"    Причина: {failure['reason']}\n")
+
+    return memory_rows
+
+
+# ============================================================================
+# 25. ДЕДУПЛИКАЦИЯ СКАНОВ
+# ============================================================================
+
+def scan_identity(data):
+    """Ключ одного сканирования: (номер сканера, имя, дата); None, если номера сканера нет"""
+    scanner_id = str(data.get('scanner_id') or '').strip()
+    if not scanner_id:
+        return None
+    return scanner_id, normalize_client_name(data.get('client_name')), str(data.get('scan_date') or '').strip()
+
+
+def content_hash(data):
+    """Хэш извлеченных данных: одинаковый у побайтно разных PDF с теми же значениями"""
+    payload = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def dedupe_fields(data):
+    """Поля результата, по которым collapse_duplicates выбирает сканирование; считаются там, где извлечены данные"""
+    return {'scan_identity': scan_identity(data), 'content_hash': content_hash(data)}
+
+
+def collapse_duplicates(items, recency):
+    """Оставляет по одному элементу на сканирование
+
+    items — словари с полями dedupe_fields; recency(item) — ключ свежести. Из группы
+    остается самый свежий, при равенстве — с меньшим хэшем данных, чтобы выбор
+    не зависел от порядка обхода. Возвращает (канонические в исходном порядке,
+    [(свернутый, канонический, данные_совпадают)]).
+    """
+    groups = {}
+    for position, item in enumerate(items):
+        identity = item['scan_identity']
+        groups.setdefault(tuple(identity) if identity else ('', position), []).append((item['content_hash'], item))
+
+    canonical_ids = set()
+    collapsed = []
+    for members in groups.values():
+        # max берет первый из равных, а члены упорядочены по хэшу
+        kept_hash, kept = max(sorted(members, key=lambda member: member[0]), key=lambda member: recency(member[1]))
+        canonical_ids.add(id(kept))
+        collapsed.extend((item, kept, item_hash == kept_hash) for item_hash, item in members if item is not kept)
+
+    return [item for item in items if id(item) in canonical_ids], collapsed
+
+
+def print_collapsed(collapsed):
+    by_kept = {}
+    for item, kept, same in collapsed:
+        by_kept.setdefault(id(kept), (kept, []))[1].append((item, same))
+    for kept, members in by_kept.values():
+        print(f"🔁 Дубликаты {kept['input_pdf']}:")
+        for item, same in members:
+            print(f"   • {item['input_pdf']} ({'те же данные' if same else 'данные отличаются'})")
+
+
+# ============================================================================
+# 26. ПЕРЕСБОРКА ОТЧЕТОВ ИЗ ЗАПИСЕЙ
+# ============================================================================
+
+LEGACY_REPORTS_DEBUG_DIR = 'generated_reports_debug'
+
+
+def iter_stored_records(debug_log_dir=None, legacy_dir=None):
+    """Записи с данными и оценками: отладочный журнал и старые JSON из generated_reports_debug"""
+    if debug_log_dir:
+        for segment_path in sorted(glob.glob(os.path.join(debug_log_dir, '*.jsonl.gz'))):
+            try:
+                with gzip.open(segment_path, 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        record = json.loads(line)
+                        if record.get('status') == 'ok':
+                            record.pop('text', None)
+                            yield record
+            except (OSError, EOFError, ValueError) as e:
+                # Сегмент процесса, завершившегося аварийно, может быть оборван
+                print(f"[WARNING] Сегмент прочитан не полностью: {os.path.basename(segment_path)} ({e})")
+
+    if legacy_dir:
+        for json_path in sorted(glob.glob(os.path.join(legacy_dir, '*.json'))):
+            try:
+                with open(json_path, encoding='utf-8') as f:
+                    payload = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if 'data' in payload and 'risk_scores' in payload:
+                yield dict(payload, input_pdf=payload.get('input_pdf') or os.path.basename(json_path))
+
+
+def stored_record_key(record):
+    """Ключ входного файла записи: полный путь (и страницы для выгрузок сеанса)
+
+    В старых JSON пути нет, а имя — имя самого JSON, поэтому их ключ — пациент
+    и дата сканирования.
+    """
+    if record.get('input_path'):
+        return record['input_path'], record['input_pdf']
+    data = record.get('data') or {}
+    scan_date = scan_sort_key(data.get('scan_date')) or str(data.get('scan_date') or '')
+    return '', f"{normalize_client_name(data.get('client_name'))}|{scan_date}"
+
+
+def latest_stored_records(debug_log_dir=None, legacy_dir=None, dedupe=True):
+    """Последняя запись для каждого входного файла (и для каждого сканирования при dedupe)"""
+    latest = {}
+    for record in iter_stored_records(debug_log_dir, legacy_dir):
+        key = stored_record_key(record)
+        if key not in latest or str(record.get('generated', '')) >= str(latest[key].get('generated', '')):
+            latest[key] = record
+    records = [latest[key] for key in sorted(latest)]
+    if not dedupe:
+        return records
+
+    records, collapsed = collapse_duplicates([{'input_pdf': record['input_pdf'], 'record': record,
+                                              **dedupe_fields(record['data'])} for record in records],
+                                            recency=lambda item: str(item['record'].get('generated', '')))
+    print_collapsed(collapsed)
+    return [item['record'] for item in records]
+
+
+def iter_rerender_results(records, output_dir, workers, rescore=False, task_timeout=None, memory_limit_mb=None,
+                          max_tasks_per_worker=None, rss_limit_mb=None, priority='backfill', pool=None,
+                          profile_dir=None, profile_per_file=False, memprofile_dir=None, stored=False):
+    """Пересобирает отчеты и выдает (номер, входной файл, результат) по мере готовности"""
+    if not workers:
+        lower_process_priority(priority)
+        monitor = StageMemoryMonitor()
+        STAGE_HOOKS.append(monitor)
+        profilers = install_stage_hooks(profile_dir, profile_per_file, memprofile_dir)
+        try:
+            for index, record in enumerate(records, 1):
+                try:
+                    result = rerender_record(record, output_dir, record['input_pdf'],
+                                             fallback_name=f"patient_{index}", rescore=rescore, stored=stored)
+                except Exception as e:
+                    traceback.print_exc()
+                    result = {'status': 'failed', 'reason': f"Ошибка: {e}",
+                              'input_pdf': record['input_pdf'], 'input_path': record['input_pdf']}
+                flush_stage_hooks(profilers, record['input_pdf'])
+                release_render_caches()
+                result['memory'] = monitor.collect()
+                yield index, record['input_pdf'], result
+        finally:
+            for hook in [monitor] + profilers:
+                STAGE_HOOKS.remove(hook)
+        return
+
+    own_pool = pool is None
+    if own_pool:
+        size = min(workers, len(records)) if hasattr(records, '__len__') else workers
+        pool = WorkerPool(size=size, task_timeout=task_timeout,
+                          memory_limit_mb=memory_limit_mb, max_tasks_per_worker=max_tasks_per_worker,
+                          rss_limit_mb=rss_limit_mb, profile_dir=profile_dir, profile_per_file=profile_per_file,
+                          memprofile_dir=memprofile_dir, priority=priority)
+    try:
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            # Окно задач ограничено: records может быть потоком, который нельзя держать в памяти целиком
+            futures = {}
+            for index, record in enumerate(records, 1):
+                future = executor.submit(run_supervised, pool, record['input_pdf'], output_dir, f"patient_{index}",
+                                         priority, task_name='rerender', record=record, rescore=rescore,
+                                         stored=stored)
+                futures[future] = (index, record['input_pdf'])
+                if len(futures) >= 2 * pool.size:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        done_index, input_pdf = futures.pop(future)
+                        yield done_index, input_pdf, future.result()
+            for future in as_completed(futures):
+                index, input_pdf = futures[future]
+                yield index, input_pdf, future.result()
+    finally:
+        if own_pool:
+            pool.close()
+
+
+def run_rerender(output_dir, workers, debug_log_dir=None, legacy_dir=LEGACY_REPORTS_DEBUG_DIR, rescore=False,
+                 task_timeout=None, memory_limit_mb=None, max_tasks_per_worker=None, rss_limit_mb=None,
+                 priority='backfill'):
+    """Команда rerender: новые отчеты по сохраненным записям, без чтения исходных PDF"""
+    print("\n" + "=" * 70)
+    print("🔁 FOOTSCAN ANALYTICS - Пересборка отчетов из сохраненных записей")
+    print("=" * 70)
+
+    records = latest_stored_records(debug_log_dir, legacy_dir)
+    print(f"[INFO] Записей для пересборки: {len(records)} "
+          f"(журнал: {debug_log_dir or '—'}, старые JSON: {legacy_dir or '—'})")
+    if not records:
+        return
+    if rescore:
+        print("[INFO] Риски и рекомендации пересчитываются по текущим правилам")
+
+    cohort = CohortStats()
+    for record in records:
+        cohort.add(record['data'])
+    records = [dict(record, percentiles=cohort.percentiles(record['data'])) for record in records]
+
+    os.makedirs(output_dir, exist_ok=True)
+    processed_count = failed_count = 0
+    with ProcessingLog(output_dir) as processing_log:
+        batch = iter_rerender_results(records, output_dir, workers, rescore=rescore, task_timeout=task_timeout,
+                                      memory_limit_mb=memory_limit_mb, max_tasks_per_worker=max_tasks_per_worker,
+                                      rss_limit_mb=rss_limit_mb, priority=priority, stored=True)
+        for index, input_pdf, result in batch:
+            processing_log.write(result)
+            if result['status'] == 'ok':
+                processed_count += 1
+                print(f"✅ {index}/{len(records)} {input_pdf} → {result['output_pdf']}")
+            else:
+                failed_count += 1
+                print(f"❌ {index}/{len(records)} {input_pdf}: {result['reason']}")
+
+    summary_file = processing_log.base_path + ".txt"
+    write_text_summary(processing_log.jsonl_path, summary_file, len(records))
+    print(f"\n✅ Пересобрано: {processed_count}, ❌ ошибок: {failed_count}")
+    print(f"📋 Итоговый отчет сохранен в: {summary_file}")
+
+
+def run_split_export(pdf_path, output_dir, workers, task_timeout=None, memory_limit_mb=None,
+                     max_tasks_per_worker=None, rss_limit_mb=None, priority='new'):
+    """Команда split-export: отдельный отчет на каждого пациента из выгрузки сеанса сканера
+
+    Выгрузка читается постранично, пациенты передаются на построение отчетов по
+    мере разбора, поэтому память не зависит от размера выгрузки. Перцентили
+    когорты в отчеты не попадают: группа известна только после разбора всей
+    выгрузки; сводка по группе строится в конце, как и для пакета.
+    """
+    print("\n" + "=" * 70)
+    print("🗂  FOOTSCAN ANALYTICS - Разбор выгрузки сеанса сканера")
+    print("=" * 70)
+    print(f"[INFO] Выгрузка: {pdf_path}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    processed_count = failed_count = 0
+    cohort = CohortStats()
+    with ProcessingLog(output_dir) as processing_log:
+        def records():
+            nonlocal failed_count
+            for scan in iter_export_scans(pdf_path):
+                if scan['status'] != 'ok':
+                    processing_log.write(scan)
+                    failed_count += 1
+                    print(f"❌ {scan['input_pdf']}: {scan['reason']}")
+                    continue
+                cohort.add(scan['record']['data'])
+                yield dict(scan['record'], input_pdf=scan['input_pdf'], input_path=scan['input_path'])
+
+        batch = iter_rerender_results(records(), output_dir, workers, task_timeout=task_timeout,
+                                      memory_limit_mb=memory_limit_mb, max_tasks_per_worker=max_tasks_per_worker,
+                                      rss_limit_mb=rss_limit_mb, priority=priority)
+        for index, input_pdf, result in batch:
+            processing_log.write(result)
+            if result['status'] == 'ok':
+                processed_count += 1
+                print(f"✅ {index}. {input_pdf} → {result['output_pdf']}")
+            else:
+                failed_count += 1
+                print(f"❌ {index}. {input_pdf}: {result['reason']}")
+
+    summary_file = processing_log.base_path + ".txt"
+    write_text_summary(processing_log.jsonl_path, summary_file, processed_count + failed_count)
+    print(f"\n✅ Пациентов в отчетах: {processed_count}, ❌ ошибок: {failed_count}")
+    print(f"📋 Итоговый отчет сохранен в: {summary_file}")
+    if cohort.patients:
+        cohort.save(processing_log.base_path + "_cohort.json")
+        cohort_pdf = create_cohort_summary(cohort, processing_log.base_path + "_cohort.pdf",
+                                           subtitle=os.path.basename(pdf_path))
+        print(f"   Сводка по группе: {cohort_pdf}")
+
+
+# ============================================================================
+# 27. ОСНОВНАЯ ФУНКЦИЯ
+# ============================================================================
+
+def main(workers=None, task_timeout=None, memory_limit_mb=None, max_tasks_per_worker=None, rss_limit_mb=None,
+         profile_dir=None, profile_per_file=False, memprofile_dir=None,
+         recursive=False, include=None, exclude=None, shard=None, lease_ttl=None, priority='new', dedupe=True,
+         archive_path=None, archive_only=False):
+    print("\n" + "=" * 70)
+    print("🏥 FOOTSCAN ANALYTICS - Генератор медицинских отчетов")
+    print("=" * 70)
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    reports_dir = os.path.join(current_dir, "../reports")
+    students_dir = os.path.join(reports_dir, "students")
+    students_result_dir = os.path.join(reports_dir, "students_result")
+
+    print(f"[INFO] Текущая директория: {current_dir}")
+    print(f"[INFO] Директория с PDF файлами: {students_dir}")
+    print(f"[INFO] Директория для результатов: {students_result_dir}")
+
+    for directory in [students_dir, students_result_dir]:
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory, exist_ok=True)
+                print(f"[INFO] Создана директория: {directory}")
+            except Exception as e:
+                print(f"[ERROR] Не удалось создать директорию {directory}: {e}")
+
+    # Рабочие папки приложения содержат сгенерированные PDF, а не сканирования
+    skip_dirs = [path for path in (students_result_dir, scratch_root(), debug_log_root(),
+                                   os.environ.get(STORE_ENV, DEFAULT_STORE_DIR),
+                                   os.environ.get(HISTORY_ENV, DEFAULT_HISTORY_DIR)) if path]
+    found = dict(discover_pdf_files([students_dir, current_dir, reports_dir], recursive=recursive,
+                                    include=include or ('*.pdf',), exclude=exclude or (),
+                                    shard=shard, skip_dirs=skip_dirs))
+    pdf_files = sorted(found)
+
+    shard_note = f" (шард {shard[0]}/{shard[1]})" if shard else ""
+    print(f"\n📁 НАЙДЕНО PDF ФАЙЛОВ: {len(pdf_files)}{shard_note}")
+    if pdf_files:
+        for i, pdf_file in enumerate(pdf_files[:20], 1):
+            print(f"  {i:2d}. {os.path.basename(pdf_file)} ({found[pdf_file] / 1024:.1f} KB)")
+        if len(pdf_files) > 20:
+            print(f"  ... и еще {len(pdf_files) - 20} файлов")
+    else:
+        print("\n[ERROR] Не найдено ни одного PDF файла!")
+        print("[INFO] Поместите PDF файлы в папку:")
+        print(f"  • {students_dir}")
+
+        manual_path = input("\nВведите путь к PDF файлу (или нажмите Enter для выхода): ").strip()
+        if manual_path and os.path.exists(manual_path):
+            pdf_files = [manual_path]
+        else:
+            print("[INFO] Выход из программы")
+            return
+
+    processed_count = 0
+    failed_count = 0
+
+    print(f"\n{'=' * 70}")
+    print("🚀 НАЧАЛО ОБРАБОТКИ ФАЙЛОВ")
+    print('=' * 70)
+
+    if workers:
+        print(f"[INFO] Воркеров: {workers}, лимит времени: {task_timeout or '—'} с, "
+              f"лимит памяти: {memory_limit_mb or '—'} МБ на файл, приоритет: {priority}")
+
+    lease_queue = None
+    if lease_ttl:
+        lease_queue = LeaseQueue(students_dir, ttl=lease_ttl)
+        print(f"[INFO] Общая очередь: {lease_queue.queue_dir}, узел {lease_queue.node}, аренда {lease_ttl:.0f} с")
+
+    def show_result(pdf_index, batch_size, pdf_file, result):
+        nonlocal processed_count, failed_count
+        if archive and result['status'] == 'ok' and os.path.exists(result['output_path']):
+            # Отчет только что записан и еще в кэше ОС: повторного чтения с диска нет
+            archive.add(result['output_path'])
+            if archive_only:
+                os.remove(result['output_path'])
+                result['output_path'] = os.path.join(archive.path, result['output_pdf'])
+        processing_log.write(result)
+        done_count = processed_count + failed_count + duplicate_count + 1
+
+        print(f"\n{'=' * 60}")
+        print(f"🔄 ФАЙЛ {pdf_index}/{batch_size} (готово {done_count}/{len(pdf_files)})")
+        print(f"📄 Файл: {os.path.basename(pdf_file)}")
+        print('=' * 60)
+
+        if result['status'] != 'ok':
+            print(f"\n❌ НЕ ОБРАБОТАН: {result['reason']}")
+            failed_count += 1
+            return
+
+        processed_count += 1
+
+        print(f"\n✅ УСПЕШНО ОБРАБОТАНО: {result['client_name']}")
+        print(f"📊 Результат сохранен в: {result['output_path']}")
+
+    batch_options = dict(task_timeout=task_timeout, memory_limit_mb=memory_limit_mb,
+                         max_tasks_per_worker=max_tasks_per_worker, rss_limit_mb=rss_limit_mb,
+                         priority=priority)
+    duplicate_count = 0
+    cohort = CohortStats()
+    pool = None
+    pending = pdf_files
+    output_dir = students_result_dir
+    if archive_path and archive_only:
+        # Отчеты и журнал пишутся во временную папку и остаются только в архиве;
+        # pid в имени позволяет gc убрать папку процесса, завершившегося аварийно
+        output_dir = os.path.join(scratch_root(), f"{os.getpid()}_archive_{unique_stamp()}")
+        os.makedirs(output_dir, exist_ok=True)
+    try:
+        archive = ReportArchive(archive_path) if archive_path else None
+        try:
+            with ProcessingLog(output_dir, node=lease_queue.node if lease_queue else None) as processing_log:
+                print(f"[INFO] Журнал обработки: {processing_log.jsonl_path}")
+
+                if dedupe and not lease_queue:
+                    # Две фазы: сначала извлечение, затем отчеты только по каноническим сканированиям.
+                    # Отчеты здесь не потоковые: дубликат может оказаться последним файлом пакета,
+                    # а перцентили когорты известны только после извлечения всех файлов.
+                    # В памяти — только данные и оценки, текст PDF остается в журнале воркера
+                    if workers:
+                        pool = WorkerPool(size=min(workers, len(pdf_files)), profile_dir=profile_dir,
+                                          profile_per_file=profile_per_file, memprofile_dir=memprofile_dir,
+                                          **batch_options)
+                    extracted = []
+                    batch = iter_batch_results(pdf_files, output_dir, workers, profile_dir=profile_dir,
+                                               profile_per_file=profile_per_file, memprofile_dir=memprofile_dir,
+                                               task_name='extract_pdf', pool=pool, **batch_options)
+                    for pdf_index, pdf_file, result in batch:
+                        if result['status'] == 'ok':
+                            extracted.append(result)
+                        else:
+                            show_result(pdf_index, len(pdf_files), pdf_file, result)
+
+                    canonical, collapsed = collapse_duplicates(extracted, recency=lambda item: item['source_mtime'])
+                    if collapsed:
+                        print(f"\n{'=' * 70}")
+                        print_collapsed(collapsed)
+                    for item, kept, same in collapsed:
+                        duplicate_count += 1
+                        processing_log.write({
+                            'status': 'duplicate',
+                            'reason': f"Дубликат {kept['input_pdf']}"
+                                      + ("" if same else " (данные отличаются, выбран более свежий)"),
+                            'input_pdf': item['input_pdf'],
+                            'input_path': item['input_path'],
+                            'memory': item.get('memory'),
+                        })
+
+                    # Когорта пакета известна до построения отчетов: перцентили попадают в каждый отчет
+                    for item in canonical:
+                        cohort.add(item['record']['data'])
+                    records = [dict(item['record'], input_pdf=item['input_pdf'], input_path=item['input_path'],
+                                    percentiles=cohort.percentiles(item['record']['data']))
+                               for item in canonical]
+                    batch = iter_rerender_results(records, output_dir, workers, pool=pool, profile_dir=profile_dir,
+                                                  profile_per_file=profile_per_file, memprofile_dir=memprofile_dir,
+                                                  **batch_options)
+                    for index, input_pdf, result in batch:
+                        # Память этапа извлечения берем из первой фазы
+                        stages = dict((canonical[index - 1].get('memory') or {}).get('stages', {}))
+                        stages.update((result.get('memory') or {}).get('stages', {}))
+                        result['memory'] = dict(result.get('memory') or {}, stages=stages)
+                        show_result(index, len(records), canonical[index - 1]['input_path'], result)
+                    pending = []
+
+                if pending and workers:
+                    # Один пул на все повторы: занятые другими узлами файлы не прогревают новый пул
+                    pool = WorkerPool(size=min(workers, len(pending)), profile_dir=profile_dir,
+                                      profile_per_file=profile_per_file, memprofile_dir=memprofile_dir,
+                                      **batch_options)
+                while pending:
+                    batch = iter_batch_results(pending, output_dir, workers, profile_dir=profile_dir,
+                                               profile_per_file=profile_per_file, memprofile_dir=memprofile_dir,
+                                               lease_queue=lease_queue, pool=pool, **batch_options)
+                    for pdf_index, pdf_file, result in batch:
+                        show_result(pdf_index, len(pending), pdf_file, result)
+                        if result['status'] == 'ok':
+                            cohort.add(result['record']['data'])
+
+                    pending = lease_queue.wait_busy() if lease_queue else []
+        except BaseException:
+            # Уже добавленные отчеты сохраняются: при archive_only других копий нет
+            if archive:
+                archive.close()
+            raise
+        finally:
+            if pool:
+                pool.close()
+            if lease_queue:
+                lease_queue.close()
+
+        if profile_dir and not profile_per_file:
+            merge_profile_parts(profile_dir)
+        if memprofile_dir:
+            merge_memprofile_parts(memprofile_dir)
+
+        # ==================== ИТОГИ ====================
+        print(f"\n{'=' * 70}")
+        print("📈 ИТОГИ ОБРАБОТКИ")
+        print('=' * 70)
+
+        print(f"✅ Успешно обработано: {processed_count} файлов")
+        print(f"❌ Не удалось обработать: {failed_count} файлов")
+        if duplicate_count:
+            print(f"🔁 Свернуто дубликатов: {duplicate_count} файлов")
+        print(f"📂 Всего найдено: {len(pdf_files)} файлов")
+
+        summary_file = processing_log.base_path + ".txt"
+        memory_rows = write_text_summary(processing_log.jsonl_path, summary_file, len(pdf_files))
+        if memory_rows:
+            print("\n🧠 ПАМЯТЬ ПО ЭТАПАМ (пик / установившаяся, МБ):")
+            for stage, peak_mb, steady_mb in memory_rows:
+                print(f"   {stage:<14} {peak_mb:8.1f} / {steady_mb:8.1f}")
+
+        print(f"\n📋 Итоговый отчет сохранен в: {summary_file}")
+        print(f"   Построчный журнал: {processing_log.jsonl_path}, {processing_log.csv_path}")
+        if cohort.patients:
+            cohort.save(processing_log.base_path + "_cohort.json")
+            cohort_pdf = create_cohort_summary(cohort, processing_log.base_path + "_cohort.pdf",
+                                               subtitle=os.path.basename(processing_log.base_path))
+            print(f"   Сводка по группе: {cohort_pdf} (скетчи: {processing_log.base_path}_cohort.json)")
+
+        if archive:
+            # Сводки — в конец архива, когда пакет уже обработан
+            for path in (summary_file, processing_log.jsonl_path, processing_log.csv_path,
+                         processing_log.base_path + "_cohort.json", processing_log.base_path + "_cohort.pdf"):
+                if os.path.exists(path):
+                    archive.add(path)
+            assets_dir = os.path.join(output_dir, HTML_ASSETS_DIR, html_asset_version())
+            if report_format() == 'html' and os.path.isdir(assets_dir):
+                archive.add(assets_dir, f"{HTML_ASSETS_DIR}/{html_asset_version()}")
+            archive.close()
+            print(f"   Архив пакета: {archive.path} (файлов: {len(archive.members)})")
+    finally:
+        if output_dir != students_result_dir:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    print(f"\n📁 РЕЗУЛЬТАТЫ СОХРАНЕНЫ В:")
+    if archive_only:
+        print(f"   Архив пакета: {archive.path}")
+    else:
+        print(f"   Отчеты PDF: {os.path.abspath(students_result_dir)}")
+    if debug_log_root():
+        print(f"   Отладочный журнал: {os.path.abspath(debug_log_root())}")
+    print(f"   Временные графики: {scratch_root()}")
+    store = artifact_store()
+    if store:
+        removed, freed, total = store.evict()
+        print(f"   Хранилище артефактов: {store.root} ({total / 1024 / 1024:.1f} МБ"
+              + (f", вытеснено {removed}" if removed else "") + ")")
+
+    if archive_only:
+        result_files = [(name, size) for name, size in archive.members if name.startswith("FootScan_Report_")]
+        if result_files:
+            print(f"\n📄 ОТЧЕТЫ В АРХИВЕ (первые 10):")
+            for i, (name, size) in enumerate(sorted(result_files)[:10], 1):
+                print(f"  {i:2d}. {name} ({size / 1024:.1f} KB)")
+
+            if len(result_files) > 10:
+                print(f"  ... и еще {len(result_files) - 10} файлов")
+    elif os.path.exists(students_result_dir):
+        result_files = glob.glob(os.path.join(students_result_dir, "FootScan_Report_*.pdf"))
+        if result_files:
+            print(f"\n📄 СОЗДАННЫЕ ОТЧЕТЫ (первые 10):")
+            for i, file in enumerate(sorted(result_files)[:10], 1):
+                file_size = os.path.getsize(file) / 1024
+                print(f"  {i:2d}. {os.path.basename(file)} ({file_size:.1f} KB)")
+
+            if len(result_files) > 10:
+                print(f"  ... и еще {len(result_files) - 10} файлов")
+
+    print(f"\n{'=' * 70}")
+    print("🎉 ОБРАБОТКА ЗАВЕРШЕНА!")
+    print('=' * 70)
+
+    if sys.platform == "win32":
+        try:
+            os.startfile(os.path.abspath(students_result_dir))
+        except Exception:
+            pass
+    elif sys.platform == "darwin":
+        try:
+            import subprocess
+            subprocess.call(["open", os.path.abspath(students_result_dir)])
+        except Exception:
+            pass
+
+
+# ============================================================================
+# 28. ЗАПУСК ПРОГРАММЫ
+# ============================================================================
+
+def add_store_arguments(parser, suppress_defaults=False):
+    """Добавляет параметры хранилища артефактов"""
+    parser.add_argument('--store', metavar='DIR', default=argparse.SUPPRESS if suppress_defaults else None,
+                        help=f'Папка хранилища графиков и отчетов (по умолчанию {DEFAULT_STORE_DIR})')
+    parser.add_argument('--store-budget', type=float, metavar='MB',
+                        default=argparse.SUPPRESS if suppress_defaults else DEFAULT_STORE_BUDGET_MB,
+                        help='Бюджет диска хранилища, МБ; давно не использованное вытесняется')
+
+
+def add_worker_arguments(parser, suppress_defaults=False):
+    """Добавляет общие параметры изолированных воркеров"""
+    default = argparse.SUPPRESS if suppress_defaults else None
+    parser.add_argument('--workers', type=int, default=default,
+                        help='Количество воркеров (по умолчанию — число ядер, 0 — без изоляции)')
+    parser.add_argument('--timeout', type=float, default=argparse.SUPPRESS if suppress_defaults else 300,
+                        help='Лимит времени на один файл, с')
+    parser.add_argument('--memory-limit', type=int, default=argparse.SUPPRESS if suppress_defaults else 2048,
+                        help='Бюджет памяти на один файл сверх прогретого воркера, МБ (0 — без лимита)')
+    parser.add_argument('--max-tasks-per-worker', type=int,
+                        default=argparse.SUPPRESS if suppress_defaults else 200,
+                        help='Перезапускать воркер после N файлов (0 — не перезапускать)')
+    parser.add_argument('--rss-limit', type=int, default=argparse.SUPPRESS if suppress_defaults else 1024,
+                        help='Перезапускать воркер, если RSS превысил порог, МБ (0 — без порога)')
+    parser.add_argument('--profile', nargs='?', const='profiles', metavar='DIR',
+                        default=argparse.SUPPRESS if suppress_defaults else None, help='Профилировать этапы (cProfile + стеки для flamegraph) в папку DIR')
+    parser.add_argument('--profile-per-file', action='store_true',
+                        default=argparse.SUPPRESS if suppress_defaults else False,
+                        help='Сохранять профили для каждого файла, а не сводно за пакет')
+    parser.add_argument('--scratch-dir', metavar='DIR', default=argparse.SUPPRESS if suppress_defaults else None,
+                        help=f'Корень временных папок процессов (по умолчанию {DEFAULT_SCRATCH_ROOT}; '
+                             'например, /dev/shm/footscan)')
+    parser.add_argument('--memprofile', nargs='?', const='memprofiles', metavar='DIR',
+                        default=argparse.SUPPRESS if suppress_defaults else None,
+                        help='Снимки tracemalloc по этапам: пик и места выделений (DIR/memprofile.jsonl)')
+    parser.add_argument('--debug-log', metavar='DIR', default=argparse.SUPPRESS if suppress_defaults else None,
+                        help=f'Папка отладочного журнала (по умолчанию {DEFAULT_DEBUG_LOG_DIR})')
+    parser.add_argument('--no-debug-log', action='store_true',
+                        default=argparse.SUPPRESS if suppress_defaults else False,
+                        help='Не вести отладочный журнал')
+    parser.add_argument('--no-store', action='store_true',
+                        default=argparse.SUPPRESS if suppress_defaults else False,
+                        help='Не использовать хранилище артефактов')
+    parser.add_argument('--output-profile', choices=list(OUTPUT_PROFILES),
+                        default=argparse.SUPPRESS if suppress_defaults else None,
+                        help='Профиль размера и качества: screen — почта, print — печать, '
+                             f'archive — хранение (по умолчанию {DEFAULT_OUTPUT_PROFILE})')
+    parser.add_argument('--norms', metavar='FILE', default=argparse.SUPPRESS if suppress_defaults else None,
+                        help='JSON со справочными нормами по полу, возрасту и длине стопы '
+                             '(по умолчанию встроенные)')
+    parser.add_argument('--history', metavar='DIR', default=argparse.SUPPRESS if suppress_defaults else None,
+                        help=f'Папка индекса истории пациентов (по умолчанию {DEFAULT_HISTORY_DIR})')
+    parser.add_argument('--no-history', action='store_true',
+                        default=argparse.SUPPRESS if suppress_defaults else False,
+                        help='Не вести историю и не добавлять в отчет раздел динамики')
+    add_store_arguments(parser, suppress_defaults)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='FootScan Analytics - Генератор медицинских отчетов')
+    parser.add_argument('--clean', action='store_true', help='Очистка временных файлов перед запуском')
+    parser.add_argument('--pdf', type=str, help='Путь к конкретному PDF файлу для обработки')
+    parser.add_argument('--recursive', action='store_true', help='Искать PDF и во вложенных папках')
+    parser.add_argument('--include', action='append', metavar='PATTERN',
+                        help='Шаблон имени входного файла (можно несколько, по умолчанию *.pdf)')
+    parser.add_argument('--exclude', action='append', metavar='PATTERN',
+                        help='Пропускать файлы по шаблону имени или относительного пути')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N',
+                        help='Обработать только шард i из N (по хэшу пути), 0 <= i < N')
+    parser.add_argument('--priority', choices=list(PRIORITIES), default='new',
+                        help='Класс приоритета пакета: new — новые сканы, backfill — перестроение архива')
+    parser.add_argument('--queue', nargs='?', type=float, const=120.0, metavar='TTL',
+                        help='Делить папку с другими узлами через аренду файлов (TTL аренды, с)')
+    parser.add_argument('--format', choices=REPORT_FORMATS, default=None,
+                        help='Формат отчетов: pdf или html для быстрого просмотра (по умолчанию pdf)')
+    parser.add_argument('--no-dedupe', action='store_true',
+                        help='Строить отчеты по всем файлам, не сворачивая повторы одного сканирования')
+    parser.add_argument('--archive', metavar='PATH',
+                        help='Складывать отчеты и сводку пакета в архив по мере готовности (.zip, .tar, .tar.gz)')
+    parser.add_argument('--archive-only', action='store_true',
+                        help='С --archive: не оставлять отдельные файлы отчетов и журнала')
+    add_worker_arguments(parser)
+
+    subparsers = parser.add_subparsers(dest='command')
+
+    serve_parser = subparsers.add_parser('serve', help='Локальный HTTP сервис генерации отчетов')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Адрес для прослушивания')
+    serve_parser.add_argument('--port', type=int, default=8765, help='Порт сервиса')
+    add_worker_arguments(serve_parser, suppress_defaults=True)
+    serve_parser.add_argument('--max-queue', type=int, default=32,
+                              help='Максимум запросов в очереди ожидания')
+    serve_parser.add_argument('--output-dir', default=None, help='Папка для готовых отчетов')
+
+    gc_parser = subparsers.add_parser('gc', help='Очистка хранилища артефактов и временных файлов')
+    add_store_arguments(gc_parser, suppress_defaults=True)
+
+    rerender_parser = subparsers.add_parser('rerender', help='Пересобрать отчеты из сохраненных записей')
+    add_worker_arguments(rerender_parser, suppress_defaults=True)
+    rerender_parser.add_argument('--rescore', action='store_true',
+                                 help='Пересчитать риски и рекомендации по текущим правилам')
+    rerender_parser.add_argument('--legacy-dir', default=LEGACY_REPORTS_DEBUG_DIR,
+                                 help='Папка старых JSON отчетов (пустая строка — не использовать)')
+    rerender_parser.add_argument('--output-dir', default=None, help='Папка для пересобранных отчетов')
+    rerender_parser.add_argument('--format', choices=REPORT_FORMATS, default=argparse.SUPPRESS,
+                                 help='Формат отчетов (по умолчанию pdf)')
+    rerender_parser.add_argument('--priority', choices=list(PRIORITIES), default='backfill',
+                                 help='Класс приоритета (по умолчанию backfill)')
+
+    export_parser = subparsers.add_parser('split-export',
+                                          help='Отчеты по каждому пациенту из выгрузки сеанса сканера (один PDF)')
+    export_parser.add_argument('export', metavar='EXPORT_PDF', help='PDF выгрузки сеанса')
+    add_worker_arguments(export_parser, suppress_defaults=True)
+    export_parser.add_argument('--output-dir', default=None, help='Папка для отчетов')
+    export_parser.add_argument('--format', choices=REPORT_FORMATS, default=argparse.SUPPRESS,
+                               help='Формат отчетов (по умолчанию pdf)')
+
+    history_parser = subparsers.add_parser('history-rebuild',
+                                           help='Перестроить индекс истории по журналу и старым JSON')
+    history_parser.add_argument('--history', metavar='DIR', default=argparse.SUPPRESS,
+                                help=f'Папка индекса истории пациентов (по умолчанию {DEFAULT_HISTORY_DIR})')
+    history_parser.add_argument('--debug-log', metavar='DIR', default=argparse.SUPPRESS,
+                                help=f'Папка отладочного журнала (по умолчанию {DEFAULT_DEBUG_LOG_DIR})')
+    history_parser.add_argument('--legacy-dir', default=LEGACY_REPORTS_DEBUG_DIR,
+                                help='Папка старых JSON отчетов (пустая строка — не использовать)')
+
+    cohort_parser = subparsers.add_parser('cohort-summary',
+                                          help='Слить когорты пакетов и узлов в одностраничную сводку')
+    cohort_parser.add_argument('cohorts', nargs='+', metavar='COHORT_JSON',
+                               help='Файлы processing_summary_*_cohort.json')
+    cohort_parser.add_argument('--output', default='cohort_summary.pdf', help='Путь PDF сводки')
+
+    subparsers.add_parser('font-cache', help='Собрать кэш шрифтов matplotlib (например, при сборке образа)')
+
+    lookup_parser = subparsers.add_parser('debug-lookup', help='Поиск записи в отладочном журнале')
+    lookup_parser.add_argument('query', help='Имя входного файла (можно шаблон) или ID сканера')
+    lookup_parser.add_argument('--debug-log', metavar='DIR', default=argparse.SUPPRESS,
+                               help=f'Папка отладочного журнала (по умолчанию {DEFAULT_DEBUG_LOG_DIR})')
+    lookup_parser.add_argument('--no-text', action='store_true', help='Не выводить извлеченный текст')
+
+    args = parser.parse_args()
+    if args.archive and not args.archive.lower().endswith(ARCHIVE_SUFFIXES):
+        parser.error(f"--archive: ожидается файл {', '.join(ARCHIVE_SUFFIXES)}")
+    if args.archive_only and not args.archive:
+        parser.error("--archive-only используется только вместе с --archive")
+
+    if args.scratch_dir:
+        configure_scratch(args.scratch_dir)
+    configure_store(None if args.no_store else args.store or DEFAULT_STORE_DIR, args.store_budget)
+    configure_debug_log(None if args.no_debug_log else args.debug_log or DEFAULT_DEBUG_LOG_DIR)
+    configure_history(None if args.no_history else args.history or DEFAULT_HISTORY_DIR)
+    configure_norms(args.norms)
+    if args.norms:
+        # Ошибки файла норм — сразу и понятным сообщением, а не падением каждого воркера
+        try:
+            norm_tables()
+        except (OSError, ValueError) as e:
+            parser.error(f"--norms: {e}")
+    configure_output_profile(args.output_profile)
+    # Сервис отдает клиенту PDF, поэтому формат задается только для пакетов и пересборки
+    configure_report_format(None if args.command == 'serve' else args.format)
+    if args.command in (None, 'rerender', 'serve', 'split-export'):
+        ensure_history(debug_log_root(), LEGACY_REPORTS_DEBUG_DIR)
+
+    if args.clean:
+        print("[INFO] Очистка временных файлов...")
+        for dir_name in [scratch_root(), debug_log_root() or DEFAULT_DEBUG_LOG_DIR,
+                         "extracted_data_debug", "generated_reports_debug"]:
+            if os.path.exists(dir_name):
+                import shutil
+
+                try:
+                    shutil.rmtree(dir_name)
+                    print(f"[INFO] Удалена папка: {dir_name}")
+                except Exception as e:
+                    print(f"[WARNING] Не удалось удалить {dir_name}: {e}")
+
+    if args.command == 'gc':
+        collect_garbage(args.store or DEFAULT_STORE_DIR, args.store_budget)
+    elif args.command == 'rerender':
+        output_dir = args.output_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                     "../reports/students_result")
+        run_rerender(output_dir, os.cpu_count() if args.workers is None else args.workers,
+                     debug_log_dir=args.debug_log or DEFAULT_DEBUG_LOG_DIR, legacy_dir=args.legacy_dir,
+                     rescore=args.rescore, task_timeout=args.timeout or None, memory_limit_mb=args.memory_limit,
+                     max_tasks_per_worker=args.max_tasks_per_worker, rss_limit_mb=args.rss_limit,
+                     priority=args.priority)
+    elif args.command == 'split-export':
+        if not os.path.exists(args.export):
+            print(f"[ERROR] Файл не найден: {args.export}")
+        else:
+            output_dir = args.output_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         "../reports/students_result")
+            run_split_export(args.export, output_dir, os.cpu_count() if args.workers is None else args.workers,
+                             task_timeout=args.timeout or None, memory_limit_mb=args.memory_limit,
+                             max_tasks_per_worker=args.max_tasks_per_worker, rss_limit_mb=args.rss_limit,
+                             priority=args.priority)
+    elif args.command == 'history-rebuild':
+        history = PatientHistory(args.history or DEFAULT_HISTORY_DIR)
+        if os.path.isdir(history.root):
+            shutil.rmtree(history.root)
+        added = rebuild_history(history, args.debug_log or DEFAULT_DEBUG_LOG_DIR, args.legacy_dir)
+        print(f"[INFO] Индекс истории пациентов перестроен: {history.root} (сканирований: {added})")
+    elif args.command == 'cohort-summary':
+        cohort = merge_cohort_files(args.cohorts)
+        create_cohort_summary(cohort, args.output, subtitle=f"Файлов когорт: {len(args.cohorts)}")
+        print(f"[INFO] Сводка по группе ({cohort.patients.get('all', 0)} пациентов): {args.output}")
+    elif args.command == 'font-cache':
+        family = register_chart_fonts()
+        font_path = font_manager.findfont(family, fallback_to_default=False)
+        print(f"[INFO] Кэш шрифтов: {os.environ.get(MPL_CACHE_ENV) or matplotlib.get_cachedir()}")
+        print(f"[INFO] Шрифт графиков: {family} ({font_path})")
+    elif args.command == 'debug-lookup':
+        found = 0
+        for record in lookup_debug_records(args.debug_log or DEFAULT_DEBUG_LOG_DIR, args.query):
+            if args.no_text:
+                record.pop('text', None)
+            print(json.dumps(record, ensure_ascii=False, indent=2))
+            found += 1
+        print(f"[INFO] Найдено записей: {found}")
+    elif args.command == 'serve':
+        output_dir = args.output_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "students_result")
+        run_service(args.host, args.port, args.workers, args.max_queue, output_dir,
+                    task_timeout=args.timeout or None, memory_limit_mb=args.memory_limit,
+                    max_tasks_per_worker=args.max_tasks_per_worker, rss_limit_mb=args.rss_limit,
+                    profile_dir=args.profile, profile_per_file=args.profile_per_file,
+                    memprofile_dir=args.memprofile)
+    elif args.pdf:
+        if os.path.exists(args.pdf):
+            print(f"Обработка указанного файла: {args.pdf}")
+            current_dir = os.path.dirname(os.path.abspath(__file__))
+            students_result_dir = os.path.join(current_dir, "students_result")
+
+            if not os.path.exists(students_result_dir):
+                os.makedirs(students_result_dir, exist_ok=True)
+
+            profilers = install_stage_hooks(args.profile, True, args.memprofile)
+
+            result = process_pdf_file(args.pdf, students_result_dir)
+
+            flush_stage_hooks(profilers, args.pdf)
+            if args.profile:
+                print(f"[INFO] Профили этапов сохранены в: {os.path.abspath(args.profile)}")
+            if args.memprofile:
+                merge_memprofile_parts(args.memprofile)
+
+            if result['status'] != 'ok':
+                print("[ERROR] Не удалось извлечь данные из PDF!")
+                print("[INFO] Проверьте структуру PDF файла")
+                sys.exit(1)
 
-            print(f"\n✅ Отчет создан: {output_filename}")
+            print(f"\n✅ Отчет создан: {result['output_path']}")
             print(f"📂 Папка с результатами: {os.path.abspath(students_result_dir)}")
         else:
             print(f"[ERROR] Файл не найден: {args.pdf}")
     else:
-        main()
+        workers = os.cpu_count() if args.workers is None else args.workers
+        main(workers=workers, task_timeout=args.timeout or None, memory_limit_mb=args.memory_limit,
+             max_tasks_per_worker=args.max_tasks_per_worker, rss_limit_mb=args.rss_limit,
+             profile_dir=args.profile, profile_per_file=args.profile_per_file,
+             memprofile_dir=args.memprofile, recursive=args.recursive,
+             include=args.include, exclude=args.exclude, shard=args.shard, lease_ttl=args.queue,
+             priority=args.priority, dedupe=not args.no_dedupe, archive_path=args.archive,
+             archive_only=args.archive_only)
 
     print("\n👋 Программа завершена.")
\ No newline at end of file
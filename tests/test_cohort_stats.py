@@ -0,0 +1,49 @@
+import math
+import random
+
+import pytest
+
+from professional_footscan_report import SKETCH_ACCURACY, QuantileSketch
+
+
+def sketch_of(values):
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+def round_trip(sketch):
+    return QuantileSketch.from_dict(sketch.to_dict())
+
+
+@pytest.mark.parametrize('values', [
+    [random.Random(1).lognormvariate(5, 1) for _ in range(5000)],
+    [random.Random(2).uniform(-300, 300) for _ in range(5000)],
+    [0.0] * 100 + [random.Random(3).uniform(200, 280) for _ in range(900)],
+])
+def test_quantile_within_relative_accuracy(values):
+    sketch = sketch_of(values)
+    ordered = sorted(values)
+    for q in [0.0, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1.0]:
+        exact = ordered[math.floor(q * (len(ordered) - 1))]
+        assert abs(sketch.quantile(q) - exact) <= SKETCH_ACCURACY * abs(exact) + 1e-12, q
+
+
+def test_merge_is_associative_through_dicts():
+    rng = random.Random(4)
+    parts = [[rng.uniform(-50, 400) for _ in range(size)] for size in (300, 1, 700)]
+    a, b, c = (sketch_of(part) for part in parts)
+
+    left = round_trip(round_trip(a).merge(round_trip(b))).merge(round_trip(c))
+    right = round_trip(a).merge(round_trip(round_trip(b).merge(round_trip(c))))
+    whole = sketch_of(parts[0] + parts[1] + parts[2])
+
+    assert left.to_dict() == right.to_dict() == whole.to_dict()
+    assert left.count == right.count == whole.count == 1001
+    assert [left.quantile(q) for q in (0.1, 0.5, 0.9)] == [whole.quantile(q) for q in (0.1, 0.5, 0.9)]
+
+
+def test_merge_rejects_other_accuracy():
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
@@ -0,0 +1,46 @@
+import itertools
+
+from professional_footscan_report import collapse_duplicates, dedupe_fields
+
+
+def scan(name, scanner_id='7_1', client='Иванов Иван', scan_date='2024/05/01', mtime=0.0, length=240):
+    data = {'scanner_id': scanner_id, 'client_name': client, 'scan_date': scan_date,
+            'foot_length': {'left': length, 'right': length}}
+    return {'input_pdf': name, 'source_mtime': mtime, 'record': {'data': data}, **dedupe_fields(data)}
+
+
+def winners(items):
+    canonical, collapsed = collapse_duplicates(items, recency=lambda item: item['source_mtime'])
+    return sorted(item['input_pdf'] for item in canonical), sorted(item['input_pdf'] for item, _, _ in collapsed)
+
+
+def test_winner_does_not_depend_on_input_order():
+    items = [
+        # Одно сканирование: самый свежий файл выигрывает
+        scan('old.pdf', mtime=1.0),
+        scan('new.pdf', mtime=3.0, length=241),
+        scan('copy.pdf', mtime=2.0),
+        # Равная свежесть: выбор по хэшу данных, а не по порядку
+        scan('tie_a.pdf', client='Петров Петр', mtime=5.0, length=230),
+        scan('tie_b.pdf', client='ПЕТРОВ  петр', mtime=5.0, length=231),
+        # Без номера сканера файлы не сворачиваются
+        scan('no_id_1.pdf', scanner_id='', mtime=1.0),
+        scan('no_id_2.pdf', scanner_id='', mtime=1.0),
+        # Другая дата — другое сканирование
+        scan('other_day.pdf', scan_date='2024/06/01', mtime=1.0),
+    ]
+
+    expected = winners(items)
+    assert 'new.pdf' in expected[0] and 'no_id_1.pdf' in expected[0] and 'other_day.pdf' in expected[0]
+    assert len(expected[0]) == 5 and len(expected[1]) == 3
+    for order in itertools.permutations(items):
+        assert winners(list(order)) == expected
+
+
+def test_canonical_keep_input_order_and_report_same_data():
+    items = [scan('b.pdf', mtime=1.0), scan('a.pdf', mtime=2.0), scan('c.pdf', scan_date='2024/07/01')]
+    canonical, collapsed = collapse_duplicates(items, recency=lambda item: item['source_mtime'])
+
+    assert [item['input_pdf'] for item in canonical] == ['a.pdf', 'c.pdf']
+    [(item, kept, same)] = collapsed
+    assert (item['input_pdf'], kept['input_pdf'], same) == ('b.pdf', 'a.pdf', True)
@@ -0,0 +1,91 @@
+import os
+import time
+
+import pytest
+
+from professional_footscan_report import LeaseQueue, run_leased
+
+
+@pytest.fixture
+def queues(tmp_path):
+    """Два узла с общей папкой очереди"""
+    first = LeaseQueue(tmp_path, ttl=60.0, node='node-a')
+    second = LeaseQueue(tmp_path, ttl=60.0, node='node-b')
+    yield first, second
+    first.close()
+    second.close()
+
+
+def expire(lease, ttl=60.0):
+    """Состаривает аренду, как будто узел-владелец перестал ее продлевать"""
+    old = time.time() - ttl - 1
+    os.utime(lease['lease_path'], (old, old))
+
+
+def test_claim_is_exclusive(tmp_path, queues):
+    first, second = queues
+    pdf_path = str(tmp_path / 'a.pdf')
+
+    lease = first.claim(pdf_path)
+    assert lease is not None
+    assert second.claim(pdf_path) is None
+    assert pdf_path in second.busy
+
+    assert first.finish(lease, {'status': 'ok'})
+    assert not os.path.exists(lease['lease_path'])
+    assert os.path.exists(lease['done_path'])
+    assert second.claim(pdf_path) is None
+
+
+def test_expired_lease_is_reclaimed(tmp_path, queues):
+    first, second = queues
+    pdf_path = str(tmp_path / 'a.pdf')
+
+    lease_a = first.claim(pdf_path)
+    assert second.claim(pdf_path) is None
+
+    expire(lease_a)
+    lease_b = second.claim(pdf_path)
+    assert lease_b is not None
+    assert lease_b['token'] != lease_a['token']
+
+    # Первый узел потерял аренду: его результат не засчитывается и чужую аренду он не снимает
+    assert not first.finish(lease_a, {'status': 'ok'})
+    assert os.path.exists(lease_b['lease_path'])
+    assert second.finish(lease_b, {'status': 'ok'})
+
+
+def test_lost_lease_result_is_dropped(tmp_path, queues):
+    first, second = queues
+    pdf_path = str(tmp_path / 'a.pdf')
+    report_path = tmp_path / 'report_a.pdf'
+    reclaimed = []
+
+    def process():
+        # Пока первый узел строит отчет, его аренду забирает и завершает второй
+        lease_a = {'lease_path': os.path.join(first.queue_dir, first._key(pdf_path) + '.lease')}
+        expire(lease_a)
+        lease_b = second.claim(pdf_path)
+        reclaimed.append(second.finish(lease_b, {'status': 'ok'}))
+        report_path.write_bytes(b'%PDF')
+        return {'status': 'ok', 'output_path': str(report_path)}
+
+    assert run_leased(first, pdf_path, process) is None
+    assert reclaimed == [True]
+    assert not report_path.exists()
+
+
+def test_done_is_written_once(tmp_path, queues):
+    first, second = queues
+    pdf_path = str(tmp_path / 'a.pdf')
+
+    lease = first.claim(pdf_path)
+    # Другой узел уже отметил файл готовым: os.link не перезаписывает его отметку
+    with open(lease['done_path'], 'w', encoding='utf-8') as f:
+        f.write('node-b')
+
+    assert not first.finish(lease, {'status': 'ok'})
+    with open(lease['done_path'], encoding='utf-8') as f:
+        assert f.read() == 'node-b'
+    assert not os.path.exists(lease['lease_path'])
+    assert [name for name in os.listdir(first.queue_dir) if name.endswith('.tmp')] == []
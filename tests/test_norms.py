@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from professional_footscan_report import (DEFAULT_AGE_BANDS, DEFAULT_LENGTH_BANDS, NORM_GENDERS, FootPair,
+                                          FootScanRecord, NormTable)
+
+# Нормы, которые были зашиты в отчет до таблицы норм
+OLD_NORMS = {
+    'foot_length': (230, 260),
+    'foot_width': (90, 105),
+    'ball_girth': (230, 250),
+    'arch_index': (0.26, 0.29),
+    'heel_angle': (0, 4),
+    'hallux_angle': (0, 8),
+}
+
+
+def patient(age='', gender='', length=240):
+    return FootScanRecord(age=str(age), gender=gender, foot_length=FootPair(length, length))
+
+
+def load(tmp_path, payload):
+    path = tmp_path / 'norms.json'
+    path.write_text(json.dumps(payload, ensure_ascii=False), encoding='utf-8')
+    return NormTable.load(str(path))
+
+
+def test_defaults_match_old_constants():
+    table = NormTable()
+    for gender in NORM_GENDERS:
+        for age in ('', *DEFAULT_AGE_BANDS, 40):
+            for length in (*DEFAULT_LENGTH_BANDS, 300):
+                assert table.lookup(patient(age, gender, length)) == OLD_NORMS
+
+
+def test_rule_applies_to_every_overlapping_band(tmp_path):
+    # Возрастные группы по умолчанию: [0, 7), [7, 12), [12, 16), [16, 18), [18, ...)
+    table = load(tmp_path, {'norms': [
+        {'age_range': [8, 10], 'foot_width': [80, 90]},
+        {'age_range': [10, 14], 'heel_angle': [1, 3]},
+        {'age_range': [12, 16], 'hallux_angle': [0, 6]},
+    ]})
+
+    assert table.lookup(patient(6))['foot_width'] == OLD_NORMS['foot_width']
+    assert table.lookup(patient(9))['foot_width'] == (80, 90)
+    assert table.lookup(patient(11))['foot_width'] == (80, 90)
+
+    for age in (7, 11, 12, 15):
+        assert table.lookup(patient(age))['heel_angle'] == (1, 3), age
+    assert table.lookup(patient(16))['heel_angle'] == OLD_NORMS['heel_angle']
+
+    # Верхняя граница диапазона не входит: группа [7, 12) правило [12, 16) не получает
+    assert table.lookup(patient(11))['hallux_angle'] == OLD_NORMS['hallux_angle']
+    assert table.lookup(patient(13))['hallux_angle'] == (0, 6)
+    assert table.lookup(patient(16))['hallux_angle'] == OLD_NORMS['hallux_angle']
+
+
+def test_rule_limited_by_gender_and_length(tmp_path):
+    table = load(tmp_path, {'norms': [{'gender': 'мужской', 'length_range': [260, 400], 'foot_length': [255, 290]}]})
+
+    assert table.lookup(patient(30, 'Мужской', 270))['foot_length'] == (255, 290)
+    assert table.lookup(patient(30, 'Женский', 270))['foot_length'] == OLD_NORMS['foot_length']
+    assert table.lookup(patient(30, 'Мужской', 250))['foot_length'] == OLD_NORMS['foot_length']
+
+
+@pytest.mark.parametrize('payload', [
+    {'age_bands': [0, 12, 7]},
+    {'norms': [{'gender': 'другой', 'foot_width': [80, 90]}]},
+    {'norms': [{'age_range': [10, 8], 'foot_width': [80, 90]}]},
+    {'norms': [{'foot_width': [90, 80]}]},
+    {'norms': [{'foot_width': '80-90'}]},
+])
+def test_invalid_file_is_rejected(tmp_path, payload):
+    with pytest.raises(ValueError):
+        load(tmp_path, payload)
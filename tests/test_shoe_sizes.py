@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from professional_footscan_report import (FootPair, FootScanRecord, convert_shoe_size, convert_shoe_sizes,
+                                          shoe_size_source)
+
+
+def old_eu(length):
+    """Прежний расчет размера EU по длине стопы"""
+    return round((length * 1.5 + 15.5) / 10 * 2) / 2
+
+
+def boundary_lengths():
+    """Длины у каждой границы полуразмера EU (внутри диапазона таблиц) и точки с шагом 0.1 мм"""
+    lengths = []
+    for step in range(200):
+        boundary = ((step + 0.5) * 5 - 15.5) / 1.5
+        if 100 < boundary < 350:
+            lengths += [boundary - 1e-6, boundary + 1e-6, round(boundary, 1), boundary - 0.2, boundary + 0.2]
+    return lengths
+
+
+@pytest.mark.parametrize('length', boundary_lengths()[::7] + [100.0, 240.0, 241.3, 349.9])
+def test_eu_matches_old_formula(length):
+    assert convert_shoe_size(length)['eu'] == old_eu(length)
+
+
+def test_vectorized_eu_matches_old_formula():
+    lengths = np.array(boundary_lengths() + [round(value, 1) for value in np.arange(100, 350, 0.1)])
+    sizes = convert_shoe_sizes(lengths)
+    assert sizes['eu'].tolist() == [old_eu(length) for length in lengths]
+
+
+def test_missing_length_has_no_size():
+    assert convert_shoe_size(0) is None
+    sizes = convert_shoe_sizes([0, 240.0])
+    assert np.isnan(sizes['eu'][0]) and sizes['eu'][1] == old_eu(240.0)
+    assert not sizes['child'][0]
+
+
+def test_size_source():
+    derived = FootScanRecord(foot_length=FootPair(241.3, 243.0), shoe_size=FootPair(old_eu(241.3), old_eu(243.0)))
+    scanner = FootScanRecord(foot_length=FootPair(241.3, 243.0), shoe_size=FootPair(40, 40))
+    assert shoe_size_source(derived) == 'По длине стопы'
+    assert shoe_size_source(scanner) == 'По данным сканера'
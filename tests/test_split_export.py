@@ -0,0 +1,81 @@
+import professional_footscan_report as report
+from professional_footscan_report import READER_CACHE_LIMIT, iter_pdf_pages, split_export_pages
+
+
+def groups(pages):
+    return [(first, last, text) for first, last, text in split_export_pages(pages)]
+
+
+def test_split_on_page_one():
+    pages = ["Page 1 Scanner No 11_1 Иванов\n", "Page 2 Scanner No 11_1\n",
+             "Page 1 Scanner No 11_1 Петров\n", "Page 2 Scanner No 11_1\n", "Page 3\n"]
+    assert groups(pages) == [(1, 2, pages[0] + pages[1]), (3, 5, pages[2] + pages[3] + pages[4])]
+
+
+def test_split_on_scanner_number_change():
+    pages = ["Scanner No 11_1 Иванов\n", "продолжение\n", "Scanner No 11_1\n",
+             "Scanner No 12_7 Петров\n", "Scanner No 12_7\n"]
+    assert [(first, last) for first, last, _ in groups(pages)] == [(1, 3), (4, 5)]
+
+
+def test_scanner_number_from_later_page():
+    # Номер сканера пациента берется с первой страницы, где он есть
+    pages = ["Иванов\n", "Scanner No 11_1\n", "Scanner No 12_7 Петров\n"]
+    assert [(first, last) for first, last, _ in groups(pages)] == [(1, 2), (3, 3)]
+
+
+def test_pages_are_consumed_lazily():
+    read = []
+
+    def pages():
+        for text in ["Page 1 A\n", "Page 2 A\n", "Page 1 B\n", "Page 2 B\n"]:
+            read.append(text)
+            yield text
+
+    batches = split_export_pages(pages())
+    assert next(batches)[:2] == (1, 2)
+    assert len(read) == 3
+    assert [batch[:2] for batch in batches] == [(3, 4)]
+    assert groups([]) == []
+
+
+class FakePage:
+    def __init__(self, text):
+        self.text = text
+
+    def extract_text(self):
+        return self.text
+
+
+class FakeReader:
+    def __init__(self, file):
+        self.pages = [FakePage("Page  1\n\nScanner No 1_1"), FakePage("Page 2")]
+
+
+class CachingReader(FakeReader):
+    def __init__(self, file):
+        super().__init__(file)
+        self.resolved_objects = dict.fromkeys(range(READER_CACHE_LIMIT + 1))
+
+
+def test_iter_pdf_pages_without_object_cache(tmp_path, monkeypatch):
+    pdf_path = tmp_path / 'export.pdf'
+    pdf_path.write_bytes(b'%PDF')
+    monkeypatch.setattr(report.PyPDF2, 'PdfReader', FakeReader)
+    assert list(iter_pdf_pages(str(pdf_path))) == ["Page 1 Scanner No 1_1\n", "Page 2\n"]
+
+
+def test_iter_pdf_pages_clears_object_cache(tmp_path, monkeypatch):
+    pdf_path = tmp_path / 'export.pdf'
+    pdf_path.write_bytes(b'%PDF')
+    readers = []
+
+    def open_reader(file):
+        readers.append(CachingReader(file))
+        return readers[-1]
+
+    monkeypatch.setattr(report.PyPDF2, 'PdfReader', open_reader)
+    pages = iter_pdf_pages(str(pdf_path))
+    next(pages)
+    next(pages)
+    assert readers[0].resolved_objects == {}